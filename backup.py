@@ -1,18 +1,43 @@
 import os
-import time
 import pyodbc
 import datetime
-from loggingUtils import log_config
 import threading
+from contextlib import contextmanager
+from loggingUtils import log_config
+import re
+import backup_sets
+import progress
+import chain
+import metrics
+import retention
 
 # ===== LOGGING CONFIGURATION =====
 logger = log_config()
 
 # ===== CONFIG =====
-SERVER = "Servidor\\MW"
-DATABASE = "MWFichaClinica"
 USERNAME = "sa"
 BACKUP_FOLDER = r"C:\Users\Servidor\Desktop\GynébeBackup"
+# Open connections kept per connection string, reused between runs by the daemon
+POOL_SIZE = 2
+
+# ===== BACKUP OPTIONS =====
+# compression: True/False forces SQL Server native backup compression on/off,
+#              None keeps the server default (Express editions do not support it)
+# stripes: number of files the backup is striped across (written in parallel)
+# buffer_count / max_transfer_size / block_size: None keeps the SQL Server default
+# checksum: write page checksums into the backup so RESTORE VERIFYONLY can check them
+BACKUP_OPTIONS = {
+    "compression": None,
+    "checksum": True,
+    "stripes": 1,
+    "buffer_count": None,
+    "max_transfer_size": None,  # bytes, multiple of 64 KiB up to 4 MiB
+    "block_size": None,
+}
+
+
+# "10 percent processed." messages sent by SQL Server for WITH STATS
+PERCENT_PATTERN = re.compile(r"(\d+) percent processed")
 
 
 # ===== FILESYSTEM PERMISSION TEST =====
@@ -30,129 +55,219 @@ def test_folder_permissions(folder: str):
 
 
 # ===== HELPER FUNCTIONS =====
-def cleanup_old_backups(folder: str, max_backups: int = 3):
-    """Keep only the latest 'max_backups' .bak files."""
-    backups = sorted(
-        [os.path.join(folder, f) for f in os.listdir(folder) if f.endswith(".bak")],
-        key=os.path.getmtime,
-        reverse=True,
+def cleanup_old_backups(folder: str, policy: dict = None):
+    """Apply the local retention policy (see retention.POLICIES) to the backup folder."""
+    retention.cleanup_folder(folder, policy or retention.POLICIES["local"])
+
+
+# File name tag and backup name for each backup type
+BACKUP_TYPES = {
+    chain.FULL: ("", "Full Database Backup"),
+    chain.DIFFERENTIAL: ("_diff", "Differential Database Backup"),
+    chain.LOG: ("_log", "Transaction Log Backup"),
+}
+
+
+def get_backup_files(backup_dir: str, database: str, timestamp: str, stripes: int = 1,
+                     backup_type: str = chain.FULL) -> list:
+    """Paths of every file of a backup set (one per stripe)."""
+    tag = BACKUP_TYPES[backup_type][0]
+    return [
+        os.path.join(backup_dir, f"{database}_{timestamp}{tag}{backup_sets.stripe_suffix(i, stripes)}.bak")
+        for i in range(1, stripes + 1)
+    ]
+
+
+def build_backup_sql(database: str, backup_files: list, options: dict = None,
+                     backup_type: str = chain.FULL) -> str:
+    """Generate the BACKUP DATABASE/LOG statement for the given files, options and backup type."""
+    options = {**BACKUP_OPTIONS, **(options or {})}
+    disks = ", ".join(f"DISK = N'{f}'" for f in backup_files)
+
+    settings = ["NOFORMAT", "NOINIT", f"NAME = N'{database}-{BACKUP_TYPES[backup_type][1]}'",
+                "SKIP", "NOREWIND", "NOUNLOAD"]
+    if backup_type == chain.DIFFERENTIAL:
+        settings.insert(0, "DIFFERENTIAL")
+    if options["checksum"]:
+        settings.append("CHECKSUM")
+    if options["compression"] is not None:
+        settings.append("COMPRESSION" if options["compression"] else "NO_COMPRESSION")
+    if options["buffer_count"]:
+        settings.append(f"BUFFERCOUNT = {int(options['buffer_count'])}")
+    if options["max_transfer_size"]:
+        settings.append(f"MAXTRANSFERSIZE = {int(options['max_transfer_size'])}")
+    if options["block_size"]:
+        settings.append(f"BLOCKSIZE = {int(options['block_size'])}")
+    settings.append("STATS = 10")
+
+    command = "BACKUP LOG" if backup_type == chain.LOG else "BACKUP DATABASE"
+    return f"{command} [{database}] TO {disks} WITH {', '.join(settings)};"
+
+
+def report_messages(cursor, database: str):
+    """Log the informational messages of the current result set and publish backup progress."""
+    for _, message in getattr(cursor, "messages", None) or []:
+        text = str(message).rsplit("]", 1)[-1].strip()
+        match = PERCENT_PATTERN.search(text)
+        if match:
+            percent = int(match.group(1))
+            logger.info(f"Progress: {percent}% complete")
+            progress.publish("backup", percent, database=database)
+        else:
+            logger.info(f"SQL Server: {text}")
+
+
+def connection_string(server: str, username: str, password: str) -> str:
+    return (
+        f"DRIVER={{ODBC Driver 17 for SQL Server}};"
+        f"SERVER={server};DATABASE=master;UID={username};PWD={password}"
     )
-    for old_file in backups[max_backups:]:
-        try:
-            os.remove(old_file)
-            logger.info(f"Deleted old backup: {old_file}")
-        except Exception as e:
-            logger.warning(f"Could not delete {old_file}: {e}")
+
+
+_pool = {}
+_pool_lock = threading.Lock()
+
+
+def is_alive(conn) -> bool:
+    try:
+        conn.cursor().execute("SELECT 1").fetchone()
+        return True
+    except pyodbc.Error:
+        return False
+
+
+@contextmanager
+def connect(server: str, username: str, password: str):
+    """
+    Connection taken from a small pool of open connections (checked before reuse).
+    A connection that raised an error is closed instead of being returned to the pool.
+    """
+    conn_str = connection_string(server, username, password)
+    with _pool_lock:
+        idle = _pool.setdefault(conn_str, [])
+        conn = idle.pop() if idle else None
+    if conn is not None and not is_alive(conn):
+        logger.info("Discarding stale SQL Server connection")
+        conn.close()
+        conn = None
+    if conn is None:
+        conn = pyodbc.connect(conn_str, autocommit=True)
+
+    try:
+        yield conn
+    except Exception:
+        conn.close()
+        raise
+    with _pool_lock:
+        if len(idle) < POOL_SIZE:
+            idle.append(conn)
+            return
+    conn.close()
 
 
 # ===== BACKUP FUNCTION =====
-def backup_database(server: str, database: str, username: str, password: str, backup_dir: str) -> str | None:
+def backup_database(server: str, database: str, username: str, password: str, backup_dir: str,
+                    options: dict = None, backup_type: str = None, on_files=None, cleanup: bool = True) -> list | None:
+    """
+    Run a full, differential or log backup, verify it and record it in the chain index.
+    When 'backup_type' is None the chain planner picks full or differential.
+    'on_files' is called with the backup file paths right before SQL Server starts writing them.
+    With 'cleanup' the local retention policy is applied afterwards (main.py does it as the last phase).
+    Returns the list of files of the backup set (one per stripe), or None on failure.
+    """
+    options = {**BACKUP_OPTIONS, **(options or {})}
+    backup_type = backup_type or chain.plan_backup_type(database)
     os.makedirs(backup_dir, exist_ok=True)
     timestamp = datetime.datetime.now().strftime("%d-%m-%Y_%H-%M")
-    backup_file = os.path.join(backup_dir, f"{database}_{timestamp}.bak")
-
-    conn_str = (
-        f"DRIVER={{ODBC Driver 17 for SQL Server}};"
-        f"SERVER={server};DATABASE=master;UID={username};PWD={password}"
+    backup_files = get_backup_files(
+        backup_dir, database, timestamp, max(1, int(options["stripes"])), backup_type
     )
 
-    backup_sql = f""" 
-        BACKUP DATABASE [{database}] 
-        TO DISK = N'{backup_file}' 
-        WITH NOFORMAT, NOINIT, 
-        NAME = N'{database}-Full Database Backup',
-        SKIP, NOREWIND, NOUNLOAD, STATS = 10; 
-    """
-    backup_sql.encode(encoding='UTF-8')
+    backup_sql = build_backup_sql(database, backup_files, options, backup_type)
 
     try:
         logger.info(f"Connecting to SQL Server at {server}...")
-        def run_backup():
-            with pyodbc.connect(conn_str, autocommit=True) as conn:
-                cursor = conn.cursor()
-
-                logger.info(f"Starting backup of '{database}' to: {backup_file}")
+        with connect(server, username, password) as conn:
+            cursor = conn.cursor()
+            logger.info(f"Starting {backup_type} backup of '{database}' to: {', '.join(backup_files)}")
+            progress.publish("backup", 0, database=database, backup_type=backup_type)
+            if on_files is not None:
+                on_files(backup_files)
 
-                try:
+            try:
+                # Each STATS message arrives as its own result set, as soon as SQL Server sends it
+                with metrics.phase("backup") as p:
                     cursor.execute(backup_sql)
-                    time.sleep(2)
+                    report_messages(cursor, database)
                     while cursor.nextset():
-                        pass
-
-                except pyodbc.Error as sql_err:
-                    logger.error("SQL Server BACKUP command failed!")
-                    logger.error(f"ODBC Error: {sql_err}", exc_info=True)
-
-                    # Extract detailed SQL Server messages
-                    if hasattr(cursor, 'messages') and cursor.messages:
-                        logger.error("SQL Server returned the following messages:")
-                        for msg in cursor.messages:
-                            logger.error(str(msg))
-
-                    return None
-
-                logger.info("Backup operation completed on SQL Server.")
-                cursor.close()
-
-        # Poll backup progress
-        with pyodbc.connect(conn_str, autocommit=True) as progress_conn:
-            logger.info(f"Starting backup of '{database}'...")
-            progress_cursor = progress_conn.cursor()
-
-            backup_thread = threading.Thread(target=run_backup)
-            backup_thread.start()
-
-            while backup_thread.is_alive():
-                progress_cursor.execute("""
-                    SELECT percent_complete, 
-                        estimated_completion_time/1000/60 AS est_min_left
-                    FROM sys.dm_exec_requests
-                    WHERE command = 'BACKUP DATABASE';
-                """)
-                row = progress_cursor.fetchone()
-                if row:
-                    percent = round(row.percent_complete, 1)
-                    est_time = int(row.est_min_left or 0)
-                    logger.info(f"Progress: {percent}% complete, ~{est_time} min remaining...")
-                else:
-                    logger.info("Backup still initializing...")
-                time.sleep(5)
-
-            backup_thread.join()
-            progress_conn.close()
-        time.sleep(1)
-
-        # Verify file creation
-        if not os.path.exists(backup_file):
-            logger.error("Backup file DOES NOT exist after SQL reported success!")
-            return None
-
-        logger.info("Verifying backup integrity...")
-        verify_sql = f"RESTORE HEADERONLY FROM DISK = N'{backup_file}'"
-
-        with pyodbc.connect(conn_str, autocommit=True) as conn:
-            cur = conn.cursor()
+                        report_messages(cursor, database)
+                    p["bytes"] = sum(os.path.getsize(f) for f in backup_files if os.path.exists(f))
+
+            except pyodbc.Error as sql_err:
+                logger.error("SQL Server BACKUP command failed!")
+                logger.error(f"ODBC Error: {sql_err}", exc_info=True)
+
+                # Extract detailed SQL Server messages
+                if hasattr(cursor, 'messages') and cursor.messages:
+                    logger.error("SQL Server returned the following messages:")
+                    for msg in cursor.messages:
+                        logger.error(str(msg))
+
+                return None
+
+            logger.info("Backup operation completed on SQL Server.")
+            progress.publish("backup", 100, database=database, done=True)
+
+            # Verify file creation
+            missing = [f for f in backup_files if not os.path.exists(f)]
+            if missing:
+                logger.error(f"Backup file DOES NOT exist after SQL reported success: {', '.join(missing)}")
+                return None
+
+            logger.info("Verifying backup integrity...")
+            verify_sql = "RESTORE HEADERONLY FROM " + ", ".join(f"DISK = N'{f}'" for f in backup_files)
 
             try:
-                cur.execute(verify_sql)
+                with metrics.phase("verify"):
+                    cursor.execute(verify_sql)
+                    header = cursor.fetchone()
             except pyodbc.Error as v_err:
                 logger.error("RESTORE HEADERONLY verification failed!")
                 logger.error(f"ODBC Error: {v_err}", exc_info=True)
-                if hasattr(cur, 'messages') and cur.messages:
+                if hasattr(cursor, 'messages') and cursor.messages:
                     logger.error("SQL Server returned the following messages:")
-                    for msg in cur.messages:
+                    for msg in cursor.messages:
                         logger.error(str(msg))
                 return None
 
-        logger.info(f"Backup completed and verified successfully: {backup_file}")
-        cleanup_old_backups(backup_dir, max_backups=3)
-        return backup_file
+        logger.info(f"Backup completed and verified successfully: {', '.join(backup_files)}")
+        chain.record_backup(database, backup_type, backup_files, header)
+        if cleanup:
+            with metrics.phase("cleanup_local"):
+                cleanup_old_backups(backup_dir)
+        return backup_files
 
     except Exception as e:
         logger.error("Unexpected fatal error during backup!", exc_info=True)
         return None
 
 
+def verify_backup_checksum(server: str, username: str, password: str, backup_files: list):
+    """
+    Run RESTORE VERIFYONLY WITH CHECKSUM on a backup set. Uses a separate connection so it can run
+    while the files are being sent to the destinations. Raises on failure.
+    """
+    disks = ", ".join(f"DISK = N'{f}'" for f in backup_files)
+    with connect(server, username, password) as conn:
+        cursor = conn.cursor()
+        logger.info(f"Running RESTORE VERIFYONLY on {', '.join(backup_files)}")
+        with metrics.phase("verify_checksum", sum(os.path.getsize(f) for f in backup_files)):
+            cursor.execute(f"RESTORE VERIFYONLY FROM {disks} WITH CHECKSUM;")
+            while cursor.nextset():
+                pass
+    logger.info("RESTORE VERIFYONLY: backup set is valid")
+
+
 # ===== MAIN EXECUTION =====
 if __name__ == "__main__":
     logger.info("=== Starting SQL Server backup process ===")
@@ -160,11 +275,16 @@ if __name__ == "__main__":
     # Test if Python can write to the folder BEFORE running SQL backup
     test_folder_permissions(BACKUP_FOLDER)
 
+    import orchestrator
     try:
-        with open("database_password.txt", "r", encoding="utf-8") as file:
-            PASSWORD = file.readline().strip()
+        # The instances and databases to back up are listed in the databases file
+        jobs = orchestrator.load_jobs(defaults={
+            "username": USERNAME, "password_file": "database_password.txt", "backup_dir": BACKUP_FOLDER,
+        })
     except Exception:
-        logger.error("Failed to read database_password.txt", exc_info=True)
+        logger.error(f"Failed to read {orchestrator.DATABASES_FILE} or a password file", exc_info=True)
         raise
 
-    backup_database(SERVER, DATABASE, USERNAME, PASSWORD, BACKUP_FOLDER)
+    for job in jobs:
+        backup_database(job["server"], job["database"], job["username"], job["password"], job["backup_dir"],
+                        options=job["options"])
@@ -0,0 +1,66 @@
+import os
+import re
+import datetime
+
+# A backup set is either a single file or the stripe files of one striped backup:
+#   MWFichaClinica_17-10-2026_22-00.bak
+#   MWFichaClinica_17-10-2026_22-00_1of4.bak ... _4of4.bak
+# Compressed/encrypted artifacts keep the same stem (e.g. "..._1of4.bak.zst").
+STRIPE_PATTERN = re.compile(r"_(\d+)of(\d+)(?=\.bak)")
+# Every file this program writes: <database>_<dd-mm-YYYY_HH-MM>[_diff|_log][_NofM].bak[.zst|.xz][.enc]
+BACKUP_NAME_PATTERN = re.compile(
+    r"^(?P<database>.+)_(?P<stamp>\d{2}-\d{2}-\d{4}_\d{2}-\d{2})(?:_diff|_log)?(?:_\d+of\d+)?"
+    r"\.bak(?:\.zst|\.xz)?(?:\.enc)?$"
+)
+ARTIFACT_SUFFIX = re.compile(r"(?<=\.bak)\..*$")
+
+
+def as_list(files) -> list:
+    """Accept a single path or a list of paths and always return a list."""
+    if isinstance(files, str):
+        return [files]
+    return list(files)
+
+
+def stripe_suffix(index: int, count: int) -> str:
+    return f"_{index}of{count}" if count > 1 else ""
+
+
+def set_key(path: str) -> str:
+    """Name shared by every file of the same backup set."""
+    return STRIPE_PATTERN.sub("", os.path.basename(path))
+
+
+def is_backup_name(name: str) -> bool:
+    return BACKUP_NAME_PATTERN.match(os.path.basename(name)) is not None
+
+
+def database_name(name: str) -> str | None:
+    match = BACKUP_NAME_PATTERN.match(os.path.basename(name))
+    return match.group("database") if match else None
+
+
+def backup_key(path: str) -> str:
+    """Set key without the artifact suffixes, shared by the raw .bak files and their artifacts."""
+    return ARTIFACT_SUFFIX.sub("", set_key(path))
+
+
+def backup_time(name: str) -> datetime.datetime | None:
+    """Time the backup was taken, from the timestamp in its name."""
+    match = BACKUP_NAME_PATTERN.match(os.path.basename(name))
+    if not match:
+        return None
+    return datetime.datetime.strptime(match.group("stamp"), "%d-%m-%Y_%H-%M")
+
+
+def group_sets(items: list, key=lambda item: item, by=set_key) -> dict:
+    """
+    Group files (paths, names or dicts via 'key') by backup set, preserving order.
+    'by' is set_key, or backup_key to also put artifacts in the set of their .bak files.
+    Returns {set key: [items]}.
+    """
+    sets = {}
+    for item in items:
+        sets.setdefault(by(key(item)), []).append(item)
+    return sets
+
@@ -0,0 +1,1197 @@
+import os
+import re
+import sys
+import json
+import time
+import types
+import shutil
+import socket
+import random
+import hashlib
+import argparse
+import datetime
+import platform
+import tempfile
+import threading
+import subprocess
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+# === CONFIG ===
+SCALES_GB = [1, 10, 50]
+RESULTS_DIR = "bench_results"
+DATABASE = "MWFichaClinica"
+# Fake SQL Server: write rate of the BACKUP statement in bytes/s (None = as fast as the disk allows)
+SQL_RATE = 300 * 1024 * 1024
+# Part of every backup block left as zeros, so compression has something to do
+ZERO_FRACTION = 0.5
+BLOCK_SIZE = 1024 * 1024
+# Fake Drive: latency added to every request and upload bandwidth in bytes/s (None = unlimited)
+DRIVE_LATENCY = 0.05
+DRIVE_BANDWIDTH = 100 * 1024 * 1024
+DRIVE_FOLDER_ID = "bench-folder"
+DRIVE_ROOT_URL = "https://www.googleapis.com/"
+# Old backups seeded in the local folder, on the NAS and on Drive, so the cleanups have work to do
+SEEDED_BACKUPS = 5
+# A scale or phase this much slower than in the baseline counts as a regression
+REGRESSION_TOLERANCE = 0.25
+# Phases shorter than this in the baseline are too noisy to compare
+MIN_COMPARED_SECONDS = 2.0
+RESULT_MARKER = "BENCH_RESULT "
+# Legs that must be streamed while the backup is written when running with --stream
+STREAMED_LEGS = ["backup server", "google drive"]
+
+# End-to-end benchmark of main.main() with local stand-ins for every external system:
+# - pyodbc is replaced by a fake SQL Server whose BACKUP writes synthetic .bak files at SQL_RATE
+#   and sends "N percent processed" messages, like WITH STATS does
+# - the NAS share is a temporary folder and its SMB port a local TCP listener
+# - Drive is a local HTTP server with the resumable upload, list, delete and batch endpoints
+# Each scale runs main.main() in a fresh interpreter, so its peak RSS is measured on its own.
+# With --checks, focused checks of single components run against the same fakes instead.
+
+
+# ===== FAKE SQL SERVER =====
+DISK_PATTERN = re.compile(r"DISK = N'([^']*)'")
+Header = namedtuple("Header", "BackupType FirstLSN LastLSN CheckpointLSN DatabaseBackupLSN")
+
+
+class FakeODBCError(Exception):
+    pass
+
+
+class FakeBackup:
+    """A running BACKUP statement: writes the stripes in the background and queues its STATS messages."""
+
+    def __init__(self, files: list, size: int, rate: float | None, zero_fraction: float):
+        self.files = files
+        self.size = size
+        self.rate = rate
+        self.zero_fraction = zero_fraction
+        self.messages = []
+        self.done = False
+        self.error = None
+        self.cond = threading.Condition()
+        threading.Thread(target=self.run, name="fake-sql-backup", daemon=True).start()
+
+    def emit(self, text: str):
+        with self.cond:
+            self.messages.append(("[01000] (3211)", f"[Microsoft][ODBC Driver 17 for SQL Server][SQL Server]{text}"))
+            self.cond.notify_all()
+
+    def run(self):
+        pool = os.urandom(4 * BLOCK_SIZE)
+        random_part = int(BLOCK_SIZE * (1 - self.zero_fraction))
+        zeros = bytes(BLOCK_SIZE - random_part)
+        handles = [open(f, "wb") for f in self.files]
+        written = 0
+        reported = 0
+        start = time.monotonic()
+        try:
+            block = 0
+            while written < self.size:
+                length = min(BLOCK_SIZE, self.size - written)
+                # Every block differs (index stamp and pool offset), so nothing deduplicates by accident
+                offset = (block * 7919 * 4096) % (len(pool) - random_part)
+                data = (block.to_bytes(8, "little") + pool[offset:offset + random_part] + zeros)[:length]
+                handles[block % len(handles)].write(data)
+                written += length
+                block += 1
+                if self.rate:
+                    ahead = written / self.rate - (time.monotonic() - start)
+                    if ahead > 0:
+                        time.sleep(ahead)
+                percent = written * 100 // self.size // 10 * 10
+                if percent > reported:
+                    reported = percent
+                    self.emit(f"{percent} percent processed.")
+            self.emit(f"BACKUP DATABASE successfully processed {self.size // 8192} pages "
+                      f"in {time.monotonic() - start:.3f} seconds.")
+        except Exception as e:
+            self.error = e
+        finally:
+            for handle in handles:
+                handle.close()
+            with self.cond:
+                self.done = True
+                self.cond.notify_all()
+
+    def message(self, index: int):
+        """The index-th message, waiting for it; None once the backup ended without it."""
+        with self.cond:
+            while index >= len(self.messages) and not self.done:
+                self.cond.wait()
+            if index < len(self.messages):
+                return self.messages[index]
+            if self.error is not None:
+                raise FakeODBCError(f"BACKUP DATABASE is terminating abnormally: {self.error}")
+            return None
+
+
+class FakeSQLServer:
+    """The state one fake instance keeps between statements: backup size and the LSN chain."""
+
+    def __init__(self, size: int, rate: float | None = SQL_RATE, zero_fraction: float = ZERO_FRACTION):
+        self.size = size
+        self.rate = rate
+        self.zero_fraction = zero_fraction
+        self.lsn = 1000
+        self.full_checkpoint = 0
+        self.lock = threading.Lock()
+        # Every statement executed, in order, for the focused checks
+        self.statements = []
+
+    def header(self, differential: bool) -> Header:
+        with self.lock:
+            first, self.lsn = self.lsn, self.lsn + 100
+            if differential:
+                return Header(5, first, self.lsn, self.lsn - 50, self.full_checkpoint)
+            base, self.full_checkpoint = self.full_checkpoint, self.lsn - 50
+            return Header(1, first, self.lsn, self.full_checkpoint, base)
+
+
+class FakeCursor:
+    def __init__(self, server: FakeSQLServer):
+        self.server = server
+        self.messages = []
+        self.row = None
+        self.backup = None
+        self.index = 0
+        self.differential = False
+
+    def execute(self, sql: str):
+        self.server.statements.append(sql)
+        self.messages = []
+        self.row = None
+        self.backup = None
+        if sql.startswith("SELECT 1"):
+            self.row = (1,)
+        elif sql.startswith("BACKUP"):
+            self.differential = "DIFFERENTIAL" in sql
+            self.backup = FakeBackup(DISK_PATTERN.findall(sql), self.server.size,
+                                     self.server.rate, self.server.zero_fraction)
+            self.index = 0
+            # The statement returns with its first message, the rest come through nextset()
+            self.nextset()
+        elif sql.startswith("RESTORE HEADERONLY"):
+            self.row = self.server.header(self.differential)
+        elif sql.startswith("RESTORE VERIFYONLY"):
+            for path in DISK_PATTERN.findall(sql):
+                with open(path, "rb") as f:
+                    while f.read(BLOCK_SIZE):
+                        pass
+        else:
+            raise FakeODBCError(f"Statement not supported by the fake SQL Server: {sql[:60]}")
+        return self
+
+    def nextset(self) -> bool:
+        if self.backup is None:
+            return False
+        message = self.backup.message(self.index)
+        if message is None:
+            self.backup = None
+            self.messages = []
+            return False
+        self.index += 1
+        self.messages = [message]
+        return True
+
+    def fetchone(self):
+        return self.row
+
+
+class FakeConnection:
+    def __init__(self, server: FakeSQLServer):
+        self.server = server
+
+    def cursor(self) -> FakeCursor:
+        return FakeCursor(self.server)
+
+    def close(self):
+        pass
+
+
+def fake_pyodbc(server: FakeSQLServer) -> types.ModuleType:
+    """Module to install as sys.modules["pyodbc"] before backup.py is imported."""
+    module = types.ModuleType("pyodbc")
+    module.Error = FakeODBCError
+    module.connect = lambda connection_string, autocommit=False: FakeConnection(server)
+    return module
+
+
+# ===== FAKE DRIVE =====
+class FakeDrive:
+    """
+    Files and upload sessions of the fake Drive. The content is only kept (in 'content_dir') when
+    downloads are benchmarked too; otherwise just the metadata and digests, so the largest scales
+    do not need the disk space once more.
+    """
+
+    def __init__(self, latency: float = DRIVE_LATENCY, bandwidth: float | None = DRIVE_BANDWIDTH,
+                 content_dir: str = None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.content_dir = content_dir
+        self.files = {}
+        self.sessions = {}
+        self.stats = {"requests": 0, "uploaded_bytes": 0, "downloaded_bytes": 0, "deleted": 0}
+        self.lock = threading.Lock()
+        self.next_id = 0
+        # Answer every upload chunk with 308 without keeping it, like a session that stopped advancing
+        self.stall = False
+
+    def new_id(self) -> str:
+        with self.lock:
+            self.next_id += 1
+            return f"fake{self.next_id:06d}"
+
+    def add_file(self, name: str, parents: list, size: int, created: datetime.datetime = None,
+                 md5: str = None, sha256: str = None) -> dict:
+        created = created or datetime.datetime.now(datetime.timezone.utc)
+        resource = {"id": self.new_id(), "name": name, "parents": parents, "size": str(size),
+                    "createdTime": created.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                    "md5Checksum": md5, "sha256Checksum": sha256}
+        with self.lock:
+            self.files[resource["id"]] = resource
+        return resource
+
+    def content_path(self, file_id: str) -> str | None:
+        return os.path.join(self.content_dir, file_id) if self.content_dir else None
+
+    def delete_file(self, file_id: str) -> bool:
+        with self.lock:
+            if self.files.pop(file_id, None) is None:
+                return False
+            self.stats["deleted"] += 1
+        path = self.content_path(file_id)
+        if path and os.path.exists(path):
+            os.remove(path)
+        return True
+
+    def list_files(self, query: str) -> list:
+        folder = re.search(r"'([^']*)' in parents", query)
+        contains = re.search(r"name contains '([^']*)'", query)
+        equals = re.search(r"name = '([^']*)'", query)
+        with self.lock:
+            files = list(self.files.values())
+        return [f for f in files
+                if (folder is None or folder.group(1) in f["parents"])
+                and (contains is None or contains.group(1) in f["name"])
+                and (equals is None or equals.group(1) == f["name"])]
+
+    def throttle(self, nbytes: int, start: float):
+        """Sleep so a transfer of 'nbytes' that began at 'start' does not beat the bandwidth."""
+        if self.bandwidth:
+            remaining = nbytes / self.bandwidth - (time.monotonic() - start)
+            if remaining > 0:
+                time.sleep(remaining)
+
+
+class DriveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def drive(self) -> FakeDrive:
+        return self.server.drive
+
+    def send_json(self, status: int, body, headers: dict = None):
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        if body is not None:
+            self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def begin(self):
+        with self.drive.lock:
+            self.drive.stats["requests"] += 1
+        if self.drive.latency:
+            time.sleep(self.drive.latency)
+        url = urlsplit(self.path)
+        return url.path, {k: v[-1] for k, v in parse_qs(url.query).items()}
+
+    def do_POST(self):
+        path, query = self.begin()
+        body = self.read_body()
+        if path == "/upload/drive/v3/files" and query.get("uploadType") == "resumable":
+            metadata = json.loads(body or b"{}")
+            session_id = self.drive.new_id()
+            self.drive.sessions[session_id] = {
+                "metadata": metadata, "received": 0, "md5": hashlib.md5(), "sha256": hashlib.sha256(),
+                "path": self.drive.content_path(f"upload-{session_id}"),
+            }
+            host = self.headers.get("Host")
+            self.send_json(200, None, {"Location": f"http://{host}/upload/drive/v3/files"
+                                                   f"?uploadType=resumable&upload_id={session_id}"})
+        elif path == "/batch/drive/v3":
+            self.batch(body)
+        else:
+            self.send_json(404, {"error": {"code": 404, "message": f"Unknown endpoint {path}"}})
+
+    def do_PUT(self):
+        path, query = self.begin()
+        start = time.monotonic()
+        body = self.read_body()
+        session = self.drive.sessions.get(query.get("upload_id"))
+        if path != "/upload/drive/v3/files" or session is None:
+            self.send_json(404, {"error": {"code": 404, "message": "Upload session not found"}})
+            return
+
+        match = re.match(r"bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)", self.headers.get("Content-Range", ""))
+        total = match.group(3) if match else "*"
+        if body and match and match.group(1) is not None and int(match.group(1)) == session["received"] \
+                and not self.drive.stall:
+            session["md5"].update(body)
+            session["sha256"].update(body)
+            session["received"] += len(body)
+            if session["path"]:
+                with open(session["path"], "ab") as f:
+                    f.write(body)
+            with self.drive.lock:
+                self.drive.stats["uploaded_bytes"] += len(body)
+            self.drive.throttle(len(body), start)
+
+        if total != "*" and session["received"] == int(total):
+            self.drive.sessions.pop(query["upload_id"], None)
+            metadata = session["metadata"]
+            resource = self.drive.add_file(
+                metadata.get("name", "untitled"), metadata.get("parents", []), session["received"],
+                md5=session["md5"].hexdigest(), sha256=session["sha256"].hexdigest(),
+            )
+            if session["path"]:
+                os.replace(session["path"], self.drive.content_path(resource["id"]))
+            fields = ("id", "name", "size", "md5Checksum", "sha256Checksum")
+            self.send_json(200, {k: resource[k] for k in fields})
+            return
+        headers = {"Range": f"bytes=0-{session['received'] - 1}"} if session["received"] else {}
+        self.send_json(308, None, headers)
+
+    def do_GET(self):
+        path, query = self.begin()
+        if path.startswith("/drive/v3/files/"):
+            self.get_file(path.rsplit("/", 1)[-1], query)
+            return
+        if path != "/drive/v3/files":
+            self.send_json(404, {"error": {"code": 404, "message": f"Unknown endpoint {path}"}})
+            return
+        files = self.drive.list_files(query.get("q", ""))
+        start = int(query.get("pageToken") or 0)
+        page_size = int(query.get("pageSize") or 100)
+        fields = ("id", "name", "size", "createdTime", "md5Checksum", "sha256Checksum")
+        page = [{k: f[k] for k in fields if f[k] is not None} for f in files[start:start + page_size]]
+        body = {"files": page}
+        if start + page_size < len(files):
+            body["nextPageToken"] = str(start + page_size)
+        self.send_json(200, body)
+
+    def get_file(self, file_id: str, query: dict):
+        """File metadata, or its content with alt=media (honouring a single Range, as Drive does)."""
+        resource = self.drive.files.get(file_id)
+        if resource is None:
+            self.send_json(404, {"error": {"code": 404, "message": f"File not found: {file_id}"}})
+            return
+        if query.get("alt") != "media":
+            self.send_json(200, resource)
+            return
+        content = self.drive.content_path(file_id)
+        if content is None or not os.path.exists(content):
+            self.send_json(403, {"error": {"code": 403, "message": "Content not kept by this fake Drive"}})
+            return
+
+        size = int(resource["size"])
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        first = int(match.group(1)) if match else 0
+        last = min(int(match.group(2)), size - 1) if match and match.group(2) else size - 1
+        self.send_response(206 if match else 200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(last - first + 1))
+        if match:
+            self.send_header("Content-Range", f"bytes {first}-{last}/{size}")
+        self.end_headers()
+
+        start = time.monotonic()
+        sent = 0
+        with open(content, "rb") as f:
+            f.seek(first)
+            while sent < last - first + 1:
+                data = f.read(min(BLOCK_SIZE, last - first + 1 - sent))
+                self.wfile.write(data)
+                sent += len(data)
+                self.drive.throttle(sent, start)
+        with self.drive.lock:
+            self.drive.stats["downloaded_bytes"] += sent
+
+    def do_DELETE(self):
+        path, _ = self.begin()
+        file_id = path.rsplit("/", 1)[-1]
+        if path.startswith("/drive/v3/files/") and self.drive.delete_file(file_id):
+            self.send_json(204, None)
+        else:
+            self.send_json(404, {"error": {"code": 404, "message": f"File not found: {file_id}"}})
+
+    def batch(self, body: bytes):
+        """multipart/mixed batch of DELETE requests, as sent by retention.delete_drive_files."""
+        boundary = re.search(r'boundary="?([^";]+)"?', self.headers.get("Content-Type", "")).group(1)
+        parts = []
+        for part in body.decode().split(f"--{boundary}")[1:]:
+            if part.startswith("--"):
+                break
+            headers, _, request = part.replace("\r\n", "\n").strip("\n").partition("\n\n")
+            content_id = re.search(r"Content-ID: <([^>]*)>", headers, re.IGNORECASE).group(1)
+            method, target = request.split(" ", 2)[:2]
+            file_id = urlsplit(target).path.rsplit("/", 1)[-1]
+            if method == "DELETE" and self.drive.delete_file(file_id):
+                status = "204 No Content"
+            else:
+                status = "404 Not Found"
+            parts.append(f"--{boundary}\r\nContent-Type: application/http\r\n"
+                         f"Content-ID: <response-{content_id}>\r\n\r\nHTTP/1.1 {status}\r\n"
+                         f"Content-Length: 0\r\n\r\n\r\n")
+        data = ("".join(parts) + f"--{boundary}--\r\n").encode()
+        self.send_response(200)
+        self.send_header("Content-Type", f"multipart/mixed; boundary={boundary}")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_drive_server(drive: FakeDrive) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), DriveHandler)
+    server.daemon_threads = True
+    server.drive = drive
+    threading.Thread(target=server.serve_forever, name="fake-drive", daemon=True).start()
+    return server
+
+
+# ===== SEEDED HISTORY =====
+def seed_names(count: int, now: datetime.datetime = None) -> list:
+    """(name, time) of 'count' old daily full backups, newest first, following the backup naming pattern."""
+    now = now or datetime.datetime.now()
+    return [(f"{DATABASE}_{now - datetime.timedelta(days=d):%d-%m-%Y}_01-00.bak",
+             (now - datetime.timedelta(days=d)).replace(hour=1, minute=0, second=0, microsecond=0))
+            for d in range(1, count + 1)]
+
+
+def seed_folder(folder: str, count: int):
+    for name, when in seed_names(count):
+        path = os.path.join(folder, name)
+        with open(path, "wb") as f:
+            f.write(os.urandom(1024))
+        os.utime(path, (when.timestamp(), when.timestamp()))
+
+
+def seed_drive(drive: FakeDrive, count: int):
+    for name, when in seed_names(count):
+        drive.add_file(name, [DRIVE_FOLDER_ID], 1024, created=when.astimezone(datetime.timezone.utc))
+
+
+# ===== ONE SCALE (child process) =====
+def peak_rss_mb() -> float | None:
+    """Peak resident set size of this process, where the platform reports it."""
+    try:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # KiB on Linux, bytes on macOS
+        return rss / 1048576 if sys.platform == "darwin" else rss / 1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 1048576
+    except (ImportError, AttributeError):
+        return None
+
+
+def drive_discovery_document(root_url: str) -> str:
+    """Drive v3 discovery document pointing every endpoint (uploads and batches too) at the fake server."""
+    from googleapiclient.discovery_cache import get_static_doc
+    return get_static_doc("drive", "v3").replace(DRIVE_ROOT_URL, root_url)
+
+
+def run_child(args) -> dict:
+    """Run main.main() once against the fakes, from inside the scale's work directory."""
+    os.chdir(args.workdir)
+    local_dir = os.path.join(args.workdir, "local")
+    nas_dir = os.path.join(args.workdir, "nas")
+    os.makedirs(local_dir, exist_ok=True)
+    os.makedirs(nas_dir, exist_ok=True)
+    seed_folder(local_dir, args.seeded)
+    seed_folder(nas_dir, args.seeded)
+    # No NAS password: the NAS backend skips "net use" and copies straight into the folder
+    open("account_password.txt", "w").close()
+    with open("database_password.txt", "w", encoding="utf-8") as f:
+        f.write("bench\n")
+    with open("drive_v3_discovery.json", "w", encoding="utf-8") as f:
+        f.write(drive_discovery_document(args.drive_url))
+
+    import loggingUtils
+    loggingUtils.LOGFILE = os.path.join(args.workdir, "bench.log")
+    sys.modules["pyodbc"] = fake_pyodbc(FakeSQLServer(int(args.size_gb * 1024 ** 3), args.sql_rate or None,
+                                                      args.zero_fraction))
+    # Stands in for the SMB port of the backup server, so the readiness probe succeeds at once
+    smb = socket.create_server(("127.0.0.1", 0))
+
+    from google.auth.credentials import AnonymousCredentials
+    import main
+    import send_backup
+    import upload
+    import resumable
+    import throttle
+    import pipeline
+    import streaming
+
+    # Record which legs were streamed, so a stream that fell back to the finished file is caught
+    streamed = []
+    backup_while_streaming = streaming.backup_while_streaming
+
+    def recording_streams(*args, **kwargs):
+        backup_files, results = backup_while_streaming(*args, **kwargs)
+        streamed.extend(r["name"] for r in results)
+        return backup_files, results
+
+    streaming.backup_while_streaming = recording_streams
+    main.DIRECTORY = local_dir
+    main.TARGET_FOLDER = nas_dir
+    main.TARGET_NAME = "127.0.0.1"
+    main.MAC_ADDRESS = None
+    main.STREAM_WHILE_BACKING_UP = args.stream
+    send_backup.SMB_PORT = smb.getsockname()[1]
+    throttle.WINDOWS = {}
+    pipeline.COMPRESSION = args.compression
+    upload.FOLDER_ID = DRIVE_FOLDER_ID
+    upload.DISCOVERY_CACHE = "drive_v3_discovery.json"
+    upload.get_credentials = AnonymousCredentials
+    resumable.UPLOAD_URL = f"{args.drive_url}upload/drive/v3/files"
+
+    start = time.perf_counter()
+    try:
+        main.main()
+        exit_code = 0
+    except SystemExit as e:
+        exit_code = e.code or 0
+    seconds = time.perf_counter() - start
+    smb.close()
+
+    reports = sorted(os.listdir(main.metrics.METRICS_DIR))
+    with open(os.path.join(main.metrics.METRICS_DIR, reports[-1]), "r", encoding="utf-8") as f:
+        report = json.load(f)
+    size = int(args.size_gb * 1024 ** 3)
+    restores = restore_times(args.workdir, nas_dir, args.drive_url) if args.restore else None
+    return {
+        "size_gb": args.size_gb,
+        "exit_code": exit_code,
+        "seconds": seconds,
+        "mb_s": size / 1048576 / seconds if seconds > 0 else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+        "phases": {name: {k: entry[k] for k in ("seconds", "bytes", "mb_s", "retries", "ok")}
+                   for name, entry in report["phases"].items()},
+        "local_files": sorted(os.listdir(local_dir)),
+        "nas_files": sorted(os.listdir(nas_dir)),
+        "streamed": streamed,
+        "restore": restores,
+    }
+
+
+def restore_times(workdir: str, nas_dir: str, drive_url: str) -> dict:
+    """Time restore.fetch_backup of the new backup from the NAS and from Drive, one at a time."""
+    import restore
+    import storage
+
+    restore.DOWNLOAD_URL = f"{drive_url}drive/v3/files/{{file_id}}?alt=media&supportsAllDrives=true"
+    sources = {"backup server": lambda: storage.NASBackend(nas_dir), "google drive": storage.DriveBackend}
+    results = {}
+    for name, open_backend in sources.items():
+        dest = os.path.join(workdir, "restore")
+        start = time.perf_counter()
+        try:
+            fetched = restore.fetch_backup({name: open_backend}, dest_dir=dest)
+        except Exception as e:
+            results[name] = {"error": str(e)}
+            continue
+        finally:
+            seconds = time.perf_counter() - start
+        size = sum(os.path.getsize(path) for paths in fetched["sets"] for path in paths)
+        results[name] = {"seconds": seconds, "mb_s": size / 1048576 / seconds if seconds > 0 else 0.0}
+        shutil.rmtree(dest, ignore_errors=True)
+    return results
+
+
+# ===== ALL SCALES =====
+def run_scale(size_gb: float, args) -> dict:
+    """Start a fake Drive, run one scale in a child interpreter and collect its result."""
+    work_root = args.work_root or tempfile.gettempdir()
+    # The backup exists twice on disk (local folder and fake NAS), four times when restores are timed
+    # (plus the fake Drive's copy and the restored file)
+    free = shutil.disk_usage(work_root).free
+    if free < (4.1 if args.restore else 2.1) * size_gb * 1024 ** 3:
+        return {"size_gb": size_gb, "skipped": f"only {free / 1024 ** 3:.1f} GB free in {work_root}"}
+
+    workdir = tempfile.mkdtemp(prefix="bench_e2e_", dir=work_root)
+    drive = FakeDrive(args.drive_latency, args.drive_bandwidth or None,
+                      os.path.join(workdir, "drive") if args.restore else None)
+    if drive.content_dir:
+        os.makedirs(drive.content_dir)
+    seed_drive(drive, args.seeded)
+    server = start_drive_server(drive)
+    command = [
+        sys.executable, os.path.abspath(__file__), "--child", "--workdir", workdir, "--scales", str(size_gb),
+        "--drive-url", f"http://127.0.0.1:{server.server_address[1]}/", "--sql-rate", str(args.sql_rate),
+        "--zero-fraction", str(args.zero_fraction), "--seeded", str(args.seeded),
+    ]
+    if args.stream:
+        command.append("--stream")
+    if args.restore:
+        command.append("--restore")
+    if args.compression:
+        command += ["--compression", args.compression]
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)),
+                                                                      os.environ.get("PYTHONPATH")]))}
+    try:
+        out = subprocess.run(command, capture_output=True, text=True, env=env)
+        lines = [line for line in out.stdout.splitlines() if line.startswith(RESULT_MARKER)]
+        if not lines:
+            tail = "\n".join((out.stdout + out.stderr).splitlines()[-20:])
+            return {"size_gb": size_gb, "failed": f"no result (exit status {out.returncode}):\n{tail}"}
+        result = json.loads(lines[-1][len(RESULT_MARKER):])
+        result["drive"] = {**drive.stats, "files": sorted(f["name"] for f in drive.files.values())}
+        return result
+    finally:
+        server.shutdown()
+        server.server_close()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def check_scale(scale: dict, args) -> list:
+    """What went wrong in a scale's run besides its exit code."""
+    problems = []
+    if args.stream:
+        missing = [leg for leg in STREAMED_LEGS if leg not in scale.get("streamed", [])]
+        if missing:
+            problems.append(f"{scale['size_gb']} GB: not streamed to {', '.join(missing)}")
+    return problems
+
+
+# ===== FOCUSED CHECKS =====
+def drive_service(drive_url: str):
+    """Drive v3 service object talking to the fake Drive."""
+    from google.auth.credentials import AnonymousCredentials
+    from googleapiclient.discovery import build_from_document
+    return build_from_document(drive_discovery_document(drive_url), credentials=AnonymousCredentials())
+
+
+def check_chunk_store(drive: FakeDrive, drive_url: str) -> list:
+    """A backup with one changed page only sends the chunk holding it, and restores byte for byte."""
+    import chunk_store
+
+    chunk_store.CHUNK_FOLDER_ID = DRIVE_FOLDER_ID
+    service = drive_service(drive_url)
+    data = bytearray(random.Random(2).randbytes(24 * 1024 * 1024))
+    with open("first.bak", "wb") as f:
+        f.write(data)
+    chunk_store.upload_backup(service, "first.bak", f"{DATABASE}_01-01-2026_01-00.bak")
+    data[len(data) // 2] ^= 0xFF
+    with open("second.bak", "wb") as f:
+        f.write(data)
+    sent = drive.stats["uploaded_bytes"]
+    chunk_store.upload_backup(service, "second.bak", f"{DATABASE}_02-01-2026_01-00.bak")
+    sent = drive.stats["uploaded_bytes"] - sent
+
+    problems = []
+    if sent > len(data) // 2:
+        problems.append(f"sent {sent} bytes for a one-page change in a {len(data)} byte backup")
+    # Without the local index, the restore has to find the chunks by listing the folder
+    os.remove(chunk_store.INDEX_FILE)
+    chunk_store.restore_backup(service, f"{DATABASE}_02-01-2026_01-00.bak", "restored.bak")
+    with open("restored.bak", "rb") as f:
+        if f.read() != data:
+            problems.append("restored backup differs from the uploaded one")
+    return problems
+
+
+def check_backup_sql(drive: FakeDrive, drive_url: str) -> list:
+    """The backup options end up in the BACKUP statement, and every stripe belongs to one backup set."""
+    server = FakeSQLServer(3 * BLOCK_SIZE, rate=None)
+    sys.modules["pyodbc"] = fake_pyodbc(server)
+    import backup
+    import backup_sets
+    import chain
+
+    backup.pyodbc = sys.modules["pyodbc"]
+    runs = [
+        (chain.FULL, {"stripes": 3, "compression": True, "buffer_count": 64, "max_transfer_size": 4194304},
+         ["BACKUP DATABASE [", "COMPRESSION", "BUFFERCOUNT = 64", "MAXTRANSFERSIZE = 4194304", "CHECKSUM"]),
+        (chain.DIFFERENTIAL, {"compression": False}, ["BACKUP DATABASE [", "DIFFERENTIAL", "NO_COMPRESSION"]),
+        (chain.LOG, {}, ["BACKUP LOG ["]),
+    ]
+    problems = []
+    for backup_type, options, expected in runs:
+        server.statements.clear()
+        files = backup.backup_database("fake", DATABASE, "sa", "bench", "backups", options=options,
+                                       backup_type=backup_type, cleanup=False)
+        if not files:
+            problems.append(f"{backup_type} backup failed")
+            continue
+        sql = next((s for s in server.statements if s.startswith("BACKUP")), "")
+        problems += [f"{backup_type} backup: {part!r} missing from {sql}" for part in expected if part not in sql]
+        if DISK_PATTERN.findall(sql) != files or len(files) != options.get("stripes", 1):
+            problems.append(f"{backup_type} backup: written to {DISK_PATTERN.findall(sql)}, returned {files}")
+        if len({backup_sets.set_key(f) for f in files}) != 1:
+            problems.append(f"{backup_type} backup: stripes {files} are not one backup set")
+        if sum(os.path.getsize(f) for f in files) != server.size:
+            problems.append(f"{backup_type} backup: stripes do not add up to the backup size")
+    return problems
+
+
+class FailingHttp:
+    """http object that fails like a dropped connection once 'chunks' upload chunks went through."""
+
+    def __init__(self, http, chunks: int):
+        self.http = http
+        self.chunks = chunks
+
+    def request(self, uri, method="GET", body=None, headers=None):
+        if method == "PUT" and body:
+            if self.chunks == 0:
+                raise ConnectionError("Connection reset by the check")
+            self.chunks -= 1
+        return self.http.request(uri, method, body=body, headers=headers)
+
+
+def check_resumable_upload(drive: FakeDrive, drive_url: str) -> list:
+    """
+    An interrupted upload continues from the confirmed offset in a new call, parallel streams all
+    arrive, and a session that stops advancing fails instead of looping.
+    """
+    from googleapiclient.http import build_http
+    import resumable
+
+    resumable.UPLOAD_URL = f"{drive_url}upload/drive/v3/files"
+    # Fixed 256 KiB chunks, so every file takes several
+    resumable.INITIAL_CHUNK = resumable.MIN_CHUNK = resumable.MAX_CHUNK = resumable.CHUNK_ALIGN
+    paths = []
+    for i in range(3):
+        paths.append(f"upload{i}.bak")
+        with open(paths[-1], "wb") as f:
+            f.write(random.Random(i).randbytes(5 * resumable.CHUNK_ALIGN + 1000))
+    size = os.path.getsize(paths[0])
+    problems = []
+
+    sent = drive.stats["uploaded_bytes"]
+    try:
+        resumable.upload_resumable(FailingHttp(build_http(), 2), paths[0], paths[0], [DRIVE_FOLDER_ID])
+        problems.append("the interrupted upload did not fail")
+    except ConnectionError:
+        pass
+    response = resumable.upload_resumable(build_http(), paths[0], paths[0], [DRIVE_FOLDER_ID])
+    if drive.stats["uploaded_bytes"] - sent != size:
+        problems.append(f"sent {drive.stats['uploaded_bytes'] - sent} bytes to resume a {size} byte upload")
+    with open(paths[0], "rb") as f:
+        if response.get("md5Checksum") != hashlib.md5(f.read()).hexdigest():
+            problems.append("resumed upload does not match the file")
+
+    responses = resumable.upload_files(build_http, paths, [DRIVE_FOLDER_ID], max_streams=3)
+    if [r["name"] for r in responses] != paths:
+        problems.append(f"parallel upload returned {[r['name'] for r in responses]}")
+
+    drive.stall = True
+    try:
+        resumable.upload_stream(build_http(), iter([b"x" * size]), "stalled.bak", [DRIVE_FOLDER_ID])
+        problems.append("the stalled upload did not fail")
+    except ConnectionError as e:
+        if "no progress" not in str(e):
+            problems.append(f"the stalled upload failed with {e}")
+    finally:
+        drive.stall = False
+    return problems
+
+
+class FakeClock:
+    """Clock for throttle.Limiter whose sleep() only moves the time forward."""
+
+    def __init__(self, start: datetime.datetime):
+        self.start = start
+        self.elapsed = 0.0
+
+    def now(self) -> datetime.datetime:
+        return self.start + datetime.timedelta(seconds=self.elapsed)
+
+    def monotonic(self) -> float:
+        return self.elapsed
+
+    def sleep(self, seconds: float):
+        self.elapsed += seconds
+
+
+def check_throttle(drive: FakeDrive, drive_url: str) -> list:
+    """
+    A copy into a local sink keeps to the capped window's rate, a paused window holds transfers until
+    it ends, and check_window puts the finish of a transfer crossing both windows where they allow it.
+    """
+    import copy_engine
+    import throttle
+
+    mib = 1024 * 1024
+    windows = [{"start": "07:30", "end": "20:00", "rate": mib},
+               {"start": "20:00", "end": "21:00", "rate": 0}]
+    day = datetime.datetime(2026, 1, 5)  # a Monday
+    problems = []
+
+    with open("source.bak", "wb") as f:
+        f.write(random.Random(3).randbytes(4 * mib))
+    clock = FakeClock(day.replace(hour=10))
+    copy_engine.copy_file("source.bak", "sink.bak", buffer_size=mib // 4,
+                          limiter=throttle.Limiter(windows, clock))
+    # The first buffer goes out at once, the other 15 at 1 MiB/s
+    if not 3.5 <= clock.elapsed <= 4.5:
+        problems.append(f"4 MiB copied in {clock.elapsed:.1f}s at a 1 MiB/s cap")
+
+    clock = FakeClock(day.replace(hour=20, minute=10))
+    waited = throttle.Limiter(windows, clock).acquire(mib)
+    if abs(waited - 50 * 60) > 60:
+        problems.append(f"waited {waited:.0f}s in a window paused for another 3000s")
+    clock = FakeClock(day.replace(hour=23))
+    if throttle.Limiter(windows, clock).acquire(100 * mib):
+        problems.append("waited outside every window")
+
+    throttle.WINDOWS = {"upload": windows}
+    try:
+        # 600 MiB until the pause, 400 MiB at full speed after it
+        estimate = throttle.check_window("upload", 1000 * mib, 10 * mib, start=day.replace(hour=19, minute=50))
+        if estimate["finish"] != day.replace(hour=21, second=40) or not estimate["throttled"]:
+            problems.append(f"transfer across the windows estimated to finish at {estimate['finish']}")
+        estimate = throttle.check_window("upload", 1000 * mib, 10 * mib, start=day.replace(hour=22))
+        if estimate["finish"] != day.replace(hour=22, minute=1, second=40) or estimate["throttled"]:
+            problems.append(f"transfer outside the windows estimated to finish at {estimate['finish']}")
+    finally:
+        throttle.WINDOWS = {}
+    return problems
+
+
+def check_smb_probe(drive: FakeDrive, drive_url: str) -> list:
+    """
+    The readiness probe sees a local listener standing in for the SMB port shortly after it opens,
+    and resends the magic packet until it gives up on a port that stays closed.
+    """
+    import send_backup
+
+    packets = []
+    send_backup.send_magic_packet = packets.append
+    send_backup.MAGIC_PACKET_INTERVAL = 0.3
+    problems = []
+    # Bound but not listening: connections are refused until listen() is called
+    with socket.socket() as smb:
+        smb.bind(("127.0.0.1", 0))
+        send_backup.SMB_PORT = smb.getsockname()[1]
+        opened = threading.Timer(0.8, smb.listen)
+        start = time.monotonic()
+        ready = send_backup.start_wait_for_share("127.0.0.1", "00:11:22:33:44:55", timeout=10)
+        opened.start()
+        if not ready.result():
+            problems.append("the open port was not seen")
+        elif time.monotonic() - start > 0.8 + 1.5:
+            problems.append(f"the open port was seen {time.monotonic() - start - 0.8:.1f}s after it opened")
+
+    packets.clear()
+    start = time.monotonic()
+    if send_backup.wait_for_share("127.0.0.1", "00:11:22:33:44:55", timeout=2):
+        problems.append("a closed port was reported ready")
+    if time.monotonic() - start > 2 + send_backup.PROBE_TIMEOUT:
+        problems.append(f"gave up after {time.monotonic() - start:.1f}s with a 2s timeout")
+    # Probes at 0, 0.25, 0.75 and 1.75s with the backoff; the packet goes out with the probes due for it
+    if len(packets) < 3:
+        problems.append(f"{len(packets)} magic packets sent in 2s with a 0.3s interval")
+    return problems
+
+
+class FailingRanges:
+    """http object that fails like a dropped connection for every range from byte 'first' on."""
+
+    def __init__(self, http, first: int):
+        self.http = http
+        self.first = first
+
+    def request(self, uri, method="GET", body=None, headers=None):
+        if int(re.match(r"bytes=(\d+)", (headers or {}).get("Range", "bytes=0")).group(1)) >= self.first:
+            raise ConnectionError("Connection reset by the check")
+        return self.http.request(uri, method, body=body, headers=headers)
+
+
+def check_restore(drive: FakeDrive, drive_url: str) -> list:
+    """
+    An interrupted ranged download only fetches the missing ranges when run again, the backup server
+    copy is preferred, and a corrupted copy there falls back to Drive's.
+    """
+    from google.auth.credentials import AnonymousCredentials
+    from googleapiclient.http import build_http
+    import restore
+    import storage
+    import upload
+
+    with open("drive_v3_discovery.json", "w", encoding="utf-8") as f:
+        f.write(drive_discovery_document(drive_url))
+    upload.DISCOVERY_CACHE = "drive_v3_discovery.json"
+    upload.FOLDER_ID = DRIVE_FOLDER_ID
+    upload.get_credentials = AnonymousCredentials
+    restore.DOWNLOAD_URL = f"{drive_url}drive/v3/files/{{file_id}}?alt=media&supportsAllDrives=true"
+
+    name = f"{DATABASE}_03-01-2026_01-00.bak"
+    data = random.Random(4).randbytes(2 * 1024 * 1024 + 123)
+    resource = drive.add_file(name, [DRIVE_FOLDER_ID], len(data), md5=hashlib.md5(data).hexdigest(),
+                              sha256=hashlib.sha256(data).hexdigest())
+    with open(drive.content_path(resource["id"]), "wb") as f:
+        f.write(data)
+    problems = []
+
+    url = restore.DOWNLOAD_URL.format(file_id=resource["id"])
+    range_size = 256 * 1024
+    # Every range starting in the second half fails, the ones before it are kept
+    half = len(data) // 2
+    missing = len(data) - -(-half // range_size) * range_size
+    retries, restore.RANGE_RETRIES = restore.RANGE_RETRIES, 1
+    try:
+        restore.download_ranges(lambda: FailingRanges(build_http(), half), url, len(data),
+                                "ranged.bak", range_size=range_size, workers=4)
+        problems.append("the interrupted download did not fail")
+    except ConnectionError:
+        pass
+    finally:
+        restore.RANGE_RETRIES = retries
+    stats = restore.download_ranges(build_http, url, len(data), "ranged.bak", range_size=range_size, workers=4)
+    if stats["bytes"] != missing:
+        problems.append(f"resumed download fetched {stats['bytes']} of {len(data)} bytes")
+    with open("ranged.bak", "rb") as f:
+        if f.read() != data:
+            problems.append("resumed download differs from the file")
+
+    for copy, source in ((data, "backup server"), (data[:-1] + b"!", "google drive")):
+        nas = f"nas-{source.replace(' ', '-')}"
+        os.makedirs(nas)
+        with open(os.path.join(nas, name), "wb") as f:
+            f.write(copy)
+        downloaded = drive.stats["downloaded_bytes"]
+        sources = {"backup server": lambda: storage.NASBackend(nas), "google drive": storage.DriveBackend}
+        fetched = restore.fetch_backup(sources, dest_dir=f"restore-{source.replace(' ', '-')}")
+        from_drive = drive.stats["downloaded_bytes"] > downloaded
+        if from_drive != (source == "google drive"):
+            problems.append(f"fetched from {'google drive' if from_drive else 'backup server'}, expected {source}")
+        with open(fetched["sets"][0][0], "rb") as f:
+            if f.read() != data:
+                problems.append(f"backup fetched from {source} differs from the original")
+        if f"RESTORE DATABASE [{DATABASE}]" not in fetched["sql"]:
+            problems.append(f"unexpected restore statement {fetched['sql']}")
+    return problems
+
+
+def check_forecast(drive: FakeDrive, drive_url: str) -> list:
+    """
+    From a simulated history of a growing database, the planner forecasts the size on the line of
+    past fulls with the learned rates, and adapts the plan in order when a late start (a fake clock)
+    would miss the deadline.
+    """
+    import chain
+    import forecast
+    import history
+
+    database = "Simulated"
+    mib = 1024 * 1024
+    # Tomorrow, so the full backup added to the chain index below was not taken "today"
+    day = datetime.datetime.combine(datetime.date.today() + datetime.timedelta(days=1), datetime.time())
+    rates = {"backup": 100 * mib, "nas_copy": 50 * mib, "upload": 8 * mib}
+    with history.connect() as conn:
+        for days_ago in range(30, 0, -1):
+            for hour, backup_type, size in ((1, chain.FULL, 10240 * mib + (30 - days_ago) * 100 * mib),
+                                            (13, chain.DIFFERENTIAL, 1024 * mib)):
+                started = day - datetime.timedelta(days=days_ago) + datetime.timedelta(hours=hour)
+                phases = {phase: {"seconds": size / rate, "bytes": size} for phase, rate in rates.items()}
+                history.insert_run(conn, {"started": started.isoformat(sep=" ", timespec="seconds"),
+                                          "database": database, "backup_type": backup_type,
+                                          "backup_size": size, "phases": phases}, [])
+    chain.record_backup(database, chain.FULL, [f"{database}_01-01-2026_01-00.bak"], Header(1, 1, 2, 1, 0))
+    full = 10240 * mib + 30 * 100 * mib
+    problems = []
+
+    plan = forecast.plan_run([database], now=day.replace(hour=1), deadline="07:30")
+    if plan["changes"] or abs(plan["forecast"]["bytes"] - full) > mib:
+        problems.append(f"01:00 start: {plan['forecast']['bytes']} bytes forecast (expected {full}), "
+                        f"changes {plan['changes']}")
+    if abs(plan["forecast"]["seconds"]["google drive"] - full / rates["upload"]) > 1:
+        problems.append(f"upload forecast {plan['forecast']['seconds']['google drive']:.0f}s "
+                        f"instead of {full / rates['upload']:.0f}s at the learned rate")
+
+    # A full backup started at 07:10 ends at about 07:43, a differential at about 07:12
+    plan = forecast.plan_run([database], now=day.replace(hour=7, minute=10), deadline="07:30")
+    if plan["types"][database] != chain.DIFFERENTIAL or len(plan["changes"]) != 1 or not plan["meets_deadline"]:
+        problems.append(f"07:10 start: {plan['types']}, changes {plan['changes']}")
+    adaptive = forecast.ADAPTIVE
+    forecast.ADAPTIVE = {**adaptive, "differential": False}
+    try:
+        plan = forecast.plan_run([database], now=day.replace(hour=7, minute=10), deadline="07:30",
+                                 allow_compression=False)
+    finally:
+        forecast.ADAPTIVE = adaptive
+    if plan["changes"] != ["defer google drive"] or plan["defer"] != ["google drive"] or not plan["meets_deadline"]:
+        problems.append(f"07:10 start without differentials: defer {plan['defer']}, changes {plan['changes']}")
+
+    report = {"phases": {"backup": {"seconds": 150.0}}, "finished": day.replace(hour=7, minute=20).timestamp()}
+    forecast.compare(plan, report)
+    with open(forecast.FORECAST_LOG, "r", encoding="utf-8") as f:
+        record = json.loads(f.readlines()[-1])
+    if record["actual"]["seconds"]["backup"] != 150.0 or record["changes"] != plan["changes"]:
+        problems.append(f"forecast log record {record}")
+    return problems
+
+
+# Run in this order by --checks, each in the same work directory
+CHECKS = [check_chunk_store, check_backup_sql, check_resumable_upload, check_throttle,
+          check_smb_probe, check_restore, check_forecast]
+
+
+def run_checks(args) -> list:
+    """Run every focused check against a fresh fake Drive, from inside a temporary work directory."""
+    workdir = tempfile.mkdtemp(prefix="bench_checks_", dir=args.work_root)
+    drive = FakeDrive(latency=0, bandwidth=None, content_dir=os.path.join(workdir, "drive"))
+    os.makedirs(drive.content_dir)
+    server = start_drive_server(drive)
+    drive_url = f"http://127.0.0.1:{server.server_address[1]}/"
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    problems = []
+    try:
+        import loggingUtils
+        loggingUtils.LOGFILE = os.path.join(workdir, "checks.log")
+        import throttle
+        throttle.WINDOWS = {}
+        for check in CHECKS:
+            print(f"Checking {check.__name__[len('check_'):]}...", flush=True)
+            try:
+                problems += [f"{check.__name__}: {p}" for p in check(drive, drive_url)]
+            except Exception as e:
+                problems.append(f"{check.__name__}: {type(e).__name__}: {e}")
+    finally:
+        os.chdir(cwd)
+        server.shutdown()
+        server.server_close()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return problems
+
+
+def compare(results: dict, baseline: dict, tolerance: float = REGRESSION_TOLERANCE) -> list:
+    """Regressions of 'results' against a previous results file, matched by scale."""
+    previous = {s["size_gb"]: s for s in baseline.get("scales", []) if "seconds" in s}
+    problems = []
+    for scale in results["scales"]:
+        base = previous.get(scale["size_gb"])
+        if base is None or "seconds" not in scale:
+            continue
+        pairs = [("total", scale["seconds"], base["seconds"])]
+        pairs += [(name, entry["seconds"], base["phases"][name]["seconds"])
+                  for name, entry in scale["phases"].items() if name in base["phases"]]
+        base_restores = base.get("restore") or {}
+        pairs += [(f"restore from {name}", entry["seconds"], base_restores[name]["seconds"])
+                  for name, entry in (scale.get("restore") or {}).items()
+                  if "seconds" in entry and "seconds" in base_restores.get(name, {})]
+        for name, now, before in pairs:
+            if before >= MIN_COMPARED_SECONDS and now > before * (1 + tolerance):
+                problems.append(f"{scale['size_gb']} GB {name}: {now:.1f}s vs {before:.1f}s")
+        if scale.get("peak_rss_mb") and base.get("peak_rss_mb") and \
+                scale["peak_rss_mb"] > base["peak_rss_mb"] * (1 + tolerance):
+            problems.append(f"{scale['size_gb']} GB peak RSS: {scale['peak_rss_mb']:.0f} MiB "
+                            f"vs {base['peak_rss_mb']:.0f} MiB")
+    return problems
+
+
+def print_summary(results: dict):
+    for scale in results["scales"]:
+        if "seconds" not in scale:
+            print(f"{scale['size_gb']:>6} GB  {scale.get('skipped') or scale.get('failed')}")
+            continue
+        rss = f"{scale['peak_rss_mb']:.0f} MiB" if scale["peak_rss_mb"] else "n/a"
+        print(f"{scale['size_gb']:>6} GB  exit {scale['exit_code']}  {scale['seconds']:8.1f}s  "
+              f"{scale['mb_s']:7.1f} MB/s  peak RSS {rss}")
+        for name, entry in scale["phases"].items():
+            print(f"{'':>12}{name:<28}{entry['seconds']:8.1f}s  {entry['mb_s']:7.1f} MB/s")
+        for name, entry in (scale.get("restore") or {}).items():
+            timing = entry.get("error") or f"{entry['seconds']:8.1f}s  {entry['mb_s']:7.1f} MB/s"
+            print(f"{'':>12}{'restore from ' + name:<28}{timing}")
+
+
+if __name__ == "__main__":
+    # End-to-end benchmark: python bench_e2e.py [--scales 1 10 50] [--baseline bench_results/e2e_....json]
+    # Results are written as JSON to RESULTS_DIR. Exits with 1 when a run fails or regresses against the baseline.
+    parser = argparse.ArgumentParser(description="Benchmark the whole backup run against local fakes.")
+    parser.add_argument("--scales", type=float, nargs="+", default=SCALES_GB, help="backup sizes in GB")
+    parser.add_argument("--sql-rate", type=float, default=SQL_RATE, help="fake BACKUP write rate in bytes/s, 0 = unlimited")
+    parser.add_argument("--zero-fraction", type=float, default=ZERO_FRACTION)
+    parser.add_argument("--drive-latency", type=float, default=DRIVE_LATENCY, help="seconds per Drive request")
+    parser.add_argument("--drive-bandwidth", type=float, default=DRIVE_BANDWIDTH, help="bytes/s, 0 = unlimited")
+    parser.add_argument("--seeded", type=int, default=SEEDED_BACKUPS, help="old backups to seed per destination")
+    parser.add_argument("--stream", action="store_true", help="run with STREAM_WHILE_BACKING_UP")
+    parser.add_argument("--compression", choices=["zstd", "lzma"])
+    parser.add_argument("--restore", action="store_true", help="also time restore.py fetching the backup back")
+    parser.add_argument("--work-root", help="folder for the temporary backup files (default: system temp)")
+    parser.add_argument("--keep", action="store_true", help="keep the work directories")
+    parser.add_argument("--baseline", help="previous results file to compare with")
+    parser.add_argument("--output", help="results file (default: RESULTS_DIR/e2e_<timestamp>.json)")
+    parser.add_argument("--checks", action="store_true", help="run the focused checks instead of the benchmark")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    parser.add_argument("--drive-url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        args.size_gb = args.scales[0]
+        print(RESULT_MARKER + json.dumps(run_child(args)), flush=True)
+        sys.exit(0)
+
+    if args.checks:
+        problems = run_checks(args)
+        for problem in problems:
+            print(f"CHECK FAILED: {problem}")
+        print(f"{len(CHECKS) - len({p.split(':')[0] for p in problems})} of {len(CHECKS)} checks passed")
+        sys.exit(1 if problems else 0)
+
+    started = datetime.datetime.now()
+    results = {
+        "started": started.isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {"sql_rate": args.sql_rate, "zero_fraction": args.zero_fraction,
+                   "drive_latency": args.drive_latency, "drive_bandwidth": args.drive_bandwidth,
+                   "seeded": args.seeded, "stream": args.stream, "compression": args.compression,
+                   "restore": args.restore},
+        "scales": [],
+    }
+    for size_gb in args.scales:
+        print(f"Running {size_gb} GB...", flush=True)
+        results["scales"].append(run_scale(size_gb, args))
+
+    output = args.output or os.path.join(RESULTS_DIR, f"e2e_{started:%Y-%m-%d_%H-%M-%S}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=1)
+    print_summary(results)
+    print(f"Results written to {output}")
+
+    failed = any("failed" in s or s.get("exit_code") for s in results["scales"])
+    problems = [p for s in results["scales"] if "seconds" in s for p in check_scale(s, args)]
+    for problem in problems:
+        print(f"CHECK FAILED: {problem}")
+    failed = failed or bool(problems)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(results, json.load(f))
+        for problem in regressions:
+            print(f"REGRESSION: {problem}")
+        failed = failed or bool(regressions)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,60 @@
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+# === CONFIG ===
+# Modules the CLIs must be able to load without. Each one is imported lazily by the stage that uses it.
+HEAVY_MODULES = ["googleapiclient", "google.oauth2", "google_auth_httplib2", "tenacity", "httplib2",
+                 "zstandard", "cryptography", "boto3"]
+ENTRY_POINTS = ["main", "daemon", "history", "email_errors"]
+MAX_IMPORT_SECONDS = 1.0
+RUNS = 5
+
+# Runs in a fresh interpreter so nothing is already imported
+PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+print(json.dumps({{"seconds": time.perf_counter() - start, "modules": sorted(sys.modules)}}))
+"""
+
+
+def measure(module: str, runs: int = RUNS) -> dict:
+    """Best import time of 'module' over 'runs' fresh interpreters, and the modules it loaded."""
+    best = None
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, "-c", PROBE.format(module=module)], capture_output=True, text=True, check=True
+        )
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        if best is None or result["seconds"] < best["seconds"]:
+            best = result
+    loaded = set(best["modules"])
+    heavy = [m for m in HEAVY_MODULES if m in loaded]
+    return {"module": module, "seconds": best["seconds"], "heavy_modules": heavy}
+
+
+if __name__ == "__main__":
+    # Startup benchmark: python bench_startup.py [--runs N] [--max-seconds S]
+    # Exits with 1 when an entry point imports a heavy dependency eagerly or gets slower than the budget.
+    parser = argparse.ArgumentParser(description="Check the import time of the backup entry points.")
+    parser.add_argument("--runs", type=int, default=RUNS)
+    parser.add_argument("--max-seconds", type=float, default=MAX_IMPORT_SECONDS)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    failed = False
+    for module in ENTRY_POINTS:
+        result = measure(module, args.runs)
+        problems = []
+        if result["heavy_modules"]:
+            problems.append(f"imports {', '.join(result['heavy_modules'])}")
+        if result["seconds"] > args.max_seconds:
+            problems.append(f"slower than {args.max_seconds:.2f}s")
+        failed = failed or bool(problems)
+        print(f"{module:<14} {result['seconds'] * 1000:8.1f} ms  {'FAIL: ' + '; '.join(problems) if problems else 'ok'}")
+
+    print(f"Benchmark took {time.perf_counter() - start:.1f}s")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,170 @@
+import os
+import json
+import datetime
+import threading
+from loggingUtils import log_config
+import backup_sets
+
+# === CONFIG ===
+CHAIN_INDEX_FILE = "backup_chain.json"
+# Backup types the planner takes. The default is a full backup every night.
+#   "full": "daily" or "weekly" (on FULL_BACKUP_WEEKDAY, or once the last full is MAX_FULL_AGE_DAYS old)
+#   "differential": True takes a differential on the first run of a day the full is not due
+#   "log": True takes a BACKUP LOG on the other runs (needs the FULL or BULK_LOGGED recovery model)
+# e.g. {"full": "weekly", "differential": True, "log": True} for weekly fulls, nightly
+# differentials and log backups from the extra daemon.SCHEDULE runs during the day
+BACKUP_SCHEDULE = {"full": "daily", "differential": False, "log": False}
+FULL_BACKUP_WEEKDAY = 6  # Sunday (datetime.weekday())
+MAX_FULL_AGE_DAYS = 7
+MAX_INDEX_ENTRIES = 500
+
+FULL = "full"
+DIFFERENTIAL = "differential"
+LOG = "log"
+
+# RESTORE HEADERONLY BackupType values
+HEADER_BACKUP_TYPES = {1: FULL, 2: LOG, 5: DIFFERENTIAL}
+
+logger = log_config()
+_lock = threading.Lock()
+
+
+# ===== INDEX =====
+def load_index() -> list:
+    if not os.path.exists(CHAIN_INDEX_FILE):
+        return []
+    with open(CHAIN_INDEX_FILE, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_index(entries: list):
+    tmp = CHAIN_INDEX_FILE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(entries[-MAX_INDEX_ENTRIES:], f, indent=1)
+    os.replace(tmp, CHAIN_INDEX_FILE)
+
+
+def find_base(entries: list, entry: dict) -> dict | None:
+    """The full backup a differential or log backup was taken against."""
+    for candidate in reversed(entries):
+        if (candidate["database"] == entry["database"] and candidate["type"] == FULL
+                and candidate["checkpoint_lsn"] == entry["database_backup_lsn"]):
+            return candidate
+    return None
+
+
+def record_backup(database: str, backup_type: str, backup_files: list, header) -> dict:
+    """
+    Add a finished backup to the chain index using the LSNs of its RESTORE HEADERONLY row.
+    Differentials and logs whose base full backup is not in the index (e.g. a full backup
+    taken by another tool) are flagged as orphans so the planner takes a new full next time.
+    """
+    entry = {
+        "key": backup_sets.set_key(backup_files[0]),
+        "database": database,
+        "type": HEADER_BACKUP_TYPES.get(getattr(header, "BackupType", None), backup_type),
+        "files": [os.path.basename(f) for f in backup_files],
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "first_lsn": str(header.FirstLSN),
+        "last_lsn": str(header.LastLSN),
+        "checkpoint_lsn": str(header.CheckpointLSN),
+        "database_backup_lsn": str(header.DatabaseBackupLSN),
+        "orphan": False,
+    }
+
+    with _lock:
+        entries = load_index()
+        if entry["type"] != FULL and find_base(entries, entry) is None:
+            entry["orphan"] = True
+            logger.warning(
+                f"{entry['key']} depends on a full backup that is not in the chain index; "
+                "the next backup will be a full backup."
+            )
+        entries.append(entry)
+        save_index(entries)
+    return entry
+
+
+def find_entry(key: str) -> dict | None:
+    """Chain index entry of a backup set, by set key (see backup_sets.set_key)."""
+    for entry in reversed(load_index()):
+        if entry["key"] == key:
+            return entry
+    return None
+
+
+# ===== PLANNER =====
+def plan_backup_type(database: str, now: datetime.datetime = None, schedule: dict = None) -> str:
+    """
+    Pick the backup type of this run from the BACKUP_SCHEDULE: a full backup when one is due,
+    missing or the chain is broken; otherwise a differential on the first run of the day and a
+    log backup on the later ones, as far as the schedule enables them.
+    """
+    now = now or datetime.datetime.now()
+    schedule = schedule or BACKUP_SCHEDULE
+    entries = [e for e in load_index() if e["database"] == database]
+    fulls = [e for e in entries if e["type"] == FULL]
+
+    if not fulls:
+        return FULL
+    if entries[-1].get("orphan"):
+        return FULL
+
+    last_full = datetime.datetime.fromisoformat(fulls[-1]["created"])
+    if schedule.get("full", "daily") == "daily":
+        if last_full.date() != now.date():
+            return FULL
+    elif (now - last_full).days >= MAX_FULL_AGE_DAYS or (
+            now.weekday() == FULL_BACKUP_WEEKDAY and last_full.date() != now.date()):
+        return FULL
+
+    taken_today = any(datetime.datetime.fromisoformat(e["created"]).date() == now.date()
+                      for e in entries if e["type"] in (FULL, DIFFERENTIAL))
+    if schedule.get("differential") and not taken_today:
+        return DIFFERENTIAL
+    if schedule.get("log"):
+        return LOG
+    return DIFFERENTIAL if schedule.get("differential") else FULL
+
+
+# ===== RETENTION =====
+def dependencies(entries: list, key: str) -> set:
+    """Keys of every backup needed to restore the backup set 'key' (excluding itself)."""
+    by_key = {e["key"]: e for e in entries}
+    needed = set()
+    pending = [by_key[key]] if key in by_key else []
+
+    while pending:
+        entry = pending.pop()
+        if entry["type"] == FULL:
+            continue
+        base = find_base(entries, entry)
+        if base is not None and base["key"] not in needed:
+            needed.add(base["key"])
+            pending.append(base)
+        if entry["type"] == LOG:
+            for previous in entries:
+                if (previous["database"] == entry["database"] and previous["type"] == LOG
+                        and previous["last_lsn"] == entry["first_lsn"] and previous["key"] not in needed):
+                    needed.add(previous["key"])
+                    pending.append(previous)
+    return needed
+
+
+def with_dependencies(keys) -> set:
+    """The given backup set keys plus every set needed to restore them."""
+    entries = load_index()
+    protected = set(keys)
+    for key in keys:
+        protected |= dependencies(entries, key)
+    return protected
+
+
+def select_for_deletion(keys: list, keep: int) -> list:
+    """
+    Given backup set keys ordered newest first, keep the newest 'keep' sets plus every set they
+    depend on, and return the keys that can be deleted safely. Sets unknown to the chain index
+    (older backups) have no dependencies and are simply pruned by age.
+    """
+    protected = with_dependencies(keys[:keep])
+    return [k for k in keys if k not in protected]
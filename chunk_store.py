@@ -0,0 +1,262 @@
+import os
+import io
+import sys
+import json
+import time
+import zlib
+import hashlib
+import datetime
+from loggingUtils import log_config
+import backup_sets
+import retention
+
+# === CONFIG ===
+CHUNK_FOLDER_ID = "0AGehFL_62_CeUk9PVA"
+CHUNK_PREFIX = "chunk-"
+MANIFEST_SUFFIX = ".manifest.json"
+INDEX_FILE = "chunk_index.json"
+MANIFEST_DIR = "manifests"
+
+# SQL Server backups are written in 8 KiB pages, so chunk boundaries are only
+# considered at page boundaries. A page ends a chunk when its CRC matches the
+# mask, which makes boundaries follow the content instead of the file offset.
+PAGE_SIZE = 8 * 1024
+BOUNDARY_MASK = 0x1FF  # ~512 pages (4 MiB) per chunk on average
+MIN_CHUNK = 1 * 1024 * 1024
+MAX_CHUNK = 16 * 1024 * 1024
+READ_SIZE = 8 * 1024 * 1024
+
+logger = log_config()
+
+
+# ===== CHUNKING =====
+def iter_chunks(file_path: str):
+    """
+    Split a file with content-defined chunking.
+    Yields (sha256 hex digest, chunk bytes) and never holds more than one chunk in memory.
+    """
+    chunk = bytearray()
+    with open(file_path, "rb") as f:
+        while True:
+            block = f.read(READ_SIZE)
+            if not block:
+                break
+            view = memoryview(block)
+            for offset in range(0, len(view), PAGE_SIZE):
+                page = view[offset:offset + PAGE_SIZE]
+                chunk += page
+                if len(chunk) < MIN_CHUNK:
+                    continue
+                if (zlib.crc32(page) & BOUNDARY_MASK) == 0 or len(chunk) >= MAX_CHUNK:
+                    yield hashlib.sha256(chunk).hexdigest(), bytes(chunk)
+                    chunk = bytearray()
+    if chunk:
+        yield hashlib.sha256(chunk).hexdigest(), bytes(chunk)
+
+
+# ===== DRIVE HELPERS =====
+def list_files(service, query: str, fields: str = "id, name, size, createdTime") -> list:
+    """List every file matching 'query', following nextPageToken."""
+    files = []
+    page_token = None
+    while True:
+        results = service.files().list(
+            q=query,
+            fields=f"nextPageToken, files({fields})",
+            pageToken=page_token,
+            pageSize=1000,
+            includeItemsFromAllDrives=True,
+            supportsAllDrives=True,
+            corpora="allDrives",
+        ).execute()
+        files.extend(results.get("files", []))
+        page_token = results.get("nextPageToken")
+        if not page_token:
+            return files
+
+
+def put_bytes(service, name: str, data: bytes) -> str:
+    from googleapiclient.http import MediaIoBaseUpload
+    media = MediaIoBaseUpload(io.BytesIO(data), mimetype="application/octet-stream", resumable=True)
+    response = service.files().create(
+        media_body=media,
+        body={"name": name, "parents": [CHUNK_FOLDER_ID]},
+        fields="id",
+        supportsAllDrives=True,
+    ).execute()
+    return response["id"]
+
+
+def get_bytes(service, file_id: str) -> bytes:
+    from googleapiclient.http import MediaIoBaseDownload
+    buffer = io.BytesIO()
+    request = service.files().get_media(fileId=file_id, supportsAllDrives=True)
+    downloader = MediaIoBaseDownload(buffer, request, chunksize=MAX_CHUNK)
+    done = False
+    while not done:
+        _, done = downloader.next_chunk()
+    return buffer.getvalue()
+
+
+# ===== LOCAL INDEX =====
+def load_index() -> dict:
+    if not os.path.exists(INDEX_FILE):
+        return {}
+    with open(INDEX_FILE, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_index(index: dict):
+    tmp = INDEX_FILE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(index, f)
+    os.replace(tmp, INDEX_FILE)
+
+
+def rebuild_index(service) -> dict:
+    """Rebuild the local chunk index from the chunks already stored in Drive."""
+    query = f"'{CHUNK_FOLDER_ID}' in parents and name contains '{CHUNK_PREFIX}' and trashed=false"
+    index = {}
+    for f in list_files(service, query, fields="id, name"):
+        index[f["name"][len(CHUNK_PREFIX):]] = f["id"]
+    save_index(index)
+    logger.info(f"Chunk index rebuilt with {len(index)} chunks.")
+    return index
+
+
+# ===== UPLOAD =====
+def upload_backup(service, file_path: str, name: str) -> dict:
+    """
+    Upload only the chunks of 'file_path' that are not yet in Drive, followed by a manifest.
+    Returns the manifest.
+    """
+    index = load_index() or rebuild_index(service)
+    whole = hashlib.sha256()
+    chunks = []
+    new_chunks = 0
+    new_bytes = 0
+    size = os.path.getsize(file_path)
+    start = time.time()
+
+    for digest, data in iter_chunks(file_path):
+        whole.update(data)
+        chunks.append([digest, len(data)])
+        if digest not in index:
+            index[digest] = put_bytes(service, CHUNK_PREFIX + digest, data)
+            new_chunks += 1
+            new_bytes += len(data)
+            # Persist often so a failed run does not re-upload what already made it
+            save_index(index)
+
+    manifest = {
+        "name": name,
+        "size": size,
+        "sha256": whole.hexdigest(),
+        "created": time.strftime('%Y-%m-%d %H:%M:%S'),
+        "chunks": chunks,
+    }
+    data = json.dumps(manifest).encode("utf-8")
+    os.makedirs(MANIFEST_DIR, exist_ok=True)
+    with open(os.path.join(MANIFEST_DIR, name + MANIFEST_SUFFIX), "wb") as f:
+        f.write(data)
+    put_bytes(service, name + MANIFEST_SUFFIX, data)
+    save_index(index)
+
+    logger.info(
+        f"Uploaded {name}: {new_chunks}/{len(chunks)} new chunks, "
+        f"{new_bytes / 1048576:.1f} of {size / 1048576:.1f} MiB sent in {time.time() - start:.0f}s"
+    )
+    return manifest
+
+
+# ===== RESTORE =====
+def load_manifest(service, manifest: str) -> dict:
+    """Load a manifest from a local path, or from Drive by backup or manifest name."""
+    if os.path.exists(manifest):
+        with open(manifest, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    name = manifest if manifest.endswith(MANIFEST_SUFFIX) else manifest + MANIFEST_SUFFIX
+    query = f"'{CHUNK_FOLDER_ID}' in parents and name = '{name}' and trashed=false"
+    files = list_files(service, query, fields="id, name")
+    if not files:
+        raise FileNotFoundError(f"Manifest not found: {manifest}")
+    return json.loads(get_bytes(service, files[0]["id"]))
+
+
+def restore_backup(service, manifest: str, output_path: str) -> str:
+    """Rebuild a backup file from its manifest and check every chunk and the whole file hash."""
+    manifest = load_manifest(service, manifest)
+    index = load_index() or rebuild_index(service)
+    whole = hashlib.sha256()
+
+    tmp = output_path + ".part"
+    with open(tmp, "wb") as out:
+        for digest, size in manifest["chunks"]:
+            if digest not in index:
+                index = rebuild_index(service)
+            data = get_bytes(service, index[digest])
+            if len(data) != size or hashlib.sha256(data).hexdigest() != digest:
+                raise ValueError(f"Chunk {digest} is corrupted")
+            whole.update(data)
+            out.write(data)
+
+    if whole.hexdigest() != manifest["sha256"]:
+        os.remove(tmp)
+        raise ValueError(f"Restored file does not match manifest hash for {manifest['name']}")
+
+    os.replace(tmp, output_path)
+    logger.info(f"Restored {manifest['name']} to {output_path}")
+    return output_path
+
+
+# ===== CLEANUP =====
+def cleanup_old_backups(service, policy: dict = None):
+    """
+    Apply the Drive retention policy (retention.POLICIES["drive"]) to the chunked backups: delete
+    the manifests of the sets it drops, never one a kept differential still depends on, and the
+    chunks no longer referenced by the remaining manifests.
+    """
+    try:
+        query = f"'{CHUNK_FOLDER_ID}' in parents and name contains '{MANIFEST_SUFFIX}' and trashed=false"
+        items = []
+        for m in list_files(service, query):
+            name = m["name"][:-len(MANIFEST_SUFFIX)]
+            created = datetime.datetime.fromisoformat(m["createdTime"].replace("Z", "+00:00"))
+            items.append({**m, "name": name, "time": retention.item_time(name, created.timestamp())})
+        old = retention.select_for_deletion(
+            [item for item in items if backup_sets.is_backup_name(item["name"])], policy or retention.POLICIES["drive"]
+        )
+        if not old:
+            logger.info("No old backups to delete.")
+            return
+
+        old_ids = {m["id"] for m in old}
+        referenced = set()
+        for m in items:
+            if m["id"] not in old_ids:
+                referenced.update(digest for digest, _ in json.loads(get_bytes(service, m["id"]))["chunks"])
+
+        for m in old:
+            service.files().delete(fileId=m["id"], supportsAllDrives=True).execute()
+            logger.info(f"Deleted old backup manifest: {m['name']}{MANIFEST_SUFFIX}")
+
+        index = rebuild_index(service)
+        for digest in [d for d in index if d not in referenced]:
+            try:
+                service.files().delete(fileId=index.pop(digest), supportsAllDrives=True).execute()
+            except Exception as e:
+                logger.warning(f"Could not delete chunk {digest}: {e}")
+        save_index(index)
+    except Exception as e:
+        logger.error(f"Error cleaning up old chunked backups: {e}")
+
+
+if __name__ == "__main__":
+    # Usage: python chunk_store.py restore <manifest path or backup name> <output .bak>
+    if len(sys.argv) != 4 or sys.argv[1] != "restore":
+        print("Usage: python chunk_store.py restore <manifest> <output>")
+        sys.exit(1)
+
+    import upload
+    restore_backup(upload.get_drive_service(), sys.argv[2], sys.argv[3])
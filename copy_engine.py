@@ -0,0 +1,140 @@
+import os
+import sys
+import time
+import queue
+import shutil
+import hashlib
+import threading
+from loggingUtils import log_config
+import digests
+
+# === CONFIG ===
+BUFFER_SIZE = 8 * 1024 * 1024  # multiple of the 64 KiB SMB/NTFS allocation unit
+BUFFER_COUNT = 4
+PROGRESS_INTERVAL = 1  # log every N percent
+
+logger = log_config()
+
+
+def file_sha256(path: str, buffer_size: int = BUFFER_SIZE) -> str:
+    """SHA-256 of a file, reading into a single reused buffer."""
+    digest = hashlib.sha256()
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                return digest.hexdigest()
+            digest.update(view[:n])
+
+
+def copy_file(src: str, dst: str, verify: bool = True,
+              buffer_size: int = BUFFER_SIZE, buffer_count: int = BUFFER_COUNT, limiter=None) -> dict:
+    """
+    Copy 'src' to 'dst' with a reader thread filling a fixed pool of buffers while the calling
+    thread writes them out. The source digests are computed while reading and shared with the
+    other stages through the digests module; if 'verify' is set, the destination is read back and
+    compared against them before it is renamed into place. 'limiter' (a throttle.Limiter) caps
+    the write rate buffer by buffer.
+    Returns {"bytes", "seconds", "mb_s", "sha256"}.
+    """
+    size = os.path.getsize(src)
+    tmp = dst + ".part"
+    free = queue.Queue()
+    filled = queue.Queue()
+    for _ in range(buffer_count):
+        free.put(bytearray(buffer_size))
+    hashers = digests.new_hashers()
+    stop = threading.Event()
+
+    def reader():
+        try:
+            with open(src, "rb", buffering=0) as f:
+                while True:
+                    buffer = free.get()
+                    if buffer is None or stop.is_set():
+                        return
+                    n = f.readinto(buffer)
+                    if n:
+                        digests.update(hashers, memoryview(buffer)[:n])
+                    filled.put((buffer, n))
+                    if not n:
+                        return
+        except Exception as e:
+            filled.put((None, e))
+
+    start = time.time()
+    thread = threading.Thread(target=reader, name="copy-reader", daemon=True)
+    thread.start()
+
+    copied = 0
+    last_progress = 0
+    try:
+        with open(tmp, "wb", buffering=0) as out:
+            while True:
+                buffer, n = filled.get()
+                if buffer is None:
+                    raise n
+                if not n:
+                    break
+                if limiter is not None:
+                    limiter.acquire(n)
+                out.write(memoryview(buffer)[:n])
+                free.put(buffer)
+                copied += n
+
+                progress = int(copied * 100 / size) if size else 100
+                if progress >= last_progress + PROGRESS_INTERVAL:
+                    elapsed = time.time() - start
+                    logger.info(f"Progress: {progress}% ({copied / 1048576 / max(elapsed, 1e-6):.1f} MB/s)")
+                    last_progress = progress
+            os.fsync(out.fileno())
+        thread.join()
+
+        sha256 = digests.register(src, digests.hexdigests(hashers))["sha256"]
+        if verify:
+            copied_sha256 = file_sha256(tmp, buffer_size)
+            if copied_sha256 != sha256:
+                raise IOError(f"Hash mismatch copying {src} to {dst} (expected {sha256}, got {copied_sha256})")
+        os.replace(tmp, dst)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    finally:
+        # A writer error leaves the reader waiting for a free buffer with the source open: release it
+        stop.set()
+        free.put(None)
+        thread.join()
+
+    elapsed = time.time() - start
+    stats = {
+        "bytes": copied,
+        "seconds": elapsed,
+        "mb_s": copied / 1048576 / max(elapsed, 1e-6),
+        "sha256": sha256,
+    }
+    logger.info(
+        f"Copied {copied / 1048576:.1f} MiB to {dst} in {elapsed:.1f}s "
+        f"({stats['mb_s']:.1f} MB/s){', SHA-256 verified' if verify else ''}"
+    )
+    return stats
+
+
+if __name__ == "__main__":
+    # Benchmark: python copy_engine.py <source file> <destination folder>
+    if len(sys.argv) != 3:
+        print("Usage: python copy_engine.py <source file> <destination folder>")
+        sys.exit(1)
+
+    source, folder = sys.argv[1], sys.argv[2]
+    target = os.path.join(folder, os.path.basename(source))
+
+    start = time.time()
+    shutil.copyfile(source, target)
+    baseline = time.time() - start
+    os.remove(target)
+    logger.info(f"shutil.copyfile: {os.path.getsize(source) / 1048576 / max(baseline, 1e-6):.1f} MB/s")
+
+    copy_file(source, target)
@@ -0,0 +1,144 @@
+import sys
+import time
+import datetime
+import argparse
+import threading
+from loggingUtils import log_config
+import main
+import journal
+import forecast
+import status
+import email_errors
+
+# === CONFIG ===
+# Cron expressions: minute hour day-of-month month day-of-week (0 = Sunday).
+# Fields accept *, numbers, lists (1,3), ranges (1-5) and steps (*/15). Day of month and
+# day of week must both match.
+SCHEDULE = ["0 1 * * *"]
+
+logger = log_config()
+
+CRON_FIELDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 6)]
+
+
+# ===== SCHEDULE =====
+def parse_field(field: str, low: int, high: int) -> set:
+    values = set()
+    for part in field.split(","):
+        step = 1
+        if "/" in part:
+            part, step = part.split("/")
+            step = int(step)
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start, end = (int(x) for x in part.split("-"))
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+        if start < low or end > high or start > end:
+            raise ValueError(f"Cron field {field!r} out of range {low}-{high}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+def parse_cron(expression: str) -> list:
+    fields = expression.split()
+    if len(fields) != 5:
+        raise ValueError(f"Cron expression {expression!r} must have 5 fields")
+    return [parse_field(f, low, high) for f, (low, high) in zip(fields, CRON_FIELDS)]
+
+
+def next_run(expression: str, now: datetime.datetime) -> datetime.datetime:
+    """First time strictly after 'now' matching the cron expression."""
+    minutes, hours, days, months, weekdays = parse_cron(expression)
+    t = now.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+    limit = now + datetime.timedelta(days=366 * 5)
+
+    while t < limit:
+        if t.month not in months:
+            t = (t.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+        elif t.day not in days or (t.weekday() + 1) % 7 not in weekdays:
+            t = t.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+        elif t.hour not in hours:
+            t = t.replace(minute=0) + datetime.timedelta(hours=1)
+        elif t.minute not in minutes:
+            t += datetime.timedelta(minutes=1)
+        else:
+            return t
+    raise ValueError(f"Cron expression {expression!r} never matches")
+
+
+def next_scheduled(schedule: list, now: datetime.datetime = None) -> datetime.datetime:
+    now = now or datetime.datetime.now()
+    return min(next_run(expression, now) for expression in schedule)
+
+
+# ===== SERVICE =====
+def run_once(resume: bool = False) -> int:
+    """Run a backup in this process and send the failure email without launching another interpreter."""
+    status.update(state="running", progress={}, last_started=time.time())
+    start = time.time()
+    try:
+        result = main.run_backup(resume=resume)
+    except Exception as e:
+        logger.error(f"Backup run crashed: {e}", exc_info=True)
+        result = 4
+    status.update(
+        state="idle",
+        last_run={"started": start, "duration": time.time() - start, "exit_code": result},
+    )
+    if result:
+        logger.error(f"Errors encountered during execution. Exited with status: {result}")
+        email_errors.notify_failure(result)
+    return result
+
+
+def run_forever(schedule: list = None, stop: threading.Event = None, run_now: bool = False):
+    """
+    Stay resident and run the backup on the schedule. The Drive service, its credentials and
+    the SQL Server connections stay warm between runs (see upload.py and backup.connect).
+    """
+    schedule = schedule or SCHEDULE
+    stop = stop or threading.Event()
+    for expression in schedule:
+        parse_cron(expression)
+
+    def scheduled_run():
+        run_once()
+        # Legs the forecast deferred are sent by a resume once the bandwidth windows end
+        return forecast.resume_time() if journal.has_pending_legs() else None
+
+    resume_at = scheduled_run() if run_now else None
+    while not stop.is_set():
+        when = next_scheduled(schedule)
+        resuming = resume_at is not None and resume_at < when
+        if resuming:
+            when = resume_at
+        status.update(state="idle", next_run=when.isoformat(timespec="minutes"))
+        logger.info(f"Next {'resume of the deferred legs' if resuming else 'backup'} scheduled for {when:%Y-%m-%d %H:%M}")
+        # Sleep in short steps so clock changes (sleep, DST) do not delay the run
+        while not stop.is_set() and datetime.datetime.now() < when:
+            stop.wait(min(60, max(0.0, (when - datetime.datetime.now()).total_seconds())))
+        if stop.is_set():
+            break
+        if resuming:
+            run_once(resume=True)
+            resume_at = None
+        else:
+            resume_at = scheduled_run()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the Gynébe backup as a resident service.")
+    parser.add_argument("--now", action="store_true", help="run a backup immediately, then follow the schedule")
+    parser.add_argument("--no-status", action="store_true", help="do not start the local status endpoint")
+    args = parser.parse_args()
+
+    if not args.no_status:
+        status.start_server()
+    try:
+        run_forever(run_now=args.now)
+    except KeyboardInterrupt:
+        logger.info("Backup service stopped")
+        sys.exit(0)
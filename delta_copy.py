@@ -0,0 +1,216 @@
+import os
+import json
+import time
+import zlib
+import hashlib
+import tempfile
+from loggingUtils import log_config
+import backup_sets
+import copy_engine
+import digests
+import retention
+
+# === CONFIG ===
+BLOCK_SIZE = 256 * 1024
+SIGNATURE_FILE = "delta_signatures.json"
+
+logger = log_config()
+
+
+# ===== SIGNATURES =====
+def block_signature(block: bytes) -> str:
+    """Weak (adler32) + strong (blake2b) checksum of one block, rsync-style."""
+    return f"{zlib.adler32(block):08x}{hashlib.blake2b(block, digest_size=16).hexdigest()}"
+
+
+def file_signatures(path: str, block_size: int = BLOCK_SIZE) -> tuple[list, dict]:
+    """Block signatures and whole-file digests (see digests.new_hashers) of a file, in a single read."""
+    signatures = []
+    hashers = digests.new_hashers()
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            digests.update(hashers, block)
+            signatures.append(block_signature(block))
+    return signatures, digests.hexdigests(hashers)
+
+
+def load_signature_cache() -> dict:
+    if not os.path.exists(SIGNATURE_FILE):
+        return {}
+    with open(SIGNATURE_FILE, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_signature_cache(dest_path: str, signatures: list, sha256: str):
+    """Remember the signatures of what is now on the target so the next run does not re-read it."""
+    stat = os.stat(dest_path)
+    cache = {path: entry for path, entry in load_signature_cache().items() if os.path.exists(path)}
+    cache.update({
+        dest_path: {
+            "size": stat.st_size,
+            "mtime": int(stat.st_mtime),
+            "block_size": BLOCK_SIZE,
+            "sha256": sha256,
+            "signatures": signatures,
+        }
+    })
+    tmp = SIGNATURE_FILE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(cache, f)
+    os.replace(tmp, SIGNATURE_FILE)
+
+
+def forget_signatures(path: str):
+    """Drop the cached signatures of a file that may not match its contents, so they are read again."""
+    cache = load_signature_cache()
+    if cache.pop(path, None) is not None:
+        tmp = SIGNATURE_FILE + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+        os.replace(tmp, SIGNATURE_FILE)
+
+
+def basis_signatures(basis_path: str) -> list:
+    """Signatures of the basis file, from the local cache when it still describes the file."""
+    cached = load_signature_cache().get(basis_path)
+    stat = os.stat(basis_path)
+    if (cached and cached["size"] == stat.st_size and cached["mtime"] == int(stat.st_mtime)
+            and cached["block_size"] == BLOCK_SIZE):
+        return cached["signatures"]
+
+    logger.info(f"No cached signatures for {basis_path}, reading it from the target...")
+    return file_signatures(basis_path)[0]
+
+
+# ===== DELTA COPY =====
+def find_basis(local_file: str, target_folder: str, policy: dict = None) -> str | None:
+    """
+    Previous copy on the target to recycle as the basis: same stripe position and extension, in a
+    set the retention 'policy' deletes anyway once this backup is on the target. The basis is
+    renamed into the new copy, so a set that is still kept is never used.
+    """
+    name = os.path.basename(local_file)
+    extension = name[name.find(".bak"):] if ".bak" in name else os.path.splitext(name)[1]
+
+    def stripe_of(file_name):
+        stripe = backup_sets.STRIPE_PATTERN.search(file_name)
+        return stripe.group(0) if stripe else ""
+
+    items = retention.list_folder(target_folder)
+    items.append({"name": name, "path": None, "time": retention.item_time(name, time.time())})
+    candidates = [
+        item["path"] for item in retention.select_for_deletion(items, policy or retention.POLICIES["nas"])
+        if item["path"] and item["name"] != name and item["name"].endswith(extension)
+        and stripe_of(item["name"]) == stripe_of(name)
+    ]
+    if not candidates:
+        return None
+    return max(candidates, key=os.path.getmtime)
+
+
+def changed_blocks(signatures: list, old_signatures: list) -> list:
+    return [index for index, signature in enumerate(signatures)
+            if index >= len(old_signatures) or old_signatures[index] != signature]
+
+
+def patch_blocks(local_file: str, path: str, changed: list, undo: list, undo_file, limiter=None) -> int:
+    """
+    Write the 'changed' blocks of 'local_file' into 'path', saving the blocks they overwrite to
+    'undo_file' first (their offsets and lengths go to 'undo'). 'limiter' (a throttle.Limiter)
+    caps the write rate block by block. Returns the number of bytes written.
+    """
+    written = 0
+    with open(local_file, "rb") as src, open(path, "r+b") as dst:
+        for index in changed:
+            offset = index * BLOCK_SIZE
+            src.seek(offset)
+            block = src.read(BLOCK_SIZE)
+            dst.seek(offset)
+            old_block = dst.read(BLOCK_SIZE)
+            undo_file.write(old_block)
+            undo.append((offset, len(old_block)))
+            if limiter is not None:
+                limiter.acquire(len(block))
+            dst.seek(offset)
+            dst.write(block)
+            written += len(block)
+        dst.truncate(os.path.getsize(local_file))
+        os.fsync(dst.fileno())
+    return written
+
+
+def roll_back(path: str, basis: str, size: int, undo: list, undo_file):
+    """Put the overwritten blocks back and give the basis its name again."""
+    undo_file.seek(0)
+    with open(path, "r+b") as f:
+        for offset, length in undo:
+            f.seek(offset)
+            f.write(undo_file.read(length))
+        f.truncate(size)
+    os.replace(path, basis)
+
+
+def delta_copy(local_file: str, target_folder: str, policy: dict = None, limiter=None) -> dict:
+    """
+    Copy 'local_file' to 'target_folder' writing only the blocks that changed since a previous copy
+    on the target. A previous copy the retention 'policy' would delete anyway is renamed on the
+    share (server-side, nothing crosses the network) and the changed blocks are patched in. The
+    patched file is then hashed on the target, since the unchanged blocks are only known from the
+    signature cache, and renamed into place when it matches the local file.
+    Without a usable basis the whole file is copied and verified as usual. 'limiter' (a
+    throttle.Limiter) caps the write rate.
+    Returns {"path", "bytes", "written", "sha256"}, "sha256" being the digest of the copy on the target.
+    """
+    dest_path = os.path.join(target_folder, os.path.basename(local_file))
+    tmp_path = dest_path + ".part"
+    basis = find_basis(local_file, target_folder, policy)
+
+    signatures, local_digests = file_signatures(local_file)
+    sha256 = digests.register(local_file, local_digests)["sha256"]
+    size = os.path.getsize(local_file)
+
+    changed = []
+    if basis is not None:
+        changed = changed_blocks(signatures, basis_signatures(basis))
+        # Every changed block is read (for the undo) and written, then the whole result is read to
+        # hash it: 2x the changed blocks plus the file, against 2x the file for a plain verified copy
+        if 2 * len(changed) * BLOCK_SIZE >= size:
+            logger.info(f"{len(changed)} of {len(signatures)} blocks changed since {basis}, a plain copy is cheaper")
+            basis = None
+
+    if basis is None:
+        if not changed:
+            logger.info(f"No previous copy to recycle in {target_folder}, copying the whole file")
+        # The copy is read back and checked against the local digests before it is renamed into place
+        target_sha256 = copy_engine.copy_file(local_file, dest_path, limiter=limiter)["sha256"]
+        written = size
+    else:
+        basis_size = os.path.getsize(basis)
+        os.replace(basis, tmp_path)
+        undo = []
+        with tempfile.TemporaryFile() as undo_file:
+            try:
+                written = patch_blocks(local_file, tmp_path, changed, undo, undo_file, limiter)
+                target_sha256 = copy_engine.file_sha256(tmp_path)
+                if target_sha256 != sha256:
+                    raise IOError(f"Hash mismatch patching {basis} into {dest_path} "
+                                  f"(expected {sha256}, got {target_sha256})")
+                os.replace(tmp_path, dest_path)
+            except Exception:
+                logger.error(f"Delta copy of {local_file} failed, restoring {basis}")
+                try:
+                    roll_back(tmp_path, basis, basis_size, undo, undo_file)
+                except OSError as e:
+                    logger.error(f"Could not restore {basis}: {e}")
+                forget_signatures(basis)
+                raise
+
+    save_signature_cache(dest_path, signatures, sha256)
+    logger.info(
+        f"Delta copy of {local_file} to {dest_path}: wrote {written / 1048576:.1f} of {size / 1048576:.1f} MiB"
+        + (f" recycling {basis} as basis" if basis else "")
+    )
+    return {"path": dest_path, "bytes": size, "written": written, "sha256": target_sha256}
@@ -0,0 +1,78 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from loggingUtils import log_config
+import metrics
+
+logger = log_config()
+
+
+# ===== DESTINATION SCHEDULER =====
+def make_destination(name: str, error_code: int, send, retries: int = 1, retry_wait: int = 30) -> dict:
+    """
+    Describe a backup destination.
+    'send' is called with the backup file and must raise on failure.
+    'error_code' is the bit added to the exit code when every attempt fails.
+    """
+    return {
+        "name": name,
+        "error_code": error_code,
+        "send": send,
+        "retries": retries,
+        "retry_wait": retry_wait,
+    }
+
+
+def format_duration(seconds: float) -> str:
+    return time.strftime('%H:%M:%S', time.gmtime(int(seconds)))
+
+
+def run_destination(destination: dict, backup_file) -> dict:
+    """
+    Send the backup to a single destination, retrying up to its own budget.
+    Returns a result dict with the timing, number of attempts and error code (0 on success).
+    """
+    name = destination["name"]
+    attempts = 0
+    start = time.time()
+    error = None
+
+    while attempts < destination["retries"]:
+        attempts += 1
+        try:
+            logger.info(f"[{name}] Started (attempt {attempts}/{destination['retries']})")
+            destination["send"](backup_file)
+            error = None
+            break
+        except Exception as e:
+            error = e
+            logger.error(f"[{name}] Attempt {attempts} failed: {e}")
+            if attempts < destination["retries"]:
+                time.sleep(destination["retry_wait"])
+
+    elapsed = time.time() - start
+    code = destination["error_code"] if error is not None else 0
+    metrics.record(f"destination {name}", seconds=elapsed, retries=attempts - 1, ok=not code)
+    if code:
+        logger.error(f"[{name}] Failed after {attempts} attempt(s). Time taken: {format_duration(elapsed)}")
+    else:
+        logger.info(f"[{name}] Finished. Time taken: {format_duration(elapsed)}")
+
+    return {"name": name, "code": code, "attempts": attempts, "seconds": elapsed, "error": error}
+
+
+def run_destinations(destinations: list, backup_file) -> tuple[int, list]:
+    """
+    Fan the finished backup out to every destination in parallel.
+    Returns the combined exit code bitmask and the per-destination results.
+    """
+    if not destinations:
+        return 0, []
+
+    with ThreadPoolExecutor(max_workers=len(destinations), thread_name_prefix="destination") as pool:
+        futures = [pool.submit(metrics.bind(run_destination), d, backup_file) for d in destinations]
+        results = [f.result() for f in futures]
+
+    result = 0
+    for r in results:
+        result |= r["code"]
+    return result, results
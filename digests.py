@@ -0,0 +1,80 @@
+import os
+import hashlib
+import threading
+from loggingUtils import log_config
+
+BUFFER_SIZE = 8 * 1024 * 1024
+
+logger = log_config()
+
+# One entry per file version: {(path, size, mtime): {"sha256": ..., "md5": ...}}
+_digests = {}
+_locks = {}
+_lock = threading.Lock()
+
+
+def file_key(path: str) -> tuple:
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+
+def new_hashers() -> dict:
+    """Hash objects for every digest a destination may check against (Drive reports md5 and sha256)."""
+    return {"sha256": hashlib.sha256(), "md5": hashlib.md5()}
+
+
+def update(hashers: dict, data):
+    for h in hashers.values():
+        h.update(data)
+
+
+def hexdigests(hashers: dict) -> dict:
+    return {name: h.hexdigest() for name, h in hashers.items()}
+
+
+def register(path: str, digests: dict) -> dict:
+    """
+    Record the digests of a file computed by whichever stage read it first.
+    If another stage already registered different digests the file changed or was misread,
+    and an IOError is raised. Returns the reference digests.
+    """
+    key = file_key(path)
+    with _lock:
+        reference = _digests.setdefault(key, digests)
+    if reference != digests:
+        raise IOError(f"{path} read differently by two stages (sha256 {reference['sha256']} vs {digests['sha256']})")
+    return reference
+
+
+def cached(path: str) -> dict | None:
+    with _lock:
+        return _digests.get(file_key(path))
+
+
+def get(path: str) -> dict:
+    """
+    Reference digests of a file. Uses what a stage already computed while reading the file;
+    only reads the file when no stage has (e.g. after a resumed upload).
+    """
+    key = file_key(path)
+    with _lock:
+        if key in _digests:
+            return _digests[key]
+        file_lock = _locks.setdefault(key, threading.Lock())
+
+    # Concurrent callers wait for one read instead of reading the file in parallel
+    with file_lock:
+        with _lock:
+            if key in _digests:
+                return _digests[key]
+        logger.info(f"Hashing {path}...")
+        hashers = new_hashers()
+        buffer = bytearray(BUFFER_SIZE)
+        view = memoryview(buffer)
+        with open(path, "rb", buffering=0) as f:
+            while True:
+                n = f.readinto(buffer)
+                if not n:
+                    break
+                update(hashers, view[:n])
+        return register(path, hexdigests(hashers))
@@ -21,14 +21,23 @@ BODY_BASE = (
     "or his successor, Quico The Great!\n"
 )
 
+# One message per bit of the exit code
 ERROR_MESSAGES = {
     "1": "- Error sending backup to backup server.",
     "2": "- Error sending backup to google drive.",
-    "3": "- Error sending backup to backup server.\n- Error sending backup to google drive.",
     "4": "- Error making backup in the server",
-    "5": "- Error reading the credentials file"
+    "8": "- Error sending backup to an additional storage target",
+    "16": "- Error reading the credentials file",
 }
 
+def error_lines(code: str) -> str:
+    """Error lines for an exit code, read as a bitmask (e.g. 7 = 1 + 2 + 4)."""
+    if not code or not code.isdigit():
+        return ""
+    value = int(code)
+    return "\n".join(message for bit, message in ERROR_MESSAGES.items() if value & int(bit))
+
+
 def send_email(sender, password, recipients, subject, body):
     msg = MIMEText(body)
     msg["Subject"] = subject
@@ -44,24 +53,23 @@ def send_email(sender, password, recipients, subject, body):
     except Exception as e:
         logger.error(f"Failed to send email: {e}")
 
-if __name__ == "__main__":
-    # Default argument is None
-    arg = sys.argv[1] if len(sys.argv) > 1 else None
+def notify_failure(code, password_file: str = "app_password.txt"):
+    """Email the failure report for an exit code (used by run.bat through __main__ and by the daemon)."""
     body = BODY_BASE
+    errors = error_lines(None if code is None else str(code))
+    if errors:
+        body += "\nErrors:\n" + errors
 
-    if arg in ERROR_MESSAGES:
-        body += "\nErrors:\n" + ERROR_MESSAGES[arg]
-
-    current_path = os.getcwd()
-    file_path = os.path.join(current_path, "app_password.txt")
-
+    file_path = os.path.join(os.getcwd(), password_file)
     if not os.path.exists(file_path):
         logger.error(f"App password file does not exist: {file_path}")
-    else:
-        logger.info(f"App password file exists: {file_path}")
-        with open(file_path, "r") as file:
-            APP_PASSWORD = file.readline()
-            send_email(SENDER, APP_PASSWORD, RECIPIENTS, SUBJECT, body)
-
+        return
+    logger.info(f"App password file exists: {file_path}")
+    with open(file_path, "r") as file:
+        APP_PASSWORD = file.readline()
+    send_email(SENDER, APP_PASSWORD, RECIPIENTS, SUBJECT, body)
 
-   
\ No newline at end of file
+if __name__ == "__main__":
+    # Default argument is None
+    arg = sys.argv[1] if len(sys.argv) > 1 else None
+    notify_failure(arg)
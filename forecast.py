@@ -0,0 +1,257 @@
+import json
+import sqlite3
+import datetime
+from loggingUtils import log_config
+import chain
+import history
+import pipeline
+import throttle
+
+# === CONFIG ===
+# Every run must be finished by this time (the clinic opens)
+DEADLINE = "07:30"
+# Deferred legs are sent by "main.py resume" at this time, once the daytime bandwidth windows end
+RESUME_AT = "20:00"
+# Runs and days of history the estimates are learned from
+RATE_RUNS = 5
+GROWTH_DAYS = 90
+# Used while the history has no run to learn from, in bytes/s
+DEFAULT_RATES = {
+    "backup": 60 * 1024 * 1024,
+    "artifact": 80 * 1024 * 1024,
+    "nas_copy": 40 * 1024 * 1024,
+    "upload": 4 * 1024 * 1024,
+    "verify_checksum": 100 * 1024 * 1024,
+}
+# Expected size reduction when the planner turns compression on (the history has no artifact sizes)
+COMPRESSION_RATIOS = {"zstd": 3.0, "lzma": 4.0}
+# What the planner may change, in this order, until the forecast meets the deadline
+ADAPTIVE = {"differential": True, "compression": True, "defer_drive": True}
+FORECAST_LOG = "forecasts.jsonl"
+
+logger = log_config()
+
+# Metrics phase and throttle window of each leg after the backup
+LEGS = {
+    "backup server": ("nas_copy", "copy"),
+    "google drive": ("upload", "upload"),
+    "verify": ("verify_checksum", None),
+}
+
+
+# ===== LEARNING =====
+def load_runs(database: str, since: datetime.datetime) -> list:
+    """Recorded runs of a database since a date, oldest first, with their phases decoded."""
+    try:
+        with history.connect() as conn:
+            rows = conn.execute(
+                "SELECT started, backup_type, backup_size, phases FROM runs"
+                " WHERE database_name = ? AND started >= ? ORDER BY started",
+                (database, since.isoformat(sep=" ", timespec="seconds")),
+            ).fetchall()
+    except sqlite3.Error as e:
+        logger.warning(f"Could not read run history: {e}")
+        return []
+    return [{"started": datetime.datetime.fromisoformat(row["started"]), "backup_type": row["backup_type"],
+             "backup_size": row["backup_size"], "phases": json.loads(row["phases"] or "{}")} for row in rows]
+
+
+def median(values: list) -> float | None:
+    values = sorted(values)
+    return values[len(values) // 2] if values else None
+
+
+def learned_rate(runs: list, phase: str, last: int = RATE_RUNS) -> float:
+    """Median bytes/s of a metrics phase over the last runs that went through it."""
+    rates = [r["phases"][phase]["bytes"] / r["phases"][phase]["seconds"] for r in runs
+             if r["phases"].get(phase, {}).get("seconds") and r["phases"][phase].get("bytes")]
+    return median(rates[-last:]) or DEFAULT_RATES[phase]
+
+
+def predicted_size(runs: list, backup_type: str, when: datetime.datetime) -> int | None:
+    """
+    Size of tonight's backup: a least-squares line through the full backups' sizes over time,
+    or the median of the last differentials or log backups (they restart small after every full).
+    """
+    sizes = [(r["started"], r["backup_size"]) for r in runs if r["backup_type"] == backup_type and r["backup_size"]]
+    if not sizes:
+        return None
+    if backup_type != chain.FULL:
+        return int(median([size for _, size in sizes[-RATE_RUNS:]]))
+    if len(sizes) < 2:
+        return sizes[-1][1]
+    origin = sizes[0][0]
+    xs = [(t - origin).total_seconds() / 86400 for t, _ in sizes]
+    ys = [size for _, size in sizes]
+    mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+    spread = sum((x - mean_x) ** 2 for x in xs)
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / spread if spread else 0.0
+    day = (when - origin).total_seconds() / 86400
+    return max(int(mean_y + slope * (day - mean_x)), ys[-1] if slope >= 0 else 0)
+
+
+def learn(database: str, now: datetime.datetime) -> dict:
+    """Sizes and throughputs of a database learned from the run history."""
+    runs = load_runs(database, now - datetime.timedelta(days=GROWTH_DAYS))
+    full = predicted_size(runs, chain.FULL, now)
+    differential = predicted_size(runs, chain.DIFFERENTIAL, now)
+    differential = differential if differential is not None else full
+    log = predicted_size(runs, chain.LOG, now)
+    return {
+        "runs": len(runs),
+        "sizes": {chain.FULL: full, chain.DIFFERENTIAL: differential,
+                  chain.LOG: log if log is not None else differential},
+        "rates": {phase: learned_rate(runs, phase) for phase in DEFAULT_RATES},
+    }
+
+
+# ===== FORECAST =====
+def next_deadline(now: datetime.datetime, deadline: str = None) -> datetime.datetime:
+    t = datetime.datetime.combine(now.date(), throttle.parse_time(deadline or DEADLINE))
+    return t if t > now else t + datetime.timedelta(days=1)
+
+
+def resume_time(now: datetime.datetime = None) -> datetime.datetime:
+    """When the legs deferred by a run started at 'now' are sent."""
+    return next_deadline(now or datetime.datetime.now(), RESUME_AT)
+
+
+def forecast_run(models: dict, plan: dict, start: datetime.datetime) -> dict:
+    """
+    Predicted timeline of a run: the databases are backed up one after another, the artifacts
+    prepared, then every leg runs in parallel under its bandwidth windows.
+    """
+    size = 0
+    seconds = {"backup": 0.0, "artifact": 0.0}
+    for database, model in models.items():
+        nbytes = model["sizes"][plan["types"][database]] or 0
+        size += nbytes
+        seconds["backup"] += nbytes / model["rates"]["backup"]
+        if plan["compression"] or pipeline.COMPRESSION:
+            seconds["artifact"] += nbytes / model["rates"]["artifact"]
+    rates = {phase: min((m["rates"][phase] for m in models.values()), default=DEFAULT_RATES[phase])
+             for phase in DEFAULT_RATES}
+    sent = size / COMPRESSION_RATIOS.get(plan["compression"] or pipeline.COMPRESSION, 1.0)
+
+    legs_start = start + datetime.timedelta(seconds=seconds["backup"] + seconds["artifact"])
+    finishes = {}
+    for leg, (phase, window) in LEGS.items():
+        if leg in plan["defer"]:
+            continue
+        nbytes = size if leg == "verify" else sent
+        windows = throttle.WINDOWS.get(window, []) if window else []
+        try:
+            finishes[leg] = throttle.estimate_finish(windows, int(nbytes), rates[phase], legs_start)
+        except ValueError:
+            # Beyond the estimate horizon: days late anyway, the unthrottled time is enough to tell
+            finishes[leg] = legs_start + datetime.timedelta(seconds=nbytes / rates[phase])
+        seconds[leg] = (finishes[leg] - legs_start).total_seconds()
+    finish = max([legs_start, *finishes.values()])
+    return {"start": start, "finish": finish, "bytes": size, "seconds": seconds}
+
+
+def plan_run(databases: list, now: datetime.datetime = None, deadline: str = None,
+             defer_leg: str = "google drive", allow_compression: bool = True) -> dict:
+    """
+    Choose tonight's plan from the forecast. Starting from the configured plan (chain planner's
+    backup type, pipeline compression, every leg), the ADAPTIVE changes are added one at a time
+    until the run is predicted to end before the deadline: differentials instead of fulls,
+    zstd compression, then deferring the Drive upload to a later "main.py resume".
+    'allow_compression' False keeps compression as configured (the chunk store deduplicates raw backups).
+    'now' comes from a fake clock in tests.
+    Returns {"types", "compression", "defer", "forecast", "deadline", "meets_deadline", "changes"};
+    "compression" is the method to use for this run only, or None for pipeline.COMPRESSION.
+    """
+    now = now or datetime.datetime.now()
+    due = next_deadline(now, deadline)
+    models = {database: learn(database, now) for database in databases}
+    plan = {
+        "types": {database: chain.plan_backup_type(database, now) for database in databases},
+        "compression": None,
+        "defer": [],
+        "changes": [],
+    }
+
+    def differential(p):
+        fulls = [db for db, t in p["types"].items() if t == chain.FULL and can_differential(db)]
+        if not fulls:
+            return None
+        return {**p, "types": {**p["types"], **{db: chain.DIFFERENTIAL for db in fulls}},
+                "changes": p["changes"] + [f"differential instead of full for {', '.join(fulls)}"]}
+
+    def compression(p):
+        if not allow_compression or p["compression"] or pipeline.COMPRESSION or not pipeline.zstd_available():
+            return None
+        return {**p, "compression": "zstd", "changes": p["changes"] + ["zstd compression"]}
+
+    def defer_drive(p):
+        if defer_leg in p["defer"]:
+            return None
+        return {**p, "defer": p["defer"] + [defer_leg], "changes": p["changes"] + [f"defer {defer_leg}"]}
+
+    steps = {"differential": differential, "compression": compression, "defer_drive": defer_drive}
+    forecast = forecast_run(models, plan, now)
+    for name, step in steps.items():
+        if forecast["finish"] <= due:
+            break
+        candidate = step(plan) if ADAPTIVE.get(name) else None
+        if candidate is not None:
+            plan, forecast = candidate, forecast_run(models, candidate, now)
+
+    plan.update(forecast=forecast, deadline=due, meets_deadline=forecast["finish"] <= due)
+    unknown = [db for db, m in models.items() if m["sizes"][chain.FULL] is None]
+    if unknown:
+        logger.info(f"No backup size history yet for {', '.join(unknown)}; the forecast leaves them out")
+    log_plan(plan)
+    return plan
+
+
+def can_differential(database: str) -> bool:
+    """A differential is possible once the chain index has an intact full backup of the database."""
+    entries = [e for e in chain.load_index() if e["database"] == database]
+    return any(e["type"] == chain.FULL for e in entries) and not entries[-1].get("orphan")
+
+
+def log_plan(plan: dict):
+    forecast = plan["forecast"]
+    legs = ", ".join(f"{name} {seconds / 60:.0f} min" for name, seconds in forecast["seconds"].items() if seconds)
+    message = (f"Forecast: {forecast['bytes'] / 1048576:.0f} MiB, finishing at {forecast['finish']:%Y-%m-%d %H:%M} "
+               f"(deadline {plan['deadline']:%H:%M}; {legs})")
+    if plan["changes"]:
+        message += f"; plan changed: {', '.join(plan['changes'])}"
+    if plan["meets_deadline"]:
+        logger.info(message)
+    else:
+        logger.warning(message + " - the deadline will be missed even so")
+
+
+# ===== FORECAST VS ACTUAL =====
+def compare(plan: dict, report: dict) -> dict:
+    """
+    Log the forecast next to the actual times of the run (a metrics.write_report() record) and
+    append both to FORECAST_LOG, so forecast errors can be followed over time.
+    """
+    forecast = plan["forecast"]
+    actual = {"backup": report["phases"].get("backup", {}).get("seconds"),
+              "artifact": report["phases"].get("artifact", {}).get("seconds")}
+    for leg in LEGS:
+        actual[leg] = report["phases"].get(f"destination {leg}", {}).get("seconds")
+    finished = datetime.datetime.fromtimestamp(report["finished"])
+    record = {
+        "started": forecast["start"].isoformat(timespec="seconds"),
+        "deadline": plan["deadline"].isoformat(timespec="seconds"),
+        "changes": plan["changes"],
+        "forecast": {"finish": forecast["finish"].isoformat(timespec="seconds"), "bytes": forecast["bytes"],
+                     "seconds": forecast["seconds"]},
+        "actual": {"finish": finished.isoformat(timespec="seconds"), "seconds": actual},
+    }
+    for name, predicted in forecast["seconds"].items():
+        if actual.get(name) is not None:
+            logger.info(f"Forecast vs actual {name}: {predicted / 60:.1f} min vs {actual[name] / 60:.1f} min")
+    logger.info(f"Forecast vs actual finish: {forecast['finish']:%H:%M} vs {finished:%H:%M}")
+    try:
+        with open(FORECAST_LOG, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+    except OSError as e:
+        logger.error(f"Could not write {FORECAST_LOG}: {e}")
+    return record
@@ -0,0 +1,295 @@
+import os
+import re
+import sys
+import json
+import sqlite3
+import argparse
+import datetime
+from loggingUtils import log_config
+
+# === CONFIG ===
+HISTORY_DB = "run_history.sqlite3"
+
+logger = log_config()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started TEXT NOT NULL,
+    finished TEXT,
+    duration REAL,
+    exit_code INTEGER,
+    database_name TEXT,
+    backup_type TEXT,
+    backup_files TEXT,
+    backup_size INTEGER,
+    sha256 TEXT,
+    phases TEXT,
+    source TEXT NOT NULL DEFAULT 'run'
+);
+CREATE INDEX IF NOT EXISTS runs_started ON runs (started);
+CREATE TABLE IF NOT EXISTS transfers (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    destination TEXT NOT NULL,
+    ok INTEGER NOT NULL,
+    seconds REAL,
+    bytes INTEGER
+);
+CREATE INDEX IF NOT EXISTS transfers_destination ON transfers (destination, ok);
+"""
+
+
+def connect(path: str = None) -> sqlite3.Connection:
+    conn = sqlite3.connect(path or HISTORY_DB)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def timestamp(epoch: float) -> str:
+    return datetime.datetime.fromtimestamp(epoch).isoformat(sep=" ", timespec="seconds")
+
+
+# ===== RECORDING =====
+def insert_run(conn, run: dict, transfers: list) -> int:
+    cur = conn.execute(
+        "INSERT INTO runs (started, finished, duration, exit_code, database_name, backup_type, backup_files,"
+        " backup_size, sha256, phases, source) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            run["started"], run.get("finished"), run.get("duration"), run.get("exit_code"),
+            run.get("database"), run.get("backup_type"), json.dumps(run.get("backup_files") or []),
+            run.get("backup_size"), run.get("sha256"), json.dumps(run.get("phases") or {}),
+            run.get("source", "run"),
+        ),
+    )
+    conn.executemany(
+        "INSERT INTO transfers (run_id, destination, ok, seconds, bytes) VALUES (?, ?, ?, ?, ?)",
+        [(cur.lastrowid, t["destination"], int(t["ok"]), t.get("seconds"), t.get("bytes")) for t in transfers],
+    )
+    return cur.lastrowid
+
+
+def record_run(report: dict, database: str, backup_files: list = None, results: list = None,
+               backup_type: str = None, sha256: str = None):
+    """Append one run to the history database. 'report' is the metrics.write_report() record."""
+    backup_files = backup_files or []
+    size = sum(os.path.getsize(f) for f in backup_files if os.path.exists(f))
+    run = {
+        "started": timestamp(report["started"]),
+        "finished": timestamp(report["finished"]),
+        "duration": report["duration"],
+        "exit_code": report["exit_code"],
+        "database": database,
+        "backup_type": backup_type,
+        "backup_files": [os.path.basename(f) for f in backup_files],
+        "backup_size": size or None,
+        "sha256": sha256,
+        "phases": report["phases"],
+    }
+    transfers = [
+        {"destination": r["name"], "ok": not r["code"], "seconds": r["seconds"], "bytes": size or None}
+        for r in results or []
+    ]
+    try:
+        with connect() as conn:
+            insert_run(conn, run, transfers)
+    except Exception as e:
+        logger.error(f"Could not record run history: {e}")
+
+
+# ===== LOG IMPORT =====
+LINE_PATTERN = re.compile(r"^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}),\d+ - (\S+) - (\w+) - (.*)$")
+RUN_START = ("Started backup process", "Connecting to SQL Server at")
+BACKUP_DONE = re.compile(r"(?:Backup file created successfully|Backup completed and verified successfully): (.*)$")
+TIME_TAKEN = re.compile(r"Time taken: (\d+):(\d{2}):(\d{2})")
+# A run is over once nothing is logged for this long (later lines belong to manual test runs)
+MAX_GAP = datetime.timedelta(hours=1)
+
+
+def parse_log(lines):
+    """
+    Stream (run, transfers) tuples out of gynebeBot.log lines. Repeated identical lines
+    (the old logger wrote each line several times) are skipped.
+    """
+    run = None
+    transfers = {}
+    previous = None
+
+    def finish():
+        if run is None:
+            return None
+        nas = transfers.get("backup server")
+        drive = transfers.get("google drive")
+        if not run.get("backup_files"):
+            run["exit_code"] = 4
+        else:
+            run["exit_code"] = (1 if nas is not None and not nas["ok"] else 0) + \
+                               (2 if drive is not None and not drive["ok"] else 0)
+        started = datetime.datetime.fromisoformat(run["started"])
+        finished = datetime.datetime.fromisoformat(run["finished"])
+        run["duration"] = (finished - started).total_seconds()
+        return run, list(transfers.values())
+
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if line == previous:
+            continue
+        previous = line
+        match = LINE_PATTERN.match(line)
+        if not match or match.group(2) != "root":
+            continue
+        when, _, _, message = match.groups()
+
+        if message.startswith(RUN_START):
+            done = finish()
+            if done:
+                yield done
+            run = {"started": when, "finished": when, "source": "log", "backup_files": []}
+            transfers = {}
+            continue
+        if run is None:
+            continue
+        if datetime.datetime.fromisoformat(when) - datetime.datetime.fromisoformat(run["finished"]) > MAX_GAP:
+            done = finish()
+            if done:
+                yield done
+            run = None
+            continue
+        run["finished"] = when
+
+        backup_done = BACKUP_DONE.search(message)
+        if backup_done:
+            run["backup_files"] = [backup_done.group(1).replace("\\\\", "\\").rsplit("\\", 1)[-1]]
+        elif message.startswith("Copied backup file"):
+            transfers["backup server"] = {"destination": "backup server", "ok": True}
+        elif message.startswith("Backup failed:") or message.startswith("[backup server] Failed"):
+            transfers["backup server"] = {"destination": "backup server", "ok": False}
+        elif message.startswith("Uploaded "):
+            transfers["google drive"] = {"destination": "google drive", "ok": True}
+        elif message.startswith("File couldn't be uploaded") or message.startswith("[google drive] Failed"):
+            transfers["google drive"] = {"destination": "google drive", "ok": False}
+        else:
+            taken = TIME_TAKEN.search(message)
+            if taken and (message.startswith("Time taken") or message.startswith("[google drive]")):
+                h, m, s = (int(x) for x in taken.groups())
+                transfers.setdefault("google drive", {"destination": "google drive", "ok": True})
+                transfers["google drive"]["seconds"] = h * 3600 + m * 60 + s
+
+    done = finish()
+    if done:
+        yield done
+
+
+def import_log(path: str) -> int:
+    """Backfill the history database from an old log file, reading it line by line."""
+    count = 0
+    with open(path, "r", encoding="utf-8", errors="replace") as f, connect() as conn:
+        for run, transfers in parse_log(f):
+            insert_run(conn, run, transfers)
+            count += 1
+    logger.info(f"Imported {count} runs from {path}")
+    return count
+
+
+# ===== QUERIES =====
+def slowest_runs(conn, limit: int = 10) -> list:
+    return conn.execute(
+        "SELECT started, duration, exit_code, backup_type, backup_size FROM runs"
+        " WHERE duration IS NOT NULL ORDER BY duration DESC LIMIT ?", (limit,)
+    ).fetchall()
+
+
+def size_growth(conn) -> list:
+    return conn.execute(
+        "SELECT substr(started, 1, 7) AS month, COUNT(*) AS runs, MIN(backup_size) AS min_size,"
+        " MAX(backup_size) AS max_size, AVG(backup_size) AS avg_size FROM runs"
+        " WHERE backup_size IS NOT NULL GROUP BY month ORDER BY month"
+    ).fetchall()
+
+
+def last_success(conn) -> list:
+    return conn.execute(
+        "SELECT t.destination, MAX(r.started) AS started FROM transfers t JOIN runs r ON r.id = t.run_id"
+        " WHERE t.ok = 1 GROUP BY t.destination ORDER BY t.destination"
+    ).fetchall()
+
+
+def recent_throughput(phase: str, runs: int = 5) -> float | None:
+    """
+    Median bytes/s of a transfer phase ("nas_copy" or "upload") over the last runs that completed it,
+    or None without history. The phase times leave out the wake-up wait and the other steps of the
+    destination, so they are close to the link speed.
+    """
+    try:
+        with connect() as conn:
+            rows = conn.execute(
+                "SELECT phases FROM runs WHERE phases LIKE ? ORDER BY started DESC", (f'%"{phase}"%',)
+            ).fetchall()
+    except sqlite3.Error as e:
+        logger.warning(f"Could not read run history: {e}")
+        return None
+    rates = []
+    for row in rows:
+        entry = json.loads(row["phases"] or "{}").get(phase, {})
+        if entry.get("ok", True) and entry.get("bytes") and entry.get("seconds"):
+            rates.append(entry["bytes"] / entry["seconds"])
+        if len(rates) == runs:
+            break
+    rates.sort()
+    return rates[len(rates) // 2] if rates else None
+
+
+def recorded_sha256(name: str) -> str | None:
+    """SHA-256 recorded for a backup file by the run that created it (only the first file of a set is hashed)."""
+    try:
+        with connect() as conn:
+            rows = conn.execute(
+                "SELECT backup_files, sha256 FROM runs WHERE sha256 IS NOT NULL AND backup_files LIKE ?"
+                " ORDER BY started DESC", (f'%"{name}"%',)
+            ).fetchall()
+    except sqlite3.Error as e:
+        logger.warning(f"Could not read run history: {e}")
+        return None
+    for row in rows:
+        files = json.loads(row["backup_files"])
+        if files and files[0] == name:
+            return row["sha256"]
+    return None
+
+
+def print_rows(rows):
+    if not rows:
+        print("No runs recorded.")
+        return
+    keys = rows[0].keys()
+    print("\t".join(keys))
+    for row in rows:
+        print("\t".join("" if row[k] is None else str(row[k]) for k in keys))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query the Gynébe backup run history.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    slowest = commands.add_parser("slowest", help="list the slowest runs")
+    slowest.add_argument("-n", type=int, default=10)
+    commands.add_parser("growth", help="backup size per month")
+    commands.add_parser("last-success", help="last successful transfer per destination")
+    importer = commands.add_parser("import-log", help="backfill history from gynebeBot.log")
+    importer.add_argument("path")
+    args = parser.parse_args(argv)
+
+    if args.command == "import-log":
+        import_log(args.path)
+        return
+
+    with connect() as conn:
+        if args.command == "slowest":
+            print_rows(slowest_runs(conn, args.n))
+        elif args.command == "growth":
+            print_rows(size_growth(conn))
+        elif args.command == "last-success":
+            print_rows(last_success(conn))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,178 @@
+import os
+import json
+import datetime
+import threading
+from loggingUtils import log_config
+import digests
+
+# === CONFIG ===
+JOURNAL_FILE = "run_journal.json"
+
+# Phase states
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+# Left for a later "main.py resume" by the backup window forecast
+DEFERRED = "deferred"
+
+# Phases around the destinations, which are journaled under their destination names
+# ("verify", "backup server", "google drive" and the additional storage targets)
+BACKUP = "backup"
+CLEANUP = "cleanup"
+
+logger = log_config()
+_lock = threading.Lock()
+
+
+# ===== JOURNAL FILE =====
+def load_all() -> dict:
+    if not os.path.exists(JOURNAL_FILE):
+        return {}
+    try:
+        with open(JOURNAL_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except ValueError:
+        logger.warning(f"Ignoring unreadable run journal {JOURNAL_FILE}")
+        return {}
+
+
+def save(journal: dict):
+    """Write one database's journal. Every database keeps only its latest run."""
+    with _lock:
+        journals = load_all()
+        journals[journal["database"]] = journal
+        tmp = JOURNAL_FILE + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(journals, f, indent=1)
+        os.replace(tmp, JOURNAL_FILE)
+
+
+def load(database: str) -> dict | None:
+    with _lock:
+        return load_all().get(database)
+
+
+def now() -> str:
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+
+# ===== PHASES =====
+def start(database: str, discard: bool = False) -> dict:
+    """
+    Journal of a new run of 'database', replacing the previous one. Raises if the previous run
+    still has destinations to send its backup to, unless 'discard' drops them knowingly.
+    """
+    legs = pending_legs(load(database))
+    if legs and not discard:
+        raise RuntimeError(f"The last run of {database} has not been sent to {', '.join(legs)} yet")
+    if legs:
+        logger.warning(f"[{database}] Dropping the last run's unsent legs: {', '.join(legs)}")
+    journal = {"database": database, "started": now(), "files": [], "artifacts": [], "phases": {}}
+    mark(journal, BACKUP, PENDING)
+    return journal
+
+
+def mark(journal: dict, phase: str, state: str, error=None, until: datetime.datetime = None):
+    """
+    Record the outcome of a phase and persist the journal right away.
+    'until' is when a DEFERRED leg may be sent (see deferred_until).
+    """
+    entry = journal["phases"].setdefault(phase, {"state": PENDING, "attempts": 0, "error": None, "updated": None})
+    entry["state"] = state
+    entry["error"] = str(error) if error is not None else None
+    entry["updated"] = now()
+    entry["until"] = until.isoformat(timespec="minutes") if state == DEFERRED and until else None
+    if state in (DONE, FAILED):
+        entry["attempts"] += 1
+        logger.info(f"[{journal['database']}] Phase {phase}: {state}")
+    save(journal)
+
+
+def state(journal: dict, phase: str) -> str:
+    return journal["phases"].get(phase, {}).get("state", PENDING)
+
+
+def is_done(journal: dict, phase: str) -> bool:
+    return state(journal, phase) == DONE
+
+
+def pending_legs(journal: dict | None) -> list:
+    """Destinations a run with a finished backup has not sent it to: deferred, or cut off before they ended."""
+    if journal is None or not is_done(journal, BACKUP):
+        return []
+    return [phase for phase, entry in journal["phases"].items()
+            if phase not in (BACKUP, CLEANUP) and entry["state"] in (PENDING, DEFERRED)]
+
+
+def deferred_until(journal: dict, phase: str) -> datetime.datetime | None:
+    """When a DEFERRED leg may be sent, or None if the leg is not deferred (or has no time)."""
+    entry = journal["phases"].get(phase, {})
+    if entry.get("state") != DEFERRED or not entry.get("until"):
+        return None
+    return datetime.datetime.fromisoformat(entry["until"])
+
+
+def still_deferred(journal: dict | None, when: datetime.datetime = None) -> list:
+    """Deferred legs of a run whose time has not come yet at 'when' (default now)."""
+    when = when or datetime.datetime.now()
+    return [leg for leg in pending_legs(journal) if (deferred_until(journal, leg) or when) > when]
+
+
+def has_pending_legs() -> bool:
+    with _lock:
+        return any(pending_legs(journal) for journal in load_all().values())
+
+
+def tracked(journal: dict, phase: str, send):
+    """Wrap a destination's send function so every attempt is recorded under 'phase'."""
+    def run(backup_file):
+        try:
+            send(backup_file)
+        except Exception as e:
+            mark(journal, phase, FAILED, e)
+            raise
+        mark(journal, phase, DONE)
+    return run
+
+
+# ===== FILES =====
+def file_record(path: str) -> dict:
+    """Size, mtime and the SHA-256 of a file if a stage already computed it (the file is not read)."""
+    stat = os.stat(path)
+    cached = digests.cached(path)
+    return {"path": path, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+            "sha256": cached["sha256"] if cached else None}
+
+
+def record_files(journal: dict, key: str, paths: list):
+    """Record the backup files ('files') or the artifacts made from them ('artifacts')."""
+    journal[key] = [file_record(p) for p in paths]
+    save(journal)
+
+
+def update_hashes(journal: dict):
+    """Add the SHA-256 of recorded files hashed since they were recorded (e.g. by the NAS copy)."""
+    for record in journal["files"] + journal["artifacts"]:
+        if record["sha256"] is None and os.path.exists(record["path"]):
+            cached = digests.cached(record["path"])
+            if cached:
+                record["sha256"] = cached["sha256"]
+    save(journal)
+
+
+def check_files(records: list) -> list | None:
+    """
+    Paths of the recorded files if every one is still there unchanged: same size, and the same
+    SHA-256 when one was recorded. None otherwise.
+    """
+    if not records:
+        return None
+    for record in records:
+        path = record["path"]
+        if not os.path.exists(path) or os.path.getsize(path) != record["size"]:
+            logger.warning(f"{path} is missing or changed size since it was journaled")
+            return None
+        if record["sha256"] and digests.get(path)["sha256"] != record["sha256"]:
+            logger.warning(f"{path} does not match the SHA-256 in the run journal")
+            return None
+    return [record["path"] for record in records]
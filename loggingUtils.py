@@ -2,23 +2,89 @@ import logging
 import logging.handlers
 import os
 import sys
+import time
+import queue
+import atexit
+import threading
 
-LOGFILE = "C:\\Users\\Servidor\\AutoBackupGynebe\\gynebeBot.log"
+# Next to the scripts, wherever the bot is installed
+LOGFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gynebeBot.log")
+
+# Third-party loggers whose DEBUG/INFO output is rate-limited
+NOISY_LOGGERS = ("googleapiclient", "google_auth_httplib2", "google.auth", "urllib3")
+NOISY_MAX_RECORDS = 5  # per logger and interval
+NOISY_INTERVAL = 60  # seconds
+
+_lock = threading.Lock()
+_listener = None
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Let through at most 'max_records' DEBUG/INFO records per 'interval' seconds for each noisy logger.
+    Warnings and errors always pass. The number of dropped records is reported when a new interval starts.
+    """
+
+    def __init__(self, prefixes=NOISY_LOGGERS, max_records=NOISY_MAX_RECORDS, interval=NOISY_INTERVAL):
+        super().__init__()
+        self.prefixes = prefixes
+        self.max_records = max_records
+        self.interval = interval
+        self.windows = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not record.name.startswith(self.prefixes):
+            return True
+
+        now = time.monotonic()
+        start, count, dropped = self.windows.get(record.name, (now, 0, 0))
+        if now - start >= self.interval:
+            if dropped:
+                record.msg = f"[{dropped} similar messages suppressed] {record.msg}"
+            start, count, dropped = now, 0, 0
+
+        if count < self.max_records:
+            self.windows[record.name] = (start, count + 1, dropped)
+            return True
+        self.windows[record.name] = (start, count, dropped + 1)
+        return False
 
 
 def log_config():
-    # Configure logger to write to a file...
+    """
+    Configure the root logger once. Records are put on a queue and written to the console and
+    the rotating log file by a background thread, so logging never blocks the caller on I/O.
+    Safe to call from every module: later calls just return the root logger.
+    """
+    global _listener
     logger = logging.getLogger('')
-    logger.setLevel(logging.DEBUG)
-    log_formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-
-    ch = logging.StreamHandler(sys.stdout)
-    ch.setFormatter(log_formatter)
-    ch.setLevel(logging.DEBUG)
-    logger.addHandler(ch)
-
-    fh = logging.handlers.RotatingFileHandler(LOGFILE, maxBytes=(1048576 * 10), backupCount=7)
-    fh.setFormatter(log_formatter)
-    fh.setLevel(logging.DEBUG)
-    logger.addHandler(fh)
+
+    with _lock:
+        if _listener is not None:
+            return logger
+
+        logger.setLevel(logging.DEBUG)
+        log_formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+        ch = logging.StreamHandler(sys.stdout)
+        ch.setFormatter(log_formatter)
+        ch.setLevel(logging.DEBUG)
+
+        fh = logging.handlers.RotatingFileHandler(LOGFILE, maxBytes=(1048576 * 10), backupCount=7)
+        fh.setFormatter(log_formatter)
+        fh.setLevel(logging.DEBUG)
+
+        log_queue = queue.SimpleQueue()
+        qh = logging.handlers.QueueHandler(log_queue)
+        qh.addFilter(RateLimitFilter())
+        logger.addHandler(qh)
+
+        _listener = logging.handlers.QueueListener(log_queue, ch, fh, respect_handler_level=True)
+        _listener.start()
+        # Flush everything still queued when the interpreter exits (including sys.exit)
+        atexit.register(_listener.stop)
+
+        # Only warns that file_cache needs oauth2client<4.0.0
+        logging.getLogger('googleapiclient.discovery_cache').setLevel(logging.ERROR)
+
     return logger
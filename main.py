@@ -1,12 +1,26 @@
 #!/usr/bin/python
+import os
 import sys
 import logging
 import backup
-import time
 import traceback
+import subprocess
 from loggingUtils import log_config
 import upload
 import send_backup
+import destinations
+import chunk_store
+import pipeline
+import metrics
+import history
+import chain
+import backup_sets
+import digests
+import storage
+import streaming
+import orchestrator
+import journal
+import forecast
 
 MAC_ADDRESS = "F4:39:09:03:72:F6"
 TARGET_NAME = "ServidorBackup"
@@ -18,69 +32,354 @@ LAST_EMAIL_KEY = 'lastSuccess'
 DIRECTORY = r"C:\Users\Servidor\Desktop\GynébeBackup"
 
 # === SQL SERVER CONFIG ===
+# Instances and databases to back up are listed in orchestrator.DATABASES_FILE;
+# without that file only this database is backed up
 SQL_SERVER = "SERVIDOR\\MW"
 SQL_DATABASE = "MWFichaClinica"
 SQL_USERNAME = "sa"
+# Run RESTORE VERIFYONLY WITH CHECKSUM alongside the transfers
+VERIFY_BACKUP = True
+# Send the backup to the backup server and Drive while SQL Server is still writing it
+# (see streaming.py). Destinations whose stream fails get the finished file as usual.
+STREAM_WHILE_BACKING_UP = False
+# Forecast the run from the history and adapt it to finish by forecast.DEADLINE (see forecast.py):
+# differential instead of full, compression, or leaving the Drive upload for "main.py resume"
+ADAPTIVE_PLAN = True
+# One-shot Task Scheduler task running "run.bat resume" for the legs the forecast deferred
+# (the daemon schedules its own resume instead)
+RESUME_TASK = "GynebeBackupResume"
+# schtasks reads /SD in the system's short date format (dd/mm/yyyy on the clinic's Portuguese Windows)
+SCHTASKS_DATE_FORMAT = "%d/%m/%Y"
 
-def main():
+# === GOOGLE DRIVE CONFIG ===
+# Upload only the changed chunks of each backup instead of the whole file
+USE_CHUNK_STORE = False
+
+# === ADDITIONAL STORAGE TARGETS ===
+# Extra destinations through storage.py, e.g. a MinIO bucket:
+#   {"name": "minio", "backend": "s3", "retries": 2,
+#    "options": {"bucket": "gynebe-backups", "endpoint_url": "http://192.168.1.20:9000"}}
+# Failures add 8 to the exit code. "policy" optionally overrides retention.POLICIES["offsite"].
+STORAGE_TARGETS = []
+
+
+def backup_server(password):
+    """The share on the backup server as a storage backend."""
+    return storage.NASBackend(TARGET_FOLDER, USERNAME, password, delta=send_backup.DELTA_COPY)
+
+
+def send_to_backup_server(backup_files, password, nas_ready=None):
+    """'nas_ready' is the future of the wake-up started before the SQL backup, if any."""
+    logger = logging.getLogger('')
+    with metrics.phase("wake_wait"):
+        ready = nas_ready is not None and nas_ready.result()
+        if not ready:
+            logger.info('Waiting for target PC to be online...')
+            ready = send_backup.wait_for_share(TARGET_NAME, MAC_ADDRESS)
+        if not ready:
+            # Fail fast instead of letting "net use" time out
+            raise ConnectionError(f"Backup server {TARGET_NAME} is not reachable")
+
+    logger.info('Copying backup file...')
+    stored = storage.send(backup_server(password), backup_files, label="nas", phase="nas_copy")
+    logger.info(f'Backup successfully copied to {", ".join(s["name"] for s in stored)}')
+
+
+def send_to_google_drive(backup_files):
+    logger = logging.getLogger('')
+    logger.info('Upload started!')
+    if USE_CHUNK_STORE:
+        service = upload.get_drive_service()
+        for backup_file in backup_files:
+            with metrics.phase("upload", os.path.getsize(backup_file)):
+                chunk_store.upload_backup(service, backup_file, os.path.basename(backup_file))
+        with metrics.phase("cleanup_drive"):
+            chunk_store.cleanup_old_backups(service)
+    else:
+        storage.send(storage.DriveBackend(), backup_files, label="drive", phase="upload")
+    logger.info('Upload finished!')
+
+
+def get_destinations(password, job=None, backup_files=None, nas_ready=None):
+    """
+    Error codes are bits of the exit code read by email_errors.ERROR_MESSAGES.
+    A Drive retry resumes the upload sessions saved by the failed attempt instead of restarting.
+    The RESTORE VERIFYONLY check runs as one more concurrent task on the job's instance; it reports
+    a failure as a backup error (4) and always checks the SQL Server backup files, not the prepared artifacts.
+    """
+    tasks = [
+        destinations.make_destination(
+            "backup server", 1, lambda f: send_to_backup_server(f, password, nas_ready), retries=2, retry_wait=60
+        ),
+        destinations.make_destination("google drive", 2, send_to_google_drive, retries=5),
+    ]
+    for target in STORAGE_TARGETS:
+        tasks.append(destinations.make_destination(
+            target["name"], 8,
+            lambda f, t=target: storage.send(
+                storage.make_backend(t["backend"], **t.get("options", {})), f, t.get("policy"), t["name"]
+            ),
+            retries=target.get("retries", 1),
+        ))
+    if VERIFY_BACKUP and job and backup_files:
+        tasks.append(destinations.make_destination(
+            "verify", 4,
+            lambda f: backup.verify_backup_checksum(job["server"], job["username"], job["password"], backup_files),
+        ))
+    return tasks
+
+
+def destination_codes():
+    """Exit code bit of every destination, by name."""
+    codes = {d["name"]: d["error_code"] for d in get_destinations(None)}
+    codes["verify"] = 4
+    return codes
+
+
+def stream_targets(password, nas_ready):
+    """Storage backends the backup is streamed to in STREAM_WHILE_BACKING_UP mode."""
+    def open_backup_server():
+        if not nas_ready.result():
+            raise ConnectionError(f"Backup server {TARGET_NAME} is not reachable")
+        return backup_server(password)
+
+    targets = {"backup server": open_backup_server}
+    if not USE_CHUNK_STORE:
+        targets["google drive"] = storage.DriveBackend
+    return targets
+
+
+def finish(result, outcomes=(), plan=None):
+    """Write the run metrics and one history record per database. Returns the error bitmask."""
+    report = metrics.write_report(result)
+    if plan is not None:
+        forecast.compare(plan, report)
+    for outcome in outcomes:
+        backup_files = (outcome["backup"] or {}).get("files")
+        entry = chain.find_entry(backup_sets.set_key(backup_files[0])) if backup_files else None
+        # Only digests a stage already computed; the backup is not read again just for the history
+        cached = digests.cached(backup_files[0]) if backup_files and os.path.exists(backup_files[0]) else None
+        history.record_run(
+            {**report, "exit_code": outcome["code"],
+             "phases": report["databases"].get(outcome["job"]["database"], {})},
+            outcome["job"]["database"], backup_files,
+            outcome["results"], backup_type=entry["type"] if entry else None,
+            sha256=cached["sha256"] if cached else None,
+        )
+    return result
+
+
+def schedule_resume(when) -> int:
+    """
+    Register a Task Scheduler task running "run.bat resume" at 'when' to send the deferred legs.
+    Returns 0, or the exit code bits of those legs if the task could not be registered, so the
+    failure is reported; the next run then sends them before its own backup.
+    """
+    logger = logging.getLogger('')
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "run.bat")
+    try:
+        # The date matters: a run started after the resume time defers to the next day
+        subprocess.run(["schtasks", "/Create", "/F", "/SC", "ONCE", "/TN", RESUME_TASK,
+                        "/SD", when.strftime(SCHTASKS_DATE_FORMAT), "/ST", f"{when:%H:%M}",
+                        "/TR", f'"{script}" resume'], check=True, capture_output=True, text=True)
+        logger.info(f"Deferred legs will be sent by the {RESUME_TASK} task at {when:%Y-%m-%d %H:%M}")
+        return 0
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.error(f"Could not schedule the resume of the deferred legs: {e}")
+        codes = destination_codes()
+        result = 0
+        for run_journal in journal.load_all().values():
+            for leg in journal.pending_legs(run_journal):
+                result |= codes.get(leg, 0)
+        return result
+
+
+def read_password():
+    """NAS account password."""
+    with open("account_password.txt", "r") as file:
+        return file.readline()
+
+
+def resume_backup(job):
+    """
+    The backup of the job's last run, if that run's journal has it done and its files are unchanged.
+    Returns the backup state for the transfers, or None when a new backup is needed. Legs the
+    forecast deferred stay deferred until the time recorded in the journal, so a resume right
+    after a failed run does not send them during the day.
+    """
+    logger = logging.getLogger('')
+    previous = journal.load(job["database"])
+    if previous is None or not journal.is_done(previous, journal.BACKUP):
+        logger.info(f"[{job['database']}] No finished backup to resume, taking a new one")
+        return None
+    backup_files = journal.check_files(previous["files"])
+    if backup_files is None:
+        logger.warning(f"[{job['database']}] The journaled backup files changed, taking a new backup")
+        return None
+    logger.info(f"[{job['database']}] Resuming the run of {previous['started']} with {', '.join(backup_files)}")
+    return {"files": backup_files, "streamed": [], "journal": previous, "defer": journal.still_deferred(previous)}
+
+
+def run_backup(resume=False):
+    """
+    Back up every configured database and send each backup to every destination. Returns the exit code bitmask.
+    Every phase is recorded in the run journal; with 'resume' a database whose last backup was made
+    only reruns the phases that did not finish, against the same backup files.
+    """
     result = 0
+    plan = None
     logger = log_config()
+    metrics.reset()
     try:
         try:
-            with open("account_password.txt", "r") as file:
-                PASSWORD = file.readline()
-            with open("database_password.txt", "r", encoding="utf-8") as file:
-                SQL_PASSWORD = file.readline().strip()
+            PASSWORD = read_password()
+            jobs = orchestrator.load_jobs(defaults={
+                "server": SQL_SERVER,
+                "username": SQL_USERNAME,
+                "password_file": "database_password.txt",
+                "backup_dir": DIRECTORY,
+                "database": SQL_DATABASE,
+            })
         except Exception as e:
             logger.error(f"Failed to read credentials file: {e}")
-            result = 5
+            result = 16
             raise Exception
 
-        backup_file = backup.backup_database(
-            server=SQL_SERVER,
-            database=SQL_DATABASE,
-            username=SQL_USERNAME,
-            password=SQL_PASSWORD,
-            backup_dir=DIRECTORY,
-        )
+        # A resumed run only finishes what is left, deferred uploads included
+        if ADAPTIVE_PLAN and not resume:
+            try:
+                plan = forecast.plan_run([job["database"] for job in jobs], allow_compression=not USE_CHUNK_STORE)
+            except Exception as e:
+                logger.error(f"Could not forecast the run, using the configured plan: {e}")
 
-        if backup_file is None:
-            result = 4
-            logger.error('No backup file!')
-            raise Exception("No backup file created.")
+        # The backup server wakes up while SQL Server writes the backups
+        nas_ready = send_backup.start_wait_for_share(TARGET_NAME, MAC_ADDRESS)
 
-        try:
-            logger.info('Waking up target PC...')
-            send_backup.wake_up_pc(MAC_ADDRESS)
+        # Error codes of sending the previous runs' unsent legs, by database
+        left_over = {}
 
-            logger.info('Waiting for target PC to be online...')
-            if not send_backup.wait_for_pc(TARGET_NAME):
-                logger.error("Target PC did not wake up!")
+        def send_left_over(job):
+            """Send the last run's backup to the destinations it has not reached yet, before its journal is replaced."""
+            previous = journal.load(job["database"])
+            legs = journal.pending_legs(previous)
+            if not legs:
+                return
+            state = resume_backup(job)
+            if state is None:
+                logger.error(f"[{job['database']}] The last backup can no longer be sent to {', '.join(legs)}")
+                codes = destination_codes()
+                left_over[job["database"]] = 0
+                for leg in legs:
+                    journal.mark(previous, leg, journal.FAILED, "Backup files changed before they were sent")
+                    left_over[job["database"]] |= codes.get(leg, 0)
+                return
+            logger.warning(f"[{job['database']}] Sending the last backup to {', '.join(legs)} before the new one")
+            # The new run replaces the journal, so nothing can stay deferred
+            left_over[job["database"]] = transfer(job, {**state, "defer": []})[0]
 
-            logger.info('Copying backup file...')
-            dest = send_backup.copy_backup(backup_file, TARGET_FOLDER, USERNAME, PASSWORD)
-            logger.info(f'Backup successfully copied to {dest}')
+        def run_job_backup(job):
+            if resume:
+                state = resume_backup(job)
+                if state is not None:
+                    return state
+            send_left_over(job)
+            run_journal = journal.start(job["database"])
 
-        except Exception as e:
-            logger.error(f"Backup failed: {e}")
-            result += 1
-            
-        try:
-            logger.info('Upload started!')
-            start = time.time()
-            service = upload.get_drive_service()
-            upload.upload_file(service, backup_file)
-            end = time.time()
-            logger.info('Upload finished!')
-            logger.info('Time taken: ' + time.strftime('%H:%M:%S', time.gmtime(int(end - start))))
-        except:
-            logger.error("File couldn't be uploaded!")
-            result += 2
-
-        sys.exit(result)
+            def run(on_files=None):
+                return backup.backup_database(
+                    server=job["server"],
+                    database=job["database"],
+                    username=job["username"],
+                    password=job["password"],
+                    backup_dir=job["backup_dir"],
+                    options=job["options"],
+                    backup_type=plan["types"].get(job["database"]) if plan else None,
+                    on_files=on_files,
+                    cleanup=False,
+                )
+
+            # The forecast's choices apply to this run only, the module settings stay as configured
+            state = {"defer": plan["defer"] if plan else [], "compression": plan["compression"] if plan else None}
+            streamed = []
+            if STREAM_WHILE_BACKING_UP:
+                targets = {name: target for name, target in stream_targets(PASSWORD, nas_ready).items()
+                           if name not in state["defer"]}
+                backup_files, streamed = streaming.backup_while_streaming(run, targets, state["compression"])
+            else:
+                backup_files = run()
+            if backup_files is None:
+                logger.error(f"[{job['database']}] No backup file!")
+                journal.mark(run_journal, journal.BACKUP, journal.FAILED, "No backup file created")
+                return None
+            journal.record_files(run_journal, "files", backup_files)
+            journal.mark(run_journal, journal.BACKUP, journal.DONE)
+            for r in streamed:
+                journal.mark(run_journal, r["name"], journal.DONE)
+            return {**state, "files": backup_files, "streamed": streamed, "journal": run_journal}
+
+        def transfer(job, state):
+            run_journal = state["journal"]
+            pending = [d for d in get_destinations(PASSWORD, job, state["files"], nas_ready)
+                       if not journal.is_done(run_journal, d["name"])]
+            if not pending and journal.is_done(run_journal, journal.CLEANUP):
+                logger.info(f"[{job['database']}] Every phase of the last run is done, nothing to resume")
+            deferred = [d for d in pending if d["name"] in state.get("defer", [])]
+            for d in deferred:
+                # Sent by "main.py resume" once 'until' has come, or before the next run replaces the journal
+                until = journal.deferred_until(run_journal, d["name"]) or forecast.resume_time()
+                logger.warning(f"[{job['database']}] {d['name']} deferred until {until:%Y-%m-%d %H:%M}")
+                journal.mark(run_journal, d["name"], journal.DEFERRED, "Deferred by the backup window forecast", until)
+            pending = [d for d in pending if d not in deferred]
+            for d in pending:
+                journal.mark(run_journal, d["name"], journal.PENDING)
+                d["send"] = journal.tracked(run_journal, d["name"], d["send"])
+
+            artifacts = state["files"]
+            if any(d["name"] != "verify" for d in pending):
+                # A resumed run sends the artifacts it already made, if they are unchanged
+                artifacts = journal.check_files(run_journal["artifacts"])
+                if artifacts is None:
+                    try:
+                        artifacts = pipeline.prepare_artifacts(state["files"], state.get("compression"))
+                        journal.record_files(run_journal, "artifacts", artifacts)
+                    except Exception as e:
+                        artifacts = state["files"]
+                        logger.error(f"Could not prepare backup artifact, sending the raw backup: {e}")
+
+            with pipeline.in_use(artifacts):
+                code, results = destinations.run_destinations(pending, artifacts)
+            journal.update_hashes(run_journal)
+
+            if not journal.is_done(run_journal, journal.CLEANUP):
+                try:
+                    with metrics.phase("cleanup_local"):
+                        backup.cleanup_old_backups(job["backup_dir"])
+                    journal.mark(run_journal, journal.CLEANUP, journal.DONE)
+                except Exception as e:
+                    logger.error(f"[{job['database']}] Error cleaning up old local backups: {e}")
+                    journal.mark(run_journal, journal.CLEANUP, journal.FAILED, e)
+            return code, state["streamed"] + results
+
+        outcomes = orchestrator.run_jobs(jobs, run_job_backup, transfer)
+        for outcome in outcomes:
+            result |= outcome["code"]
+        for code in left_over.values():
+            result |= code
+        return finish(result, outcomes, plan)
     except Exception as e:
-        logger.error("Gynébe Backup Program failed: {e}")
-        sys.exit(result)
+        logger.error(f"Gynébe Backup Program failed: {e}")
+        return finish(result)
+
+
+def main():
+    # "python main.py resume" reruns only what the last run did not finish
+    resume = sys.argv[1:2] == ["resume"]
+    result = run_backup(resume=resume)
+    # Also after a resume that left deferred legs for later (run.bat resumes a failed run right away)
+    if journal.has_pending_legs():
+        result |= schedule_resume(forecast.resume_time())
+    sys.exit(result)
+
 
 def exception_handler(t, value, tb):
     logger = logging.getLogger('')
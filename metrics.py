@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import datetime
+import threading
+import contextvars
+from contextlib import contextmanager
+from loggingUtils import log_config
+
+# === CONFIG ===
+METRICS_DIR = "metrics"
+# Point this at the node exporter's --collector.textfile.directory
+PROMETHEUS_TEXTFILE = os.path.join(METRICS_DIR, "gynebe_backup.prom")
+
+logger = log_config()
+
+_lock = threading.Lock()
+_run = {"started": time.time(), "phases": {}, "databases": {}, "active": {}}
+# Database the phases recorded in this context belong to (see database() and bind())
+_database = contextvars.ContextVar("metrics_database", default=None)
+
+
+# ===== RECORDING =====
+def reset():
+    """Start a new run record."""
+    with _lock:
+        _run["started"] = time.time()
+        _run["phases"] = {}
+        _run["databases"] = {}
+        _run["active"] = {}
+
+
+@contextmanager
+def database(name: str):
+    """
+    Also record the phases run inside the block under database 'name', so each database's history
+    only gets its own. Threads started inside must run their work through bind() to keep it.
+    """
+    token = _database.set(name)
+    try:
+        yield
+    finally:
+        _database.reset(token)
+
+
+def bind(func):
+    """Wrap 'func' to run in a copy of the caller's context, e.g. before handing it to a thread pool."""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(func, *args, **kwargs)
+
+
+def _entries(name: str) -> list:
+    """The phase entries to update: the run's, and the current database's if any. Call with _lock held."""
+    tables = [_run["phases"]]
+    if _database.get() is not None:
+        tables.append(_run["databases"].setdefault(_database.get(), {}))
+    return [table.setdefault(name, {"seconds": 0.0, "bytes": 0, "retries": 0, "ok": True, "runs": 0})
+            for table in tables]
+
+
+def record(name: str, seconds: float = 0.0, nbytes: int = 0, retries: int = 0, ok: bool = True) -> dict:
+    """Add to the totals of a phase. Phases that run several times (e.g. per stripe) accumulate."""
+    with _lock:
+        entries = _entries(name)
+        for entry in entries:
+            entry["seconds"] += seconds
+            entry["bytes"] += nbytes
+            entry["retries"] += retries
+            entry["ok"] = entry["ok"] and ok
+            entry["runs"] += 1
+        return dict(entries[0])
+
+
+def add_retry(name: str):
+    with _lock:
+        for entry in _entries(name):
+            entry["retries"] += 1
+
+
+@contextmanager
+def phase(name: str, nbytes: int = 0):
+    """
+    Time a phase. The yielded dict can be updated with the number of bytes processed:
+        with metrics.phase("nas_copy") as p:
+            p["bytes"] = copy(...)
+    """
+    info = {"bytes": nbytes}
+    start = time.time()
+    ok = False
+    with _lock:
+        _run["active"][name] = start
+    try:
+        yield info
+        ok = True
+    finally:
+        with _lock:
+            _run["active"].pop(name, None)
+        elapsed = time.time() - start
+        record(name, seconds=elapsed, nbytes=info["bytes"], ok=ok)
+        rate = info["bytes"] / 1048576 / elapsed if elapsed > 0 and info["bytes"] else 0
+        logger.debug(f"Phase {name}: {elapsed:.1f}s, {info['bytes'] / 1048576:.1f} MiB, {rate:.1f} MB/s")
+
+
+def snapshot() -> dict:
+    """
+    Copy of the current run record, with MB/s filled in for every phase and the phases still running.
+    "databases" has the phases of each database on their own.
+    """
+    with _lock:
+        phases = {name: dict(entry) for name, entry in _run["phases"].items()}
+        databases = {db: {name: dict(entry) for name, entry in table.items()}
+                     for db, table in _run["databases"].items()}
+        active = dict(_run["active"])
+        started = _run["started"]
+    for table in [phases, *databases.values()]:
+        for entry in table.values():
+            entry["mb_s"] = entry["bytes"] / 1048576 / entry["seconds"] if entry["seconds"] > 0 else 0.0
+    now = time.time()
+    return {"started": started, "phases": phases, "databases": databases,
+            "active": {name: round(now - start, 1) for name, start in active.items()}}
+
+
+# ===== REPORTS =====
+def write_report(exit_code: int) -> dict:
+    """Write the run record as JSON and as a Prometheus node-exporter textfile."""
+    report = snapshot()
+    report["finished"] = time.time()
+    report["duration"] = report["finished"] - report["started"]
+    report["exit_code"] = exit_code
+
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        stamp = datetime.datetime.fromtimestamp(report["started"]).strftime("%Y-%m-%d_%H-%M-%S")
+        with open(os.path.join(METRICS_DIR, f"run_{stamp}.json"), "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=1)
+        write_prometheus(report)
+        for name, entry in report["phases"].items():
+            logger.info(
+                f"Phase {name}: {time.strftime('%H:%M:%S', time.gmtime(int(entry['seconds'])))}, "
+                f"{entry['bytes'] / 1048576:.1f} MiB, {entry['mb_s']:.1f} MB/s, {entry['retries']} retries"
+            )
+    except Exception as e:
+        logger.error(f"Could not write run metrics: {e}")
+    return report
+
+
+def write_prometheus(report: dict):
+    lines = []
+
+    def metric(name, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in samples:
+            lines.append(f"{name}{labels} {value}")
+
+    phases = report["phases"].items()
+    metric("gynebe_backup_phase_seconds", "Wall time of each phase of the last run.",
+           [(f'{{phase="{n}"}}', round(e["seconds"], 3)) for n, e in phases])
+    metric("gynebe_backup_phase_bytes", "Bytes processed by each phase of the last run.",
+           [(f'{{phase="{n}"}}', e["bytes"]) for n, e in phases])
+    metric("gynebe_backup_phase_throughput_bytes_per_second", "Throughput of each phase of the last run.",
+           [(f'{{phase="{n}"}}', round(e["mb_s"] * 1048576)) for n, e in phases])
+    metric("gynebe_backup_phase_retries", "Retries of each phase of the last run.",
+           [(f'{{phase="{n}"}}', e["retries"]) for n, e in phases])
+    metric("gynebe_backup_phase_success", "1 if the phase succeeded in the last run.",
+           [(f'{{phase="{n}"}}', int(e["ok"])) for n, e in phases])
+    metric("gynebe_backup_last_run_timestamp_seconds", "Start time of the last run.",
+           [("", int(report["started"]))])
+    metric("gynebe_backup_last_run_duration_seconds", "Duration of the last run.",
+           [("", round(report["duration"], 3))])
+    metric("gynebe_backup_last_run_exit_code", "Exit code of the last run (0 = success).",
+           [("", report["exit_code"])])
+
+    # Write to a temporary file and rename, so the exporter never reads a partial file
+    tmp = PROMETHEUS_TEXTFILE + ".tmp"
+    with open(tmp, "w", encoding="utf-8", newline="\n") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp, PROMETHEUS_TEXTFILE)
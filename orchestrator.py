@@ -0,0 +1,94 @@
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from loggingUtils import log_config
+import metrics
+
+# === CONFIG ===
+DATABASES_FILE = "databases.json"
+# Backups running at the same time on one SQL Server instance, unless the instance sets its own
+DEFAULT_MAX_CONCURRENT = 1
+# Backup sets being sent to the destinations at the same time
+MAX_PARALLEL_TRANSFERS = 2
+
+logger = log_config()
+
+
+# ===== CONFIGURATION =====
+def load_jobs(path: str = None, defaults: dict = None) -> list:
+    """
+    One job per database listed in the databases file:
+        {"instances": [{"server": "SERVIDOR\\\\MW", "username": "sa", "password_file": "database_password.txt",
+                        "max_concurrent": 1, "backup_dir": "...", "databases": ["MWFichaClinica"]}]}
+    Missing instance settings come from 'defaults'. Without the file, 'defaults' describes the
+    single database to back up. Password files are read here, so a missing one fails the run early.
+    """
+    path = path or DATABASES_FILE
+    defaults = defaults or {}
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            instances = json.load(f)["instances"]
+    else:
+        instances = [{"databases": [defaults["database"]]}]
+
+    jobs = []
+    for instance in instances:
+        settings = {**defaults, **instance}
+        with open(settings["password_file"], "r", encoding="utf-8") as f:
+            password = f.readline().strip()
+        for database in instance["databases"]:
+            jobs.append({
+                "server": settings["server"],
+                "username": settings["username"],
+                "password": password,
+                "database": database,
+                "backup_dir": settings["backup_dir"],
+                "max_concurrent": settings.get("max_concurrent", DEFAULT_MAX_CONCURRENT),
+                "options": settings.get("options"),
+            })
+    return jobs
+
+
+# ===== ORCHESTRATION =====
+def run_jobs(jobs: list, backup, transfer, max_transfers: int = MAX_PARALLEL_TRANSFERS) -> list:
+    """
+    Back up every database, with at most 'max_concurrent' backups per instance at a time, and start
+    sending each backup as soon as it is done, while the other databases are still being backed up.
+    'backup(job)' returns the backup (e.g. its files), or None on failure.
+    'transfer(job, backup)' sends it and returns (error code bitmask, destination results).
+    Returns one outcome per job, in the order of 'jobs'.
+    """
+    limits = {}
+    for job in jobs:
+        limits.setdefault(job["server"], threading.BoundedSemaphore(job["max_concurrent"]))
+    transfers = threading.BoundedSemaphore(max_transfers)
+
+    def run_job(job):
+        outcome = {"job": job, "backup": None, "code": 0, "results": [], "seconds": 0.0}
+        start = time.time()
+        try:
+            # The phases of this job, in this thread and the ones it starts, also go to its database
+            with metrics.database(job["database"]):
+                with limits[job["server"]]:
+                    logger.info(f"[{job['database']}] Backup started on {job['server']}")
+                    outcome["backup"] = backup(job)
+                if not outcome["backup"]:
+                    outcome["code"] = 4
+                else:
+                    with transfers:
+                        outcome["code"], outcome["results"] = transfer(job, outcome["backup"])
+        except Exception as e:
+            logger.error(f"[{job['database']}] Failed: {e}", exc_info=True)
+            # A crash before the backup finished is a backup error, after it every destination failed
+            outcome["code"] |= 4 if outcome["backup"] is None else 3
+            outcome["error"] = e
+        outcome["seconds"] = time.time() - start
+        logger.info(f"[{job['database']}] Finished with code {outcome['code']} in {outcome['seconds']:.1f}s")
+        return outcome
+
+    if not jobs:
+        return []
+    with ThreadPoolExecutor(max_workers=len(jobs), thread_name_prefix="database") as pool:
+        return list(pool.map(run_job, jobs))
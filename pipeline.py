@@ -0,0 +1,321 @@
+import os
+import sys
+import lzma
+import importlib.util
+import time
+import threading
+from contextlib import contextmanager
+from loggingUtils import log_config
+import backup_sets
+import metrics
+import digests
+
+# === CONFIG ===
+COMPRESSION = None  # "zstd", "lzma" or None
+COMPRESSION_LEVEL = 3
+COMPRESSION_THREADS = -1  # zstd only, -1 uses every CPU core
+ENCRYPT = False
+ENCRYPTION_KEY_FILE = "backup_key.bin"  # 32 random bytes (AES-256)
+BUFFER_SIZE = 16 * 1024 * 1024
+MAX_ARTIFACTS = 1
+
+MAGIC = b"GYNEBE1"
+NONCE_SIZE = 12
+TAG_SIZE = 16
+
+logger = log_config()
+# Artifacts being sent by a running job, which cleanup_old_artifacts leaves alone
+_in_use = {}
+_in_use_lock = threading.Lock()
+
+
+# ===== STAGE STATISTICS =====
+def new_stats() -> dict:
+    return {}
+
+
+def account(stats: dict, stage: str, nbytes: int, seconds: float):
+    entry = stats.setdefault(stage, {"bytes": 0, "seconds": 0.0})
+    entry["bytes"] += nbytes
+    entry["seconds"] += seconds
+
+
+def log_stats(stats: dict):
+    for stage, entry in stats.items():
+        mb = entry["bytes"] / 1048576
+        rate = mb / entry["seconds"] if entry["seconds"] > 0 else 0
+        logger.info(f"Stage {stage}: {mb:.1f} MiB in {entry['seconds']:.1f}s ({rate:.1f} MB/s)")
+
+
+# ===== STAGES =====
+def read_file(path: str, stats: dict, offset: int = 0, length: int = None):
+    with open(path, "rb") as f:
+        f.seek(offset)
+        remaining = length
+        while remaining is None or remaining > 0:
+            start = time.perf_counter()
+            size = BUFFER_SIZE if remaining is None else min(BUFFER_SIZE, remaining)
+            data = f.read(size)
+            account(stats, "read", len(data), time.perf_counter() - start)
+            if not data:
+                return
+            if remaining is not None:
+                remaining -= len(data)
+            yield data
+
+
+def zstd_available() -> bool:
+    """Whether zstd compression can be used, without importing the package."""
+    return importlib.util.find_spec("zstandard") is not None
+
+
+def compress(chunks, stats: dict, method: str = None, level: int = None):
+    method = method or COMPRESSION
+    level = COMPRESSION_LEVEL if level is None else level
+    if method == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError("zstd compression requested but the 'zstandard' package is not installed") from None
+        compressor = zstandard.ZstdCompressor(level=level, threads=COMPRESSION_THREADS).compressobj()
+    elif method == "lzma":
+        compressor = lzma.LZMACompressor(preset=level)
+    else:
+        raise ValueError(f"Unknown compression method: {method}")
+
+    for chunk in chunks:
+        start = time.perf_counter()
+        out = compressor.compress(chunk)
+        account(stats, "compress", len(chunk), time.perf_counter() - start)
+        if out:
+            yield out
+    out = compressor.flush()
+    if out:
+        yield out
+
+
+def decompress(chunks, stats: dict, method: str):
+    if method == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError("The 'zstandard' package is required to read .zst backups") from None
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+    else:
+        decompressor = lzma.LZMADecompressor()
+
+    for chunk in chunks:
+        start = time.perf_counter()
+        out = decompressor.decompress(chunk)
+        account(stats, "decompress", len(out), time.perf_counter() - start)
+        if out:
+            yield out
+
+
+def read_key(key_file: str = None) -> bytes:
+    key_file = key_file or ENCRYPTION_KEY_FILE
+    with open(key_file, "rb") as f:
+        key = f.read()
+    if len(key) != 32:
+        raise ValueError(f"Encryption key in {key_file} must be 32 bytes, got {len(key)}")
+    return key
+
+
+def encrypt(chunks, stats: dict, key: bytes):
+    """AES-256-GCM. Output is MAGIC + nonce + ciphertext + tag."""
+    try:
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    except ImportError:
+        raise RuntimeError("Encryption requested but the 'cryptography' package is not installed") from None
+    nonce = os.urandom(NONCE_SIZE)
+    encryptor = Cipher(algorithms.AES(key), modes.GCM(nonce)).encryptor()
+    yield MAGIC + nonce
+    for chunk in chunks:
+        start = time.perf_counter()
+        out = encryptor.update(chunk)
+        account(stats, "encrypt", len(chunk), time.perf_counter() - start)
+        yield out
+    yield encryptor.finalize() + encryptor.tag
+
+
+def decrypt_file(path: str, stats: dict, key: bytes):
+    """Stream the plaintext of a file written by encrypt(). Authentication is checked at the end."""
+    try:
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    except ImportError:
+        raise RuntimeError("The 'cryptography' package is required to read encrypted backups") from None
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        header = f.read(len(MAGIC) + NONCE_SIZE)
+        if not header.startswith(MAGIC):
+            raise ValueError(f"{path} is not an encrypted Gynébe backup")
+        f.seek(size - TAG_SIZE)
+        tag = f.read(TAG_SIZE)
+
+    decryptor = Cipher(algorithms.AES(key), modes.GCM(header[len(MAGIC):], tag)).decryptor()
+    body_length = size - len(header) - TAG_SIZE
+    for chunk in read_file(path, stats, offset=len(header), length=body_length):
+        start = time.perf_counter()
+        out = decryptor.update(chunk)
+        account(stats, "decrypt", len(chunk), time.perf_counter() - start)
+        yield out
+    yield decryptor.finalize()
+
+
+def write_file(chunks, path: str, stats: dict, hashers: dict = None) -> str:
+    """Write the stream to 'path'. With 'hashers', the written bytes are hashed and registered in digests."""
+    tmp = path + ".part"
+    with open(tmp, "wb") as f:
+        for chunk in chunks:
+            start = time.perf_counter()
+            f.write(chunk)
+            if hashers is not None:
+                digests.update(hashers, chunk)
+            account(stats, "write", len(chunk), time.perf_counter() - start)
+    os.replace(tmp, path)
+    if hashers is not None:
+        digests.register(path, digests.hexdigests(hashers))
+    return path
+
+
+# ===== ARTIFACTS =====
+# 'compression' overrides COMPRESSION for one run (e.g. the forecast's choice); None uses the configured one
+def is_enabled(compression: str = None) -> bool:
+    return bool(compression or COMPRESSION) or ENCRYPT
+
+
+def artifact_path(backup_file: str, compression: str = None) -> str:
+    path = backup_file
+    method = compression or COMPRESSION
+    if method == "zstd":
+        path += ".zst"
+    elif method == "lzma":
+        path += ".xz"
+    if ENCRYPT:
+        path += ".enc"
+    return path
+
+
+def transform(chunks, stats: dict, compression: str = None):
+    """Apply the configured compression and encryption stages to a stream of chunks."""
+    if compression or COMPRESSION:
+        chunks = compress(chunks, stats, compression)
+    if ENCRYPT:
+        chunks = encrypt(chunks, stats, read_key())
+    return chunks
+
+
+def prepare_artifact(backup_file: str, compression: str = None) -> str:
+    """
+    Read the backup once and write a single compressed and/or encrypted artifact next to it.
+    Every destination then sends that artifact instead of the raw .bak.
+    """
+    if not is_enabled(compression):
+        return backup_file
+
+    stats = new_stats()
+    output = artifact_path(backup_file, compression)
+    logger.info(f"Preparing backup artifact: {output}")
+    start = time.time()
+
+    chunks = transform(read_file(backup_file, stats), stats, compression)
+    # Hash the artifact while writing it so no destination has to read it again to check it
+    write_file(chunks, output, stats, digests.new_hashers())
+
+    original = os.path.getsize(backup_file)
+    result = os.path.getsize(output)
+    elapsed = time.time() - start
+    logger.info(
+        f"Artifact ready: {original / 1048576:.1f} MiB -> {result / 1048576:.1f} MiB "
+        f"(ratio {original / max(result, 1):.1f}x) in {elapsed:.1f}s "
+        f"({original / 1048576 / max(elapsed, 1e-6):.1f} MB/s)"
+    )
+    log_stats(stats)
+    return output
+
+
+def restore_artifact(artifact: str, output: str) -> str:
+    """Turn an artifact back into the original .bak, undoing encryption and compression."""
+    stats = new_stats()
+    name = artifact
+    if name.endswith(".enc"):
+        chunks = decrypt_file(artifact, stats, read_key())
+        name = name[:-len(".enc")]
+    else:
+        chunks = read_file(artifact, stats)
+
+    if name.endswith(".zst"):
+        chunks = decompress(chunks, stats, "zstd")
+    elif name.endswith(".xz"):
+        chunks = decompress(chunks, stats, "lzma")
+
+    write_file(chunks, output, stats)
+    log_stats(stats)
+    logger.info(f"Restored {artifact} to {output}")
+    return output
+
+
+def prepare_artifacts(backup_files: list, compression: str = None) -> list:
+    """Prepare one artifact per file of a backup set, then drop the artifacts of the database's older sets."""
+    if not is_enabled(compression):
+        # The backup files are sent as they are; no phase, or the forecast would learn an instant rate
+        return list(backup_files)
+    with metrics.phase("artifact", sum(os.path.getsize(f) for f in backup_files)):
+        artifacts = [prepare_artifact(f, compression) for f in backup_files]
+    cleanup_old_artifacts(os.path.dirname(artifacts[0]) or ".", database=backup_sets.database_name(artifacts[0]))
+    return artifacts
+
+
+@contextmanager
+def in_use(artifacts: list):
+    """Keep the artifacts of a job from being cleaned up by the other jobs while it sends them."""
+    paths = [os.path.abspath(a) for a in artifacts]
+    with _in_use_lock:
+        for path in paths:
+            _in_use[path] = _in_use.get(path, 0) + 1
+    try:
+        yield
+    finally:
+        with _in_use_lock:
+            for path in paths:
+                _in_use[path] -= 1
+                if not _in_use[path]:
+                    del _in_use[path]
+
+
+def cleanup_old_artifacts(folder: str, max_artifacts: int = None, database: str = None):
+    """
+    Keep only the latest 'max_artifacts' sets of compressed/encrypted artifacts of every database,
+    or only of 'database'. Artifacts a running job is sending are never deleted.
+    """
+    artifacts = sorted(
+        [os.path.join(folder, f) for f in os.listdir(folder)
+         if ".bak." in f and not f.endswith(".part")
+         and (database is None or backup_sets.database_name(f) == database)],
+        key=os.path.getmtime,
+        reverse=True,
+    )
+    by_database = {}
+    for artifact_set in backup_sets.group_sets(artifacts).values():
+        by_database.setdefault(backup_sets.database_name(artifact_set[0]), []).append(artifact_set)
+    keep = MAX_ARTIFACTS if max_artifacts is None else max_artifacts
+    for sets in by_database.values():
+        for old_set in sets[keep:]:
+            with _in_use_lock:
+                if any(os.path.abspath(f) in _in_use for f in old_set):
+                    logger.info(f"Keeping {', '.join(old_set)}: still being sent")
+                    continue
+                for old_file in old_set:
+                    try:
+                        os.remove(old_file)
+                        logger.info(f"Deleted old artifact: {old_file}")
+                    except Exception as e:
+                        logger.warning(f"Could not delete {old_file}: {e}")
+
+
+if __name__ == "__main__":
+    # Usage: python pipeline.py restore <artifact> <output .bak>
+    if len(sys.argv) != 4 or sys.argv[1] != "restore":
+        print("Usage: python pipeline.py restore <artifact> <output>")
+        sys.exit(1)
+    restore_artifact(sys.argv[2], sys.argv[3])
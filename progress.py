@@ -0,0 +1,36 @@
+import time
+import threading
+from loggingUtils import log_config
+
+logger = log_config()
+
+_subscribers = []
+_lock = threading.Lock()
+
+
+# ===== PROGRESS EVENTS =====
+# An event is a dict: {"stage": "backup", "percent": 40, "time": <epoch>, ...extra details}
+def subscribe(callback):
+    """Call 'callback(event)' for every progress event. Returns the callback so it can be unsubscribed."""
+    with _lock:
+        _subscribers.append(callback)
+    return callback
+
+
+def unsubscribe(callback):
+    with _lock:
+        if callback in _subscribers:
+            _subscribers.remove(callback)
+
+
+def publish(stage: str, percent: float = None, **details) -> dict:
+    """Send a progress event to every subscriber. A failing subscriber never breaks the stage."""
+    event = {"stage": stage, "percent": percent, "time": time.time(), **details}
+    with _lock:
+        subscribers = list(_subscribers)
+    for callback in subscribers:
+        try:
+            callback(event)
+        except Exception as e:
+            logger.warning(f"Progress subscriber {callback!r} failed: {e}")
+    return event
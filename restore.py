@@ -0,0 +1,382 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from loggingUtils import log_config
+import backup_sets
+import chain
+import digests
+import history
+import pipeline
+import storage
+
+# === CONFIG ===
+RESTORE_DIR = "restore"
+# Drive downloads: RANGE_WORKERS concurrent HTTP Range requests of RANGE_SIZE bytes.
+# Each request is held in memory until written, so the peak is about RANGE_SIZE * RANGE_WORKERS.
+RANGE_SIZE = 16 * 1024 * 1024
+RANGE_WORKERS = 8
+RANGE_RETRIES = 4
+DOWNLOAD_URL = "https://www.googleapis.com/drive/v3/files/{file_id}?alt=media&supportsAllDrives=true"
+# Seconds to wait for the backup server to wake up before restoring from the other sources
+WAKE_TIMEOUT = 180
+PROGRESS_INTERVAL = 5  # log every N percent
+
+logger = log_config()
+
+
+# ===== RANGED DOWNLOAD =====
+def load_download_state(state_file: str, url: str, size: int) -> set:
+    """Start offsets of the ranges already written by an interrupted download of the same object."""
+    if not os.path.exists(state_file):
+        return set()
+    try:
+        with open(state_file, "r", encoding="utf-8") as f:
+            state = json.load(f)
+    except ValueError:
+        return set()
+    if state.get("url") != url or state.get("size") != size:
+        return set()
+    return set(state["done"])
+
+
+def save_download_state(state_file: str, url: str, size: int, done: set):
+    tmp = state_file + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"url": url, "size": size, "done": sorted(done)}, f)
+    os.replace(tmp, state_file)
+
+
+def download_ranges(http_factory, url: str, size: int, path: str,
+                    range_size: int = RANGE_SIZE, workers: int = RANGE_WORKERS) -> dict:
+    """
+    Download 'url' into 'path' with concurrent HTTP Range requests. The file is preallocated at its
+    final size and every range is written at its offset as it arrives. Finished ranges are saved
+    next to it, so running this again after an interruption only fetches the missing ranges.
+    'http_factory()' returns an httplib2-compatible object; each worker thread gets its own.
+    The caller checks the digests of the result: a range recorded but lost in a crash shows up there.
+    Returns {"bytes", "seconds", "mb_s"} for the bytes downloaded by this call.
+    """
+    tmp = path + ".part"
+    state_file = tmp + ".json"
+    done = load_download_state(state_file, url, size)
+    if not os.path.exists(tmp) or os.path.getsize(tmp) != size:
+        done = set()
+        free = shutil.disk_usage(os.path.dirname(os.path.abspath(path))).free
+        if free < size:
+            raise OSError(f"Not enough disk space for {os.path.basename(path)}: "
+                          f"{size / 1048576:.0f} MiB needed, {free / 1048576:.0f} MiB free")
+        with open(tmp, "wb") as f:
+            f.truncate(size)
+    elif done:
+        logger.info(f"Resuming download of {os.path.basename(path)}: "
+                    f"{len(done)} of {-(-size // range_size)} ranges already downloaded")
+
+    pending = [start for start in range(0, size, range_size) if start not in done]
+    local = threading.local()
+    lock = threading.Lock()
+    downloaded = 0
+    last_progress = -PROGRESS_INTERVAL
+    start_time = time.time()
+
+    def fetch(start):
+        nonlocal downloaded, last_progress
+        end = min(start + range_size, size) - 1
+        for attempt in range(RANGE_RETRIES):
+            try:
+                if getattr(local, "http", None) is None:
+                    local.http = http_factory()
+                resp, content = local.http.request(url, "GET", headers={"Range": f"bytes={start}-{end}"})
+                if resp.status not in (200, 206) or (resp.status == 200 and (start, end) != (0, size - 1)):
+                    raise ConnectionError(f"HTTP {resp.status} for bytes {start}-{end}")
+                if len(content) != end - start + 1:
+                    raise ConnectionError(f"Got {len(content)} bytes for bytes {start}-{end}")
+                break
+            except Exception as e:
+                if attempt == RANGE_RETRIES - 1:
+                    raise
+                logger.warning(f"Range {start}-{end} failed ({e}), retrying")
+                local.http = None
+                time.sleep(2 ** attempt)
+
+        with open(tmp, "r+b") as f:
+            f.seek(start)
+            f.write(content)
+        with lock:
+            done.add(start)
+            save_download_state(state_file, url, size, done)
+            downloaded += len(content)
+            progress = int(len(done) * range_size * 100 / size) if size else 100
+            if progress >= last_progress + PROGRESS_INTERVAL:
+                elapsed = time.time() - start_time
+                logger.info(f"Progress: {min(progress, 100)}% ({downloaded / 1048576 / max(elapsed, 1e-6):.1f} MB/s)")
+                last_progress = progress
+
+    if pending:
+        with ThreadPoolExecutor(max_workers=min(workers, len(pending)), thread_name_prefix="range") as pool:
+            list(pool.map(fetch, pending))
+
+    os.replace(tmp, path)
+    if os.path.exists(state_file):
+        os.remove(state_file)
+    elapsed = time.time() - start_time
+    stats = {"bytes": downloaded, "seconds": elapsed, "mb_s": downloaded / 1048576 / max(elapsed, 1e-6)}
+    logger.info(f"Downloaded {downloaded / 1048576:.1f} MiB to {path} in {elapsed:.1f}s ({stats['mb_s']:.1f} MB/s)")
+    return stats
+
+
+# ===== SOURCES =====
+def open_sources(password: str = None, nas_ready=None) -> dict:
+    """
+    Source name -> function returning its storage backend, in order of preference: the local backup
+    folder, the backup server, the additional storage targets, then Drive.
+    'nas_ready' is the future of the backup server wake-up (see send_backup.start_wait_for_share).
+    """
+    import main
+
+    def backup_server():
+        if nas_ready is not None and not nas_ready.result():
+            raise ConnectionError(f"Backup server {main.TARGET_NAME} is not reachable")
+        return storage.NASBackend(main.TARGET_FOLDER, main.USERNAME, password)
+
+    sources = {"local": lambda: storage.LocalBackend(main.DIRECTORY), "backup server": backup_server}
+    for target in main.STORAGE_TARGETS:
+        sources[target["name"]] = lambda t=target: storage.make_backend(t["backend"], **t.get("options", {}))
+    if not main.USE_CHUNK_STORE:
+        sources["google drive"] = storage.DriveBackend
+    return sources
+
+
+def list_backups(sources: dict) -> tuple:
+    """
+    Every backup set found on the sources, listed concurrently. Sources that cannot be reached
+    are logged and left out. Returns (backends by source name,
+    {backup key: {"key", "database", "time", "copies": {source: [items]}}} newest first).
+    """
+    def open_and_list(name):
+        backend = sources[name]()
+        return backend, backend.list()
+
+    with ThreadPoolExecutor(max_workers=len(sources), thread_name_prefix="list") as pool:
+        futures = {name: pool.submit(open_and_list, name) for name in sources}
+
+    backends = {}
+    catalog = {}
+    for name, future in futures.items():
+        try:
+            backend, items = future.result()
+        except Exception as e:
+            logger.warning(f"[{name}] Not available: {e}")
+            continue
+        backends[name] = backend
+        for key, group in backup_sets.group_sets(items, key=lambda item: item["name"], by=backup_sets.backup_key).items():
+            entry = catalog.setdefault(key, {"key": key, "database": backup_sets.database_name(key),
+                                             "time": max(item["time"] for item in group), "copies": {}})
+            entry["copies"][name] = group
+    return backends, dict(sorted(catalog.items(), key=lambda kv: kv[1]["time"], reverse=True))
+
+
+def select_files(items: list) -> list | None:
+    """
+    Files to fetch for one copy of a backup set: one per stripe, the raw .bak before an artifact.
+    None when a stripe is missing.
+    """
+    stripes = {}
+    count = 1
+    # Raw .bak names are shorter than their artifacts' names
+    for item in sorted(items, key=lambda item: len(item["name"])):
+        match = backup_sets.STRIPE_PATTERN.search(item["name"])
+        index, count = (int(match.group(1)), int(match.group(2))) if match else (1, 1)
+        stripes.setdefault(index, item)
+    if set(stripes) != set(range(1, count + 1)):
+        return None
+    return [stripes[i] for i in sorted(stripes)]
+
+
+def restore_chain(catalog: dict, key: str) -> list:
+    """Backup set keys needed to restore 'key', oldest first (the full backup, then the rest)."""
+    entries = chain.load_index()
+    if any(e["key"] == key for e in entries):
+        needed = chain.dependencies(entries, key)
+    elif key.endswith("_diff.bak"):
+        # Not in this machine's chain index (e.g. restoring on a new server): the newest full before it
+        database, taken = catalog[key]["database"], catalog[key]["time"]
+        fulls = [k for k, e in catalog.items() if e["database"] == database and e["time"] < taken
+                 and not k.endswith(("_diff.bak", "_log.bak"))]
+        needed = set(fulls[:1])
+    else:
+        needed = set()
+    missing = [k for k in needed if k not in catalog]
+    if missing:
+        raise FileNotFoundError(f"{key} needs {', '.join(missing)}, which is on none of the sources")
+    return sorted(needed | {key}, key=lambda k: catalog[k]["time"])
+
+
+# ===== VERIFICATION =====
+def reference_digests(name: str, entry: dict) -> dict:
+    """Digests of a file known without downloading it: Drive's checksums, else the run history."""
+    reference = {}
+    for items in entry["copies"].values():
+        for item in items:
+            if item["name"] == name:
+                if item.get("sha256Checksum"):
+                    reference["sha256"] = item["sha256Checksum"]
+                if item.get("md5Checksum"):
+                    reference["md5"] = item["md5Checksum"]
+    if "sha256" not in reference:
+        recorded = history.recorded_sha256(name)
+        if recorded:
+            reference["sha256"] = recorded
+    return reference
+
+
+def check_digests(name: str, fetched: dict, reference: dict):
+    """Raise IOError when the fetched file does not match its reference digests."""
+    if not reference:
+        logger.warning(f"No reference hash known for {name}; only the transfer itself was checked")
+        return
+    for algorithm, expected in reference.items():
+        if fetched.get(algorithm) and fetched[algorithm] != expected:
+            raise IOError(f"{algorithm} mismatch for {name} (expected {expected}, got {fetched[algorithm]})")
+    logger.info(f"{name}: {', '.join(reference)} verified")
+
+
+# ===== FETCH =====
+def fetch_file(backend: storage.Backend, item: dict, entry: dict, dest_dir: str) -> str:
+    """Fetch and verify one file of a backup set; artifacts are turned back into the .bak. Returns its path."""
+    name = item["name"]
+    reference = reference_digests(name, entry)
+    if backend.name == "local":
+        # Already on this machine: verified and handed over where it is
+        path = backend.path(name)
+        fetched = {"name": name, "size": os.path.getsize(path), **digests.get(path)}
+    else:
+        path = os.path.join(dest_dir, name)
+        if os.path.exists(path) and os.path.getsize(path) == item["size"] and reference:
+            fetched = {"name": name, "size": item["size"], **digests.get(path)}
+            logger.info(f"{name} was already fetched")
+        else:
+            fetched = backend.get(name, path)
+    if fetched["size"] != item["size"]:
+        raise IOError(f"{name} is {fetched['size']} bytes, expected {item['size']}")
+    try:
+        check_digests(name, fetched, reference)
+    except IOError:
+        if backend.name != "local":
+            os.remove(path)
+        raise
+
+    bak_name = backup_sets.ARTIFACT_SUFFIX.sub("", name)
+    if bak_name == name:
+        return path
+    bak = os.path.join(dest_dir, bak_name)
+    pipeline.restore_artifact(path, bak)
+    if backend.name != "local":
+        os.remove(path)
+    recorded = history.recorded_sha256(bak_name)
+    if recorded:
+        check_digests(bak_name, digests.get(bak), {"sha256": recorded})
+    return bak
+
+
+def fetch_set(entry: dict, backends: dict, dest_dir: str) -> list:
+    """
+    Fetch every file of a backup set from the first source (in order of preference) holding a
+    complete copy; a copy failing its checks moves on to the next source. Returns the .bak paths.
+    """
+    for source, backend in backends.items():
+        files = select_files(entry["copies"].get(source, []))
+        if not files:
+            continue
+        logger.info(f"Fetching {entry['key']} from {source}")
+        start = time.time()
+        try:
+            paths = [fetch_file(backend, item, entry, dest_dir) for item in files]
+        except Exception as e:
+            logger.error(f"[{source}] Could not fetch {entry['key']}: {e}")
+            continue
+        logger.info(f"{entry['key']} ready in {time.time() - start:.1f}s")
+        return paths
+    raise IOError(f"No complete, intact copy of {entry['key']} could be fetched")
+
+
+def restore_sql(database: str, sets: list) -> str:
+    """RESTORE statements for the fetched sets, oldest first; only the last one recovers the database."""
+    statements = []
+    for i, paths in enumerate(sets):
+        disks = ", ".join(f"DISK = N'{os.path.abspath(p)}'" for p in paths)
+        command = "RESTORE LOG" if backup_sets.set_key(paths[0]).endswith("_log.bak") else "RESTORE DATABASE"
+        options = ["CHECKSUM", "STATS = 10", "RECOVERY" if i == len(sets) - 1 else "NORECOVERY"]
+        if i == 0:
+            options.insert(0, "REPLACE")
+        statements.append(f"{command} [{database}] FROM {disks} WITH {', '.join(options)};")
+    return "\n".join(statements)
+
+
+def fetch_backup(sources: dict, key: str = None, database: str = None, dest_dir: str = RESTORE_DIR) -> dict:
+    """
+    Fetch the newest backup (of 'database', or the set 'key') and everything it depends on.
+    Returns {"database", "sets": [[.bak paths]] oldest first, "sql": RESTORE statements}.
+    """
+    backends, catalog = list_backups(sources)
+    if key is None:
+        candidates = [k for k, e in catalog.items() if database is None or e["database"] == database]
+        if not candidates:
+            raise FileNotFoundError("No backups found on any source")
+        key = candidates[0]
+    key = backup_sets.backup_key(key)
+    if key not in catalog:
+        raise FileNotFoundError(f"{key} is on none of the sources")
+
+    os.makedirs(dest_dir, exist_ok=True)
+    sets = [fetch_set(catalog[k], backends, dest_dir) for k in restore_chain(catalog, key)]
+    database = catalog[key]["database"]
+    return {"database": database, "sets": sets, "sql": restore_sql(database, sets)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="List and fetch Gynébe backups for a restore.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    lister = commands.add_parser("list", help="backups available on every source")
+    lister.add_argument("--database")
+    fetcher = commands.add_parser("fetch", help="fetch and verify a backup (the newest by default)")
+    fetcher.add_argument("key", nargs="?", help="backup file name, e.g. MWFichaClinica_17-10-2026_01-00.bak")
+    fetcher.add_argument("--database")
+    fetcher.add_argument("--dest", default=RESTORE_DIR)
+    for command in (lister, fetcher):
+        command.add_argument("--source", action="append", help="only use these sources (repeatable)")
+    args = parser.parse_args(argv)
+
+    import main as config
+    import send_backup
+    try:
+        password = config.read_password()
+    except OSError:
+        password = None
+    nas_ready = send_backup.start_wait_for_share(config.TARGET_NAME, config.MAC_ADDRESS, WAKE_TIMEOUT)
+    sources = open_sources(password, nas_ready)
+    if args.source:
+        sources = {name: sources[name] for name in sources if name in args.source}
+
+    if args.command == "list":
+        _, catalog = list_backups(sources)
+        for entry in catalog.values():
+            if args.database and entry["database"] != args.database:
+                continue
+            copies = ", ".join(f"{source}{'' if select_files(items) else ' (incomplete)'}"
+                               for source, items in entry["copies"].items())
+            print(f"{entry['time']:%Y-%m-%d %H:%M}\t{entry['key']}\t{copies}")
+        return
+
+    result = fetch_backup(sources, args.key, args.database, args.dest)
+    for paths in result["sets"]:
+        print("\n".join(paths))
+    print(result["sql"])
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
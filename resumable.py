@@ -0,0 +1,296 @@
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from loggingUtils import log_config
+import digests
+import throttle
+
+# === CONFIG ===
+UPLOAD_URL = "https://www.googleapis.com/upload/drive/v3/files"
+SESSION_FILE = "upload_sessions.json"
+RESPONSE_FIELDS = "id,name,size,md5Checksum,sha256Checksum"
+
+# Drive requires chunks to be multiples of 256 KiB (except the last one)
+CHUNK_ALIGN = 256 * 1024
+INITIAL_CHUNK = 8 * 1024 * 1024
+MIN_CHUNK = 1 * 1024 * 1024
+MAX_CHUNK = 128 * 1024 * 1024
+TARGET_CHUNK_SECONDS = 10
+MAX_STREAMS = 4
+# 308 answers in a row that do not move the confirmed offset before an upload gives up
+MAX_STALLED_CHUNKS = 5
+
+logger = log_config()
+_sessions_lock = threading.Lock()
+
+
+# ===== SESSION STATE =====
+def session_key(file_path: str) -> str:
+    stat = os.stat(file_path)
+    return f"{os.path.abspath(file_path)}|{stat.st_size}|{int(stat.st_mtime)}"
+
+
+def load_sessions() -> dict:
+    if not os.path.exists(SESSION_FILE):
+        return {}
+    try:
+        with open(SESSION_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except ValueError:
+        logger.warning(f"Ignoring unreadable upload session file {SESSION_FILE}")
+        return {}
+
+
+def update_session(key: str, session: dict | None):
+    """Persist (or forget, when 'session' is None) the resumable session of one file."""
+    with _sessions_lock:
+        sessions = load_sessions()
+        if session is None:
+            sessions.pop(key, None)
+        else:
+            sessions[key] = session
+        tmp = SESSION_FILE + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(sessions, f, indent=1)
+        os.replace(tmp, SESSION_FILE)
+
+
+# ===== PROTOCOL =====
+def next_chunk_size(chunk_size: int, sent: int, seconds: float) -> int:
+    """Size the next chunk so it takes about TARGET_CHUNK_SECONDS at the measured throughput."""
+    if seconds <= 0:
+        return chunk_size
+    target = int(sent / seconds * TARGET_CHUNK_SECONDS)
+    target = max(MIN_CHUNK, min(MAX_CHUNK, target))
+    return max(CHUNK_ALIGN, target // CHUNK_ALIGN * CHUNK_ALIGN)
+
+
+def capped_chunk_size(chunk_size: int, limiter) -> int:
+    """
+    Keep a chunk within the limiter's burst while a capped window is active. The chunk is timed
+    after limiter.acquire(), so next_chunk_size() learns the full link speed and a chunk sized from
+    it would go out in one burst at that speed.
+    """
+    rate = limiter.rate()
+    if not rate:
+        return chunk_size
+    cap = int(rate * limiter.burst_seconds) // CHUNK_ALIGN * CHUNK_ALIGN
+    return max(CHUNK_ALIGN, min(chunk_size, cap))
+
+
+def confirmed_offset(resp) -> int:
+    """Offset after the last byte the server has, from the Range header of a 308 response."""
+    range_header = resp.get("range")
+    if not range_header:
+        return 0
+    return int(range_header.rsplit("-", 1)[1]) + 1
+
+
+def start_session(http, name: str, parents: list, size: int | None, url: str) -> str:
+    """Open a resumable session. 'size' is None for streams whose length is not known yet."""
+    body = json.dumps({"name": name, "parents": parents})
+    headers = {
+        "Content-Type": "application/json; charset=UTF-8",
+        "X-Upload-Content-Type": "application/octet-stream",
+    }
+    if size is not None:
+        headers["X-Upload-Content-Length"] = str(size)
+    resp, content = http.request(
+        f"{url}?uploadType=resumable&supportsAllDrives=true&fields={RESPONSE_FIELDS}",
+        "POST",
+        body=body,
+        headers=headers,
+    )
+    if resp.status != 200 or "location" not in resp:
+        raise ConnectionError(f"Could not start resumable upload of {name}: HTTP {resp.status} {content[:200]!r}")
+    return resp["location"]
+
+
+def query_session(http, session_uri: str, size: int):
+    """
+    Ask the server how much of an existing session it has.
+    Returns (offset, None), (size, response) when already finished, or (None, None) when expired.
+    """
+    resp, content = http.request(
+        session_uri, "PUT", body=b"", headers={"Content-Length": "0", "Content-Range": f"bytes */{size}"}
+    )
+    if resp.status in (200, 201):
+        return size, json.loads(content)
+    if resp.status == 308:
+        return confirmed_offset(resp), None
+    if resp.status in (404, 410):
+        return None, None
+    raise ConnectionError(f"Could not query upload session: HTTP {resp.status}")
+
+
+# ===== UPLOAD =====
+def upload_resumable(http, file_path: str, name: str, parents: list, url: str = None) -> dict:
+    """
+    Upload a file through a Drive resumable session.
+    The session URI and confirmed offset are saved after every chunk, so calling this again
+    after a failure (or in a new process) continues from the last confirmed byte.
+    'http' is an httplib2-compatible object (e.g. google_auth_httplib2.AuthorizedHttp).
+    When the whole file is sent in this call, its digests are computed from the bytes sent and
+    shared with the other stages through the digests module.
+    Returns the Drive file resource.
+    """
+    url = url or UPLOAD_URL
+    size = os.path.getsize(file_path)
+    key = session_key(file_path)
+    session = load_sessions().get(key)
+    offset = 0
+
+    if session:
+        offset, response = query_session(http, session["session_uri"], size)
+        if response is not None:
+            update_session(key, None)
+            logger.info(f"Uploaded {name} successfully (finished in a previous attempt)!")
+            return response
+        if offset is None:
+            logger.warning(f"Upload session for {name} expired, starting again")
+            session = None
+        else:
+            logger.info(f"Resuming upload of {name} at {offset / 1048576:.1f} MiB of {size / 1048576:.1f} MiB")
+
+    if not session:
+        session = {"session_uri": start_session(http, name, parents, size, url), "chunk_size": INITIAL_CHUNK}
+        offset = 0
+    session["offset"] = offset
+    update_session(key, session)
+
+    chunk_size = session["chunk_size"]
+    limiter = throttle.get_limiter("upload")
+    hashers = digests.new_hashers() if offset == 0 else None
+    last_progress = -1
+    stalled = 0
+    start = time.time()
+    first_offset = offset
+
+    with open(file_path, "rb") as f:
+        while True:
+            f.seek(offset)
+            data = f.read(capped_chunk_size(chunk_size, limiter))
+            end = offset + len(data) - 1
+            content_range = f"bytes {offset}-{end}/{size}" if data else f"bytes */{size}"
+
+            limiter.acquire(len(data))
+            chunk_start = time.time()
+            resp, content = http.request(
+                session["session_uri"], "PUT", body=data,
+                headers={"Content-Length": str(len(data)), "Content-Range": content_range},
+            )
+            elapsed = time.time() - chunk_start
+
+            if resp.status in (200, 201):
+                update_session(key, None)
+                if hashers is not None:
+                    digests.update(hashers, data)
+                    digests.register(file_path, digests.hexdigests(hashers))
+                total = time.time() - start
+                rate = (size - first_offset) / 1048576 / total if total > 0 else 0
+                logger.info(f"Uploaded {name} successfully! ({rate:.2f} MB/s)")
+                return json.loads(content)
+
+            if resp.status != 308:
+                raise ConnectionError(f"Upload of {name} failed at byte {offset}: HTTP {resp.status}")
+
+            new_offset = confirmed_offset(resp)
+            stalled = stalled + 1 if new_offset <= offset else 0
+            if stalled >= MAX_STALLED_CHUNKS:
+                raise ConnectionError(f"Upload of {name} made no progress at byte {offset} in {stalled} attempts")
+            if hashers is not None and new_offset >= offset:
+                digests.update(hashers, memoryview(data)[:new_offset - offset])
+            else:
+                hashers = None
+            chunk_size = next_chunk_size(chunk_size, new_offset - offset, elapsed)
+            offset = new_offset
+            session.update(offset=offset, chunk_size=chunk_size)
+            update_session(key, session)
+
+            progress = int(offset * 100 / size) if size else 100
+            if progress > last_progress:
+                logger.info(f"Progress {name}: {progress}% (chunk {chunk_size // 1048576} MiB)")
+                last_progress = progress
+
+
+def upload_stream(http, chunks, name: str, parents: list, url: str = None) -> dict:
+    """
+    Upload a stream of unknown length (e.g. the output of the pipeline stages) through a resumable
+    session, sending aligned chunks as they fill up. Unlike upload_resumable the session is not
+    persisted, since the stream cannot be replayed. The MD5 reported by Drive is checked against
+    the bytes sent. Returns the Drive file resource.
+    """
+    url = url or UPLOAD_URL
+    session_uri = start_session(http, name, parents, None, url)
+    hashers = digests.new_hashers()
+    buffer = bytearray()
+    offset = 0
+    chunk_size = INITIAL_CHUNK
+    limiter = throttle.get_limiter("upload")
+    stalled = 0
+    start = time.time()
+
+    def send(length: int, final: bool):
+        nonlocal offset, chunk_size, buffer, stalled
+        total = str(offset + len(buffer)) if final else "*"
+        content_range = f"bytes {offset}-{offset + length - 1}/{total}" if length else f"bytes */{total}"
+        limiter.acquire(length)
+        chunk_start = time.time()
+        resp, content = http.request(
+            session_uri, "PUT", body=bytes(buffer[:length]),
+            headers={"Content-Length": str(length), "Content-Range": content_range},
+        )
+        if resp.status in (200, 201):
+            return json.loads(content)
+        if resp.status != 308:
+            raise ConnectionError(f"Upload of {name} failed at byte {offset}: HTTP {resp.status}")
+        # The server may keep only part of the chunk; the rest stays in the buffer and is sent again
+        confirmed = confirmed_offset(resp)
+        if confirmed < offset:
+            raise ConnectionError(f"Upload of {name} went back from byte {offset} to {confirmed}, the stream cannot be replayed")
+        stalled = stalled + 1 if confirmed == offset else 0
+        if stalled >= MAX_STALLED_CHUNKS:
+            raise ConnectionError(f"Upload of {name} made no progress at byte {offset} in {stalled} attempts")
+        del buffer[:confirmed - offset]
+        chunk_size = next_chunk_size(chunk_size, confirmed - offset, time.time() - chunk_start)
+        offset = confirmed
+        return None
+
+    for chunk in chunks:
+        digests.update(hashers, chunk)
+        buffer += chunk
+        while True:
+            length = capped_chunk_size(chunk_size, limiter)
+            if len(buffer) < length:
+                break
+            send(length, final=False)
+
+    response = None
+    while response is None:
+        response = send(len(buffer), final=True)
+
+    md5 = digests.hexdigests(hashers)["md5"]
+    if response.get("md5Checksum") and response["md5Checksum"] != md5:
+        raise IOError(f"md5Checksum mismatch for streamed upload {name} (expected {md5}, got {response['md5Checksum']})")
+    elapsed = time.time() - start
+    logger.info(f"Uploaded {name} successfully! ({offset / 1048576 / max(elapsed, 1e-6):.2f} MB/s)")
+    return response
+
+
+def upload_files(http_factory, file_paths: list, parents: list, max_streams: int = MAX_STREAMS,
+                 url: str = None) -> list:
+    """
+    Upload several files (e.g. the stripes of a backup set) as parallel streams.
+    'http_factory' returns a new http object per stream, since httplib2 is not thread-safe.
+    Returns the Drive file resources in the order of 'file_paths'.
+    """
+    def upload_one(path):
+        return upload_resumable(http_factory(), path, os.path.basename(path), parents, url)
+
+    if len(file_paths) == 1:
+        return [upload_one(file_paths[0])]
+
+    with ThreadPoolExecutor(max_workers=min(max_streams, len(file_paths)), thread_name_prefix="upload") as pool:
+        return list(pool.map(upload_one, file_paths))
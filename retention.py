@@ -0,0 +1,169 @@
+import os
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from loggingUtils import log_config
+import backup_sets
+import chain
+
+# === CONFIG ===
+# Grandfather-father-son policies: keep the newest backup set of each of the last 'daily' days,
+# 'weekly' ISO weeks and 'monthly' months. The newest set is always kept.
+POLICIES = {
+    "local": {"daily": 3, "weekly": 0, "monthly": 0},
+    "nas": {"daily": 1, "weekly": 0, "monthly": 0},
+    "drive": {"daily": 2, "weekly": 0, "monthly": 0},
+    # Additional storage targets (see storage.py) without a policy of their own
+    "offsite": {"daily": 2, "weekly": 4, "monthly": 3},
+}
+DELETE_WORKERS = 4
+# Drive accepts at most 100 calls per batch request
+DRIVE_BATCH_SIZE = 100
+DRIVE_PAGE_SIZE = 1000
+
+logger = log_config()
+
+BUCKETS = {
+    "daily": lambda t: t.date(),
+    "weekly": lambda t: t.isocalendar()[:2],
+    "monthly": lambda t: (t.year, t.month),
+}
+
+
+# ===== POLICY =====
+def select_for_deletion(items: list, policy: dict) -> list:
+    """
+    Apply a GFS policy to backup files. Each item is a dict with at least "name" and "time".
+    The policy applies to each database separately. Files are grouped into backup sets (stripes
+    and artifacts together), sets needed by a kept differential or log backup are kept too, and
+    the files of every other set are returned.
+    """
+    by_database = {}
+    for item in items:
+        by_database.setdefault(backup_sets.database_name(item["name"]), []).append(item)
+    return [old for group in by_database.values() for old in select_sets(group, policy)]
+
+
+def select_sets(items: list, policy: dict) -> list:
+    """select_for_deletion for the backups of a single database."""
+    sets = backup_sets.group_sets(items, key=lambda item: item["name"], by=backup_sets.backup_key)
+    newest_first = sorted(sets, key=lambda k: max(item["time"] for item in sets[k]), reverse=True)
+    if not newest_first:
+        return []
+
+    keep = {newest_first[0]}
+    for bucket_name, bucket in BUCKETS.items():
+        seen = set()
+        for key in newest_first:
+            if len(seen) >= policy.get(bucket_name, 0):
+                break
+            period = bucket(max(item["time"] for item in sets[key]))
+            if period not in seen:
+                seen.add(period)
+                keep.add(key)
+
+    keep = chain.with_dependencies(keep)
+    return [item for key in newest_first if key not in keep for item in sets[key]]
+
+
+def item_time(name: str, fallback: float) -> datetime.datetime:
+    return backup_sets.backup_time(name) or datetime.datetime.fromtimestamp(fallback)
+
+
+# ===== FILESYSTEM (local folder and NAS share) =====
+def list_folder(folder: str) -> list:
+    """Backup files in a folder, ignoring anything that does not follow the backup naming pattern."""
+    items = []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_file() and backup_sets.is_backup_name(entry.name):
+                items.append({"name": entry.name, "path": entry.path,
+                              "time": item_time(entry.name, entry.stat().st_mtime)})
+    return items
+
+
+def delete_paths(paths: list, workers: int = DELETE_WORKERS) -> int:
+    """Delete files through a bounded thread pool. Files already gone count as deleted."""
+    def delete(path):
+        try:
+            os.remove(path)
+            logger.info(f"Deleted old backup: {path}")
+            return True
+        except FileNotFoundError:
+            return True
+        except OSError as e:
+            logger.warning(f"Could not delete old backup {path}: {e}")
+            return False
+
+    if not paths:
+        return 0
+    with ThreadPoolExecutor(max_workers=min(workers, len(paths)), thread_name_prefix="retention") as pool:
+        return sum(pool.map(delete, paths))
+
+
+def cleanup_folder(folder: str, policy: dict) -> int:
+    """Apply a retention policy to a local or UNC folder. Returns the number of files deleted."""
+    old = select_for_deletion(list_folder(folder), policy)
+    if not old:
+        logger.info(f"No old backups to delete in {folder}.")
+        return 0
+    return delete_paths([item["path"] for item in old])
+
+
+# ===== GOOGLE DRIVE =====
+def list_drive(service, folder_id: str, name_prefix: str = "") -> list:
+    """Every backup file in a Drive folder, following nextPageToken and fetching only the needed fields."""
+    query = f"'{folder_id}' in parents and trashed=false"
+    if name_prefix:
+        query += f" and name contains '{name_prefix}'"
+    items = []
+    page_token = None
+    while True:
+        response = service.files().list(
+            q=query,
+            fields="nextPageToken, files(id, name, size, createdTime, md5Checksum, sha256Checksum)",
+            pageSize=DRIVE_PAGE_SIZE,
+            pageToken=page_token,
+            includeItemsFromAllDrives=True,
+            supportsAllDrives=True,
+            corpora="allDrives",
+        ).execute()
+        for f in response.get("files", []):
+            if backup_sets.is_backup_name(f["name"]):
+                created = datetime.datetime.fromisoformat(f["createdTime"].replace("Z", "+00:00"))
+                items.append({**f, "time": item_time(f["name"], created.timestamp())})
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            return items
+
+
+def delete_drive_files(service, files: list) -> int:
+    """
+    Permanently delete Drive files with batch requests. Files already gone (404) count as deleted,
+    so a cleanup interrupted halfway can simply run again.
+    """
+    deleted = []
+
+    def callback(request_id, response, exception):
+        status = getattr(getattr(exception, "resp", None), "status", None)
+        if exception is None or status == 404:
+            deleted.append(request_id)
+            logger.info(f"Deleted old backup: {names[request_id]}")
+        else:
+            logger.warning(f"Could not delete old backup {names[request_id]}: {exception}")
+
+    names = {f["id"]: f["name"] for f in files}
+    for start in range(0, len(files), DRIVE_BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=callback)
+        for f in files[start:start + DRIVE_BATCH_SIZE]:
+            batch.add(service.files().delete(fileId=f["id"], supportsAllDrives=True), request_id=f["id"])
+        batch.execute()
+    return len(deleted)
+
+
+def cleanup_drive(service, folder_id: str, policy: dict, name_prefix: str = "") -> int:
+    """Apply a retention policy to a Drive folder. Returns the number of files deleted."""
+    old = select_for_deletion(list_drive(service, folder_id, name_prefix), policy)
+    if not old:
+        logger.info("No old backups to delete.")
+        return 0
+    return delete_drive_files(service, old)
@@ -1,7 +1,13 @@
 @echo off
 cd /d "%~dp0"
+rem "run.bat resume" is what the task main.py schedules for the legs the forecast deferred
+if /i "%~1" == "resume" goto :resume
 python main.py
 if %ERRORLEVEL% == 0 goto :endofscript
+echo "Errors encountered during execution. Retrying the phases that failed..."
+:resume
+python main.py resume
+if %ERRORLEVEL% == 0 goto :endofscript
 echo "Errors encountered during execution. Exited with status: %errorlevel%"
 python email_errors.py %errorlevel%
 
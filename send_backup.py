@@ -1,12 +1,27 @@
 import os
-import time
-import shutil
 import glob
+import asyncio
+import threading
+from concurrent.futures import Future
 from wakeonlan import send_magic_packet
 from loggingUtils import log_config
 
 logger = log_config()
 
+# Write only the blocks that changed since the previous copy on the target
+DELTA_COPY = False
+
+# === READINESS PROBE ===
+SMB_PORT = 445
+PROBE_TIMEOUT = 1.0  # seconds per TCP connection attempt
+PROBE_MIN_DELAY = 0.25
+PROBE_MAX_DELAY = 5.0
+MAGIC_PACKET_INTERVAL = 30  # resend the magic packet while the PC is not up
+READY_TIMEOUT = 300
+
+# Parallel transfers and stripe streams share one SMB session; connecting is serialized
+_connect_lock = threading.Lock()
+
 def wake_up_pc(mac_address: str):
     """
     Send a Wake-on-LAN magic packet to the target PC.
@@ -19,101 +34,107 @@ def wake_up_pc(mac_address: str):
         raise
 
 
-def wait_for_pc(host: str, timeout: int = 120) -> bool:
-    """
-    Ping the target host (IP or computer name) until it responds or timeout expires.
-    Works with both IP and hostname.
-    """
-    logger.info(f"Waiting for PC {host} to come online (timeout: {timeout}s)")
-    start = time.time()
-    while time.time() - start < timeout:
-        response = os.system(f"ping -n 1 {host} >nul 2>&1")
-        if response == 0:
-            logger.info(f"PC {host} is online")
-            return True
-        time.sleep(5)
-    logger.warning(f"Timeout expired: PC {host} did not respond")
-    return False
+async def probe_port(host: str, port: int = SMB_PORT, timeout: float = PROBE_TIMEOUT) -> bool:
+    """True if a TCP connection to host:port opens within 'timeout' seconds."""
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return True
 
 
-def connect_network_share(target_folder: str, username: str, password: str):
+async def wait_until_ready(host: str, mac_address: str = None, port: int = None,
+                           timeout: float = READY_TIMEOUT) -> bool:
     """
-    Connect to a Windows network share with given credentials.
+    Wake the PC and wait until its SMB port accepts connections. The magic packet is resent every
+    MAGIC_PACKET_INTERVAL seconds; the port is probed with short timeouts and exponential backoff.
     """
-    try:
-        parts = target_folder.strip("\\").split("\\")
-        if len(parts) < 2:
-            raise ValueError(f"Invalid target folder UNC path: {target_folder}")
-        server = parts[0]
+    port = port or SMB_PORT
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    next_packet = start
+    delay = PROBE_MIN_DELAY
+
+    while loop.time() - start < timeout:
+        if mac_address and loop.time() >= next_packet:
+            try:
+                wake_up_pc(mac_address)
+            except Exception:
+                pass
+            next_packet = loop.time() + MAGIC_PACKET_INTERVAL
+        if await probe_port(host, port):
+            logger.info(f"PC {host} is ready (port {port}) after {loop.time() - start:.1f}s")
+            return True
+        remaining = timeout - (loop.time() - start)
+        await asyncio.sleep(max(0.0, min(delay, remaining)))
+        delay = min(delay * 2, PROBE_MAX_DELAY)
 
-        # Disconnect any existing connections
-        os.system(f'net use \\\\{server} /delete /y >nul 2>&1')
+    logger.warning(f"Timeout expired: PC {host} did not accept connections on port {port}")
+    return False
 
-        # Connect with credentials
-        result = os.system(f'net use {target_folder} /user:{username} {password}')
-        if result != 0:
-            raise ConnectionError(f"Failed to connect to {target_folder} as {username}")
 
-        logger.info(f"Connected to network share {target_folder} as {username}")
-    except Exception as e:
-        logger.error(f"Error connecting to network share {target_folder}: {e}")
-        raise
+def wait_for_share(host: str, mac_address: str = None, timeout: float = READY_TIMEOUT) -> bool:
+    return asyncio.run(wait_until_ready(host, mac_address, timeout=timeout))
 
 
-def copy_backup(local_file: str, target_folder: str, username: str = None, password: str = None):
+def start_wait_for_share(host: str, mac_address: str = None, timeout: float = READY_TIMEOUT) -> Future:
     """
-    Copy the backup file to the target network folder.
-    If username/password are provided, authenticate before copying.
+    Start waking the PC in the background (e.g. while SQL Server writes the backup).
+    The returned future resolves to True once the share is reachable, False on timeout.
     """
-    try:
-        if username and password:
-            connect_network_share(target_folder, username, password)
+    future = Future()
 
-        if not os.path.exists(local_file):
-            raise FileNotFoundError(f"Backup file not found: {local_file}")
-        
-        if not os.path.exists(target_folder):
-            raise FileNotFoundError(f"Target folder not found: {target_folder}")
+    def run():
+        try:
+            future.set_result(wait_for_share(host, mac_address, timeout))
+        except Exception as e:
+            future.set_exception(e)
 
-        shutil.copy(local_file, target_folder)
-        dest_path = os.path.join(target_folder, os.path.basename(local_file))
-        logger.info(f"Copied backup file {local_file} to {dest_path}")
+    logger.info(f"Waking up {host} in the background...")
+    threading.Thread(target=run, name="wake-probe", daemon=True).start()
+    return future
 
-        # === NEW: Keep only the two newest backups ===
-        cleanup_old_backups(target_folder)
 
-        return dest_path
-    except Exception as e:
-        logger.error(f"Failed to copy backup file {local_file} to {target_folder}: {e}")
-        raise
+def wait_for_pc(host: str, timeout: int = 120) -> bool:
+    """Wait until the target host (IP or computer name) accepts SMB connections or timeout expires."""
+    logger.info(f"Waiting for PC {host} to come online (timeout: {timeout}s)")
+    return wait_for_share(host, timeout=timeout)
 
 
-def cleanup_old_backups(target_folder: str, max_backups: int = 1):
+def connect_network_share(target_folder: str, username: str, password: str):
     """
-    Keep only the most recent 'max_backups' files in the target folder.
-    Deletes older backups based on modification time.
+    Connect to a Windows network share with given credentials.
+    A share that is already reachable is left as it is: other transfers may be copying over that
+    session, and deleting it would drop them.
     """
-    try:
-        # Get list of files in the target folder
-        files = [os.path.join(target_folder, f) for f in os.listdir(target_folder)
-                 if os.path.isfile(os.path.join(target_folder, f))]
+    with _connect_lock:
+        try:
+            parts = target_folder.strip("\\").split("\\")
+            if len(parts) < 2:
+                raise ValueError(f"Invalid target folder UNC path: {target_folder}")
+            server = parts[0]
 
-        # Skip if there are fewer than or equal to max_backups
-        if len(files) <= max_backups:
-            return
+            if os.path.isdir(target_folder):
+                logger.debug(f"Network share {target_folder} already connected")
+                return
 
-        # Sort by modification time (newest first)
-        files.sort(key=os.path.getmtime, reverse=True)
+            # Disconnect any stale connection (e.g. with other credentials)
+            os.system(f'net use \\\\{server} /delete /y >nul 2>&1')
 
-        # Delete older ones
-        for old_file in files[max_backups:]:
-            try:
-                os.remove(old_file)
-                logger.info(f"Deleted old backup: {old_file}")
-            except Exception as e:
-                logger.warning(f"Could not delete old backup {old_file}: {e}")
-    except Exception as e:
-        logger.error(f"Error cleaning up old backups in {target_folder}: {e}")
+            # Connect with credentials
+            result = os.system(f'net use {target_folder} /user:{username} {password}')
+            if result != 0:
+                raise ConnectionError(f"Failed to connect to {target_folder} as {username}")
+
+            logger.info(f"Connected to network share {target_folder} as {username}")
+        except Exception as e:
+            logger.error(f"Error connecting to network share {target_folder}: {e}")
+            raise
 
 
 def main():
@@ -151,8 +172,10 @@ def main():
             password = file.readline()
 
         # Copy the backup file to the network share
-        dest_path = copy_backup(local_file, target_folder, username, password)
-        logger.info(f"Backup successfully copied to: {dest_path}")
+        import storage
+        storage.send(storage.NASBackend(target_folder, username, password, delta=DELTA_COPY), local_file,
+                     label="nas", phase="nas_copy")
+        logger.info(f"Backup successfully copied to: {target_folder}")
 
         logger.info("=== Backup test completed successfully ===")
     except Exception as e:
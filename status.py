@@ -0,0 +1,66 @@
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from loggingUtils import log_config
+import progress
+import metrics
+
+# === CONFIG ===
+# Only reachable from the server itself
+STATUS_HOST = "127.0.0.1"
+STATUS_PORT = 8765
+
+logger = log_config()
+
+_lock = threading.Lock()
+_state = {"state": "starting", "next_run": None, "last_run": None, "progress": {}}
+
+
+# ===== STATE =====
+def update(**fields):
+    with _lock:
+        _state.update(fields)
+
+
+def on_progress(event: dict):
+    """Keep the last progress event of every stage."""
+    with _lock:
+        _state["progress"][event["stage"]] = event
+
+
+def current() -> dict:
+    with _lock:
+        state = {**_state, "progress": dict(_state["progress"])}
+    if state["state"] == "running":
+        run = metrics.snapshot()
+        state["active_phases"] = run["active"]
+        state["finished_phases"] = {name: round(e["seconds"], 1) for name, e in run["phases"].items()}
+    state["time"] = time.time()
+    return state
+
+
+# ===== HTTP ENDPOINT =====
+class StatusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") not in ("", "/status"):
+            self.send_error(404)
+            return
+        body = json.dumps(current(), indent=1, default=str).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"Status request: {format % args}")
+
+
+def start_server(host: str = STATUS_HOST, port: int = STATUS_PORT) -> ThreadingHTTPServer:
+    """Serve the status as JSON on http://host:port/status from a background thread."""
+    progress.subscribe(on_progress)
+    server = ThreadingHTTPServer((host, port), StatusHandler)
+    threading.Thread(target=server.serve_forever, name="status-server", daemon=True).start()
+    logger.info(f"Status endpoint listening on http://{host}:{server.server_port}/status")
+    return server
@@ -0,0 +1,423 @@
+import io
+import os
+import threading
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from loggingUtils import log_config
+import backup_sets
+import copy_engine
+import delta_copy
+import digests
+import history
+import metrics
+import pipeline
+import resumable
+import retention
+import throttle
+
+# === S3 CONFIG ===
+# Multipart uploads: parts of S3_PART_SIZE sent by up to S3_MAX_CONCURRENCY threads
+S3_PART_SIZE = 64 * 1024 * 1024
+S3_MAX_CONCURRENCY = 8
+# S3 DeleteObjects accepts at most 1000 keys per request
+S3_DELETE_BATCH = 1000
+
+logger = log_config()
+
+
+# ===== BACKEND INTERFACE =====
+class Backend:
+    """
+    A place backups are stored. Objects are addressed by file name; list() only returns objects
+    following the backup naming pattern, as dicts with at least "name", "size" and "time".
+    hash() returns the SHA-256 the storage knows for an object, or None when it cannot tell
+    without downloading it. get() fetches an object into a local file and returns its
+    "name", "size" and the digests of the fetched file ("sha256", "md5").
+    'throttle_kind' names the throttle windows put() runs under, and 'max_streams' how many
+    files of a backup set send() may put in parallel.
+    """
+    name = "backend"
+    throttle_kind = None
+    max_streams = 1
+
+    def put(self, local_path: str, name: str = None) -> dict:
+        raise NotImplementedError
+
+    def put_stream(self, chunks, name: str) -> dict:
+        raise NotImplementedError
+
+    def get(self, name: str, local_path: str) -> dict:
+        raise NotImplementedError
+
+    def list(self) -> list:
+        raise NotImplementedError
+
+    def delete(self, objects: list) -> int:
+        """Delete objects returned by list(). Objects already gone count as deleted."""
+        raise NotImplementedError
+
+    def stat(self, name: str) -> dict | None:
+        raise NotImplementedError
+
+    def hash(self, name: str) -> str | None:
+        raise NotImplementedError
+
+
+# ===== LOCAL DIRECTORY / NAS SHARE =====
+class LocalBackend(Backend):
+    name = "local"
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    def put(self, local_path: str, name: str = None) -> dict:
+        os.makedirs(self.root, exist_ok=True)
+        name = name or os.path.basename(local_path)
+        limiter = throttle.get_limiter(self.throttle_kind) if self.throttle_kind else None
+        stats = copy_engine.copy_file(local_path, self.path(name), limiter=limiter)
+        return {"name": name, "size": stats["bytes"], "sha256": stats["sha256"]}
+
+    def put_stream(self, chunks, name: str) -> dict:
+        os.makedirs(self.root, exist_ok=True)
+        path = pipeline.write_file(chunks, self.path(name), pipeline.new_stats(), digests.new_hashers())
+        return {"name": name, "size": os.path.getsize(path), "sha256": digests.get(path)["sha256"]}
+
+    def get(self, name: str, local_path: str) -> dict:
+        # The copy engine hashes the source while reading it and checks the copy against it
+        stats = copy_engine.copy_file(self.path(name), local_path)
+        return {"name": name, "size": stats["bytes"], **digests.cached(self.path(name))}
+
+    def list(self) -> list:
+        items = retention.list_folder(self.root)
+        for item in items:
+            item["size"] = os.path.getsize(item["path"])
+        return items
+
+    def delete(self, objects: list) -> int:
+        return retention.delete_paths([self.path(o["name"]) for o in objects])
+
+    def stat(self, name: str) -> dict | None:
+        try:
+            st = os.stat(self.path(name))
+        except FileNotFoundError:
+            return None
+        return {"name": name, "size": st.st_size, "time": retention.item_time(name, st.st_mtime)}
+
+    def hash(self, name: str) -> str | None:
+        return digests.get(self.path(name))["sha256"] if os.path.exists(self.path(name)) else None
+
+
+class NASBackend(LocalBackend):
+    """The UNC share on the backup server; connects with 'net use' before the first access."""
+    name = "nas"
+    throttle_kind = "copy"
+
+    def __init__(self, root: str, username: str = None, password: str = None, delta: bool = False):
+        super().__init__(root)
+        self.username = username
+        self.password = password
+        self.delta = delta
+        self.connected = not (username and password)
+        self._connect_lock = threading.Lock()
+
+    def connect(self):
+        # Stripe streams call this concurrently
+        with self._connect_lock:
+            if not self.connected:
+                import send_backup
+                send_backup.connect_network_share(self.root, self.username, self.password)
+                self.connected = True
+
+    def put(self, local_path: str, name: str = None) -> dict:
+        self.connect()
+        if self.delta and (name is None or name == os.path.basename(local_path)):
+            # The digest is the one computed from the patched copy on the share, not the local file's
+            result = delta_copy.delta_copy(local_path, self.root, limiter=throttle.get_limiter(self.throttle_kind))
+            return {"name": os.path.basename(local_path), "size": result["bytes"], "sha256": result["sha256"]}
+        return super().put(local_path, name)
+
+    def put_stream(self, chunks, name: str) -> dict:
+        self.connect()
+        return super().put_stream(chunks, name)
+
+    def get(self, name: str, local_path: str) -> dict:
+        self.connect()
+        return super().get(name, local_path)
+
+    def list(self) -> list:
+        self.connect()
+        return super().list()
+
+    def delete(self, objects: list) -> int:
+        self.connect()
+        return super().delete(objects)
+
+    def stat(self, name: str) -> dict | None:
+        self.connect()
+        return super().stat(name)
+
+
+# ===== GOOGLE DRIVE =====
+class DriveBackend(Backend):
+    """A Drive folder, through the resumable upload engine and the batched retention calls."""
+    name = "drive"
+    throttle_kind = "upload"
+    max_streams = resumable.MAX_STREAMS
+
+    def __init__(self, folder_id: str = None, name_prefix: str = None):
+        import upload
+        self.upload = upload
+        self.folder_id = folder_id or upload.FOLDER_ID
+        self.name_prefix = upload.NAME_PREFIX if name_prefix is None else name_prefix
+
+    def service(self):
+        return self.upload.get_drive_service()
+
+    def put(self, local_path: str, name: str = None) -> dict:
+        name = name or os.path.basename(local_path)
+        response = resumable.upload_resumable(self.upload.get_upload_http(), local_path, name, [self.folder_id])
+        self.upload.check_uploaded_digests(self.service(), local_path, response)
+        return response
+
+    def put_stream(self, chunks, name: str) -> dict:
+        return resumable.upload_stream(self.upload.get_upload_http(), chunks, name, [self.folder_id])
+
+    def get(self, name: str, local_path: str) -> dict:
+        """Concurrent ranged download (see restore.download_ranges), resumed when interrupted."""
+        import restore
+
+        info = self.stat(name)
+        if info is None:
+            raise FileNotFoundError(f"{name} not found on Drive")
+        url = restore.DOWNLOAD_URL.format(file_id=info["id"])
+        restore.download_ranges(self.upload.get_upload_http, url, info["size"], local_path)
+        return {"name": name, "size": info["size"], **digests.get(local_path)}
+
+    def list(self) -> list:
+        items = retention.list_drive(self.service(), self.folder_id, self.name_prefix)
+        for item in items:
+            item["size"] = int(item.get("size", 0))
+        return items
+
+    def delete(self, objects: list) -> int:
+        return retention.delete_drive_files(self.service(), objects)
+
+    def stat(self, name: str) -> dict | None:
+        escaped = name.replace("\\", "\\\\").replace("'", "\\'")
+        files = self.service().files().list(
+            q=f"'{self.folder_id}' in parents and name = '{escaped}' and trashed=false",
+            fields=f"files({resumable.RESPONSE_FIELDS},createdTime)",
+            includeItemsFromAllDrives=True,
+            supportsAllDrives=True,
+            corpora="allDrives",
+        ).execute().get("files", [])
+        if not files:
+            return None
+        f = files[0]
+        created = datetime.datetime.fromisoformat(f["createdTime"].replace("Z", "+00:00"))
+        return {**f, "size": int(f.get("size", 0)), "time": retention.item_time(name, created.timestamp())}
+
+    def hash(self, name: str) -> str | None:
+        info = self.stat(name)
+        return info.get("sha256Checksum") if info else None
+
+
+# ===== S3-COMPATIBLE OBJECT STORAGE =====
+class ChunkReader(io.RawIOBase):
+    """File-like view of an iterator of byte chunks, for boto3's upload_fileobj."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.pending = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self.pending:
+            try:
+                self.pending = next(self.chunks)
+            except StopIteration:
+                return 0
+        n = min(len(buffer), len(self.pending))
+        buffer[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+
+class S3Backend(Backend):
+    """
+    An S3 bucket (AWS, MinIO, ...). Requires boto3, imported only when the backend is created.
+    Credentials come from the usual boto3 sources (environment, ~/.aws) unless given here.
+    The SHA-256 of uploaded files is stored as object metadata so hash() needs no download.
+    """
+    name = "s3"
+
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: str = None, region: str = None,
+                 access_key: str = None, secret_key: str = None):
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client(
+            "s3", endpoint_url=endpoint_url, region_name=region,
+            aws_access_key_id=access_key, aws_secret_access_key=secret_key,
+        )
+        self.transfer = TransferConfig(
+            multipart_threshold=S3_PART_SIZE, multipart_chunksize=S3_PART_SIZE,
+            max_concurrency=S3_MAX_CONCURRENCY, use_threads=True,
+        )
+
+    def key(self, name: str) -> str:
+        return self.prefix + name
+
+    def put(self, local_path: str, name: str = None) -> dict:
+        name = name or os.path.basename(local_path)
+        sha256 = digests.get(local_path)["sha256"]
+        self.client.upload_file(
+            local_path, self.bucket, self.key(name),
+            ExtraArgs={"Metadata": {"sha256": sha256}}, Config=self.transfer,
+        )
+        logger.info(f"Uploaded {name} to s3://{self.bucket}/{self.key(name)}")
+        return {"name": name, "size": os.path.getsize(local_path), "sha256": sha256}
+
+    def put_stream(self, chunks, name: str) -> dict:
+        """Streamed uploads have no sha256 metadata, since it is only known once the upload is done."""
+        hashers = digests.new_hashers()
+        size = 0
+
+        def hashed():
+            nonlocal size
+            for chunk in chunks:
+                digests.update(hashers, chunk)
+                size += len(chunk)
+                yield chunk
+
+        self.client.upload_fileobj(ChunkReader(hashed()), self.bucket, self.key(name), Config=self.transfer)
+        logger.info(f"Uploaded {name} to s3://{self.bucket}/{self.key(name)}")
+        return {"name": name, "size": size, "sha256": digests.hexdigests(hashers)["sha256"]}
+
+    def get(self, name: str, local_path: str) -> dict:
+        """boto3 already splits large downloads into concurrent ranged GETs (S3_PART_SIZE parts)."""
+        tmp = local_path + ".part"
+        self.client.download_file(self.bucket, self.key(name), tmp, Config=self.transfer)
+        os.replace(tmp, local_path)
+        return {"name": name, "size": os.path.getsize(local_path), **digests.get(local_path)}
+
+    def list(self) -> list:
+        items = []
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for obj in page.get("Contents", []):
+                name = obj["Key"][len(self.prefix):]
+                if "/" not in name and backup_sets.is_backup_name(name):
+                    items.append({"name": name, "size": obj["Size"],
+                                  "time": retention.item_time(name, obj["LastModified"].timestamp())})
+        return items
+
+    def delete(self, objects: list) -> int:
+        deleted = 0
+        for start in range(0, len(objects), S3_DELETE_BATCH):
+            batch = objects[start:start + S3_DELETE_BATCH]
+            response = self.client.delete_objects(
+                Bucket=self.bucket,
+                Delete={"Objects": [{"Key": self.key(o["name"])} for o in batch], "Quiet": True},
+            )
+            errors = response.get("Errors", [])
+            for error in errors:
+                logger.warning(f"Could not delete old backup {error['Key']}: {error.get('Message')}")
+            deleted += len(batch) - len(errors)
+        return deleted
+
+    def stat(self, name: str) -> dict | None:
+        from botocore.exceptions import ClientError
+
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        return {"name": name, "size": head["ContentLength"],
+                "time": retention.item_time(name, head["LastModified"].timestamp()),
+                "sha256": head.get("Metadata", {}).get("sha256")}
+
+    def hash(self, name: str) -> str | None:
+        info = self.stat(name)
+        return info.get("sha256") if info else None
+
+
+BACKENDS = {
+    "local": LocalBackend,
+    "nas": NASBackend,
+    "drive": DriveBackend,
+    "s3": S3Backend,
+}
+
+
+def make_backend(kind: str, **options) -> Backend:
+    """Create a backend from its configuration, e.g. make_backend("s3", bucket="backups")."""
+    if kind not in BACKENDS:
+        raise ValueError(f"Unknown storage backend {kind!r} (expected one of {', '.join(BACKENDS)})")
+    return BACKENDS[kind](**options)
+
+
+# ===== GENERIC OPERATIONS =====
+def cleanup(backend: Backend, policy: dict) -> int:
+    """Apply a retention policy (see retention.POLICIES) to any backend."""
+    old = retention.select_for_deletion(backend.list(), policy)
+    if not old:
+        logger.info(f"No old backups to delete on {backend.name}.")
+        return 0
+    return backend.delete(old)
+
+
+def send(backend: Backend, backup_files, policy: dict = None, label: str = None, phase: str = None) -> list:
+    """
+    Store a backup set on a backend as one unit: if any file fails, the files already stored are
+    deleted again. Each stored file is checked against the local digests when the backend knows
+    its hash, then the retention policy is applied. 'label' names the metrics phases (defaults to
+    the backend kind); 'phase' overrides the name of the put phase, e.g. "nas_copy" or "upload" for
+    the legs the forecast learns from. Returns the put() results.
+    """
+    local_files = backup_sets.as_list(backup_files)
+    label = label or backend.name
+    phase = phase or f"{label}_put"
+    if backend.throttle_kind:
+        throttle.check_window(backend.throttle_kind, sum(os.path.getsize(f) for f in local_files),
+                              history.recent_throughput(phase))
+    stored = []
+
+    def put(f):
+        name = os.path.basename(f)
+        with metrics.phase(phase, os.path.getsize(f)):
+            result = backend.put(f, name)
+        stored.append({"name": name, **result})
+        remote = result.get("sha256") or result.get("sha256Checksum")
+        if remote and remote != digests.get(f)["sha256"]:
+            raise IOError(f"SHA-256 mismatch for {name} on {backend.name}")
+
+    try:
+        if len(local_files) == 1 or backend.max_streams == 1:
+            for f in local_files:
+                put(f)
+        else:
+            with ThreadPoolExecutor(max_workers=min(backend.max_streams, len(local_files)),
+                                    thread_name_prefix=f"{label}-put") as pool:
+                list(pool.map(metrics.bind(put), local_files))
+    except Exception:
+        if stored:
+            backend.delete(stored)
+        raise
+
+    # The set is stored; a failed cleanup is retried by the next run and does not fail this one
+    with metrics.phase(f"cleanup_{label}"):
+        try:
+            cleanup(backend, policy or retention.POLICIES.get(backend.name, retention.POLICIES["offsite"]))
+        except Exception as e:
+            logger.error(f"Error cleaning up old backups on {backend.name}: {e}")
+    return stored
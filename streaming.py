@@ -0,0 +1,133 @@
+import os
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from loggingUtils import log_config
+import digests
+import metrics
+import pipeline
+import retention
+import storage
+
+# === CONFIG ===
+POLL_INTERVAL = 0.5  # seconds between reads once the reader has caught up with SQL Server
+BUFFER_SIZE = 8 * 1024 * 1024
+
+logger = log_config()
+
+
+# ===== TAIL =====
+def tail_file(path: str, finished: threading.Event, hashers: dict = None,
+              buffer_size: int = BUFFER_SIZE, poll_interval: float = POLL_INTERVAL):
+    """
+    Yield the bytes of a file while another process is still writing it, until 'finished' is set
+    and the end of the file is reached. The bytes read are hashed into 'hashers'.
+    SQL Server may pre-allocate a compressed backup or rewrite its header at the end, so whatever
+    was read must be checked against the final file (see backup_while_streaming).
+    """
+    while not os.path.exists(path):
+        if finished.is_set():
+            raise FileNotFoundError(f"Backup file was never created: {path}")
+        time.sleep(poll_interval)
+
+    with open(path, "rb") as f:
+        while True:
+            # Checked before reading, so the last read after the backup finished sees every byte
+            done = finished.is_set()
+            data = f.read(buffer_size)
+            if data:
+                if hashers is not None:
+                    digests.update(hashers, data)
+                yield data
+            elif done:
+                return
+            else:
+                time.sleep(poll_interval)
+
+
+# ===== BACKUP WHILE STREAMING =====
+def stream_file(backend: storage.Backend, path: str, finished: threading.Event, compression: str = None) -> dict:
+    """Send one growing backup file (through the compression/encryption stages) to a backend."""
+    raw = digests.new_hashers()
+    name = os.path.basename(pipeline.artifact_path(path, compression))
+    chunks = tail_file(path, finished, raw)
+    if pipeline.is_enabled(compression):
+        chunks = pipeline.transform(chunks, pipeline.new_stats(), compression)
+    info = backend.put_stream(chunks, name)
+    return {"object": {**info, "name": name}, "raw": digests.hexdigests(raw)}
+
+
+def backup_while_streaming(run_backup, targets: dict, compression: str = None) -> tuple:
+    """
+    Run the SQL backup and send its files to the targets while SQL Server is still writing them.
+    'run_backup(on_files)' runs backup.backup_database and returns its result; 'targets' maps a
+    destination name to a function returning its storage backend (called from the stream thread,
+    so it may wait for the backup server to wake up). 'compression' overrides pipeline.COMPRESSION.
+    A target only counts as done when every file arrived and the bytes streamed match the final
+    backup files; otherwise what it received is deleted and the caller sends the finished files
+    the usual way. Returns (backup files or None, result dicts of the targets that are done).
+    """
+    files_ready = Future()
+    finished = threading.Event()
+
+    def backup_thread():
+        try:
+            return run_backup(files_ready.set_result)
+        finally:
+            finished.set()
+            if not files_ready.done():
+                files_ready.set_result(None)
+
+    start = time.time()
+    backup_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="backup")
+    backup_future = backup_pool.submit(metrics.bind(backup_thread))
+    files = files_ready.result()
+    if not files:
+        return backup_future.result(), []
+
+    logger.info(f"Streaming {len(files)} backup file(s) to {', '.join(targets)} while SQL Server writes them")
+    backends = {}
+    streams = {}
+    # One lock per target: the backup server may wait for the wake-up, the other targets must not
+    locks = {name: threading.Lock() for name in targets}
+
+    def open_stream(name, path):
+        with locks[name]:
+            if name not in backends:
+                backends[name] = targets[name]()
+        return stream_file(backends[name], path, finished, compression)
+
+    with ThreadPoolExecutor(max_workers=len(targets) * len(files), thread_name_prefix="stream") as pool:
+        for name in targets:
+            streams[name] = [pool.submit(metrics.bind(open_stream), name, path) for path in files]
+        backup_files = backup_future.result()
+        backup_pool.shutdown()
+    elapsed = time.time() - start
+
+    results = []
+    for name, futures in streams.items():
+        done = [f.result() for f in futures if f.exception() is None]
+        error = next((f.exception() for f in futures if f.exception() is not None), None)
+        if error is None and backup_files:
+            for path, stream in zip(backup_files, done):
+                if stream["raw"]["sha256"] != digests.get(path)["sha256"]:
+                    error = IOError(f"{os.path.basename(path)} changed after it was streamed")
+                    break
+
+        backend = backends.get(name)
+        if error is not None or not backup_files:
+            if error is not None:
+                logger.warning(f"[{name}] Streaming failed, the finished backup will be sent instead: {error}")
+            if backend is not None and done:
+                backend.delete([stream["object"] for stream in done])
+            continue
+
+        metrics.record(f"destination {name}", seconds=elapsed,
+                       nbytes=sum(os.path.getsize(f) for f in backup_files))
+        logger.info(f"[{name}] Streamed and verified during the backup ({elapsed:.1f}s)")
+        try:
+            storage.cleanup(backend, retention.POLICIES.get(backend.name, retention.POLICIES["offsite"]))
+        except Exception as e:
+            logger.error(f"[{name}] Error cleaning up old backups: {e}")
+        results.append({"name": name, "code": 0, "attempts": 1, "seconds": elapsed, "error": None})
+    return backup_files, results
@@ -0,0 +1,177 @@
+import time
+import datetime
+import threading
+from loggingUtils import log_config
+
+# === CONFIG ===
+# Bandwidth windows per transfer kind, in bytes per second: None = unlimited, 0 = paused.
+# The first window matching the current time wins; outside every window transfers run at full
+# speed. Windows may cross midnight; 'weekdays' uses datetime.weekday() (0 = Monday).
+WINDOWS = {
+    "upload": [
+        {"start": "07:30", "end": "20:00", "rate": 2 * 1024 * 1024, "weekdays": [0, 1, 2, 3, 4, 5]},
+    ],
+    "copy": [
+        {"start": "07:30", "end": "20:00", "rate": 30 * 1024 * 1024, "weekdays": [0, 1, 2, 3, 4, 5]},
+    ],
+}
+# Tokens a limiter can save up while idle, in seconds of its rate
+BURST_SECONDS = 1.0
+# Longest single sleep, so a window change is noticed
+MAX_SLEEP = 30
+
+logger = log_config()
+
+
+class Clock:
+    """Wall clock for the windows and monotonic time for the buckets; replaced by a fake in tests."""
+
+    def now(self) -> datetime.datetime:
+        return datetime.datetime.now()
+
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+    def sleep(self, seconds: float):
+        time.sleep(seconds)
+
+
+# ===== WINDOWS =====
+def parse_time(value: str) -> datetime.time:
+    return datetime.datetime.strptime(value, "%H:%M").time()
+
+
+def in_window(window: dict, when: datetime.datetime) -> bool:
+    start, end = parse_time(window["start"]), parse_time(window["end"])
+    t = when.time()
+    if start <= end:
+        day = when.weekday()
+        inside = start <= t < end
+    else:
+        # Crosses midnight: the part after midnight belongs to the previous day's window
+        day = when.weekday() if t >= start else (when - datetime.timedelta(days=1)).weekday()
+        inside = t >= start or t < end
+    return inside and day in window.get("weekdays", range(7))
+
+
+def rate_at(windows: list, when: datetime.datetime) -> float | None:
+    """Allowed rate at a given time (the first matching window wins)."""
+    for window in windows:
+        if in_window(window, when):
+            return window["rate"]
+    return None
+
+
+def next_change(windows: list, when: datetime.datetime) -> datetime.datetime:
+    """Next time any window starts or ends, i.e. the next time the allowed rate may change."""
+    candidates = []
+    for window in windows:
+        for boundary in (window["start"], window["end"]):
+            t = datetime.datetime.combine(when.date(), parse_time(boundary))
+            if t <= when:
+                t += datetime.timedelta(days=1)
+            candidates.append(t)
+    return min(candidates) if candidates else when + datetime.timedelta(days=1)
+
+
+# ===== TOKEN BUCKET =====
+class Limiter:
+    """
+    Token bucket whose rate follows the time-of-day windows. acquire() is called at chunk
+    boundaries before sending a chunk, so transfers slow down, pause and resume between chunks.
+    One limiter is shared by every stream of the same kind.
+    """
+
+    def __init__(self, windows: list, clock: Clock = None, burst_seconds: float = BURST_SECONDS):
+        self.windows = windows
+        self.clock = clock or Clock()
+        self.burst_seconds = burst_seconds
+        self.tokens = 0.0
+        self.last = self.clock.monotonic()
+        self.lock = threading.Lock()
+
+    def rate(self) -> float | None:
+        return rate_at(self.windows, self.clock.now())
+
+    def acquire(self, nbytes: int) -> float:
+        """Wait until 'nbytes' may be sent. Returns the seconds waited."""
+        waited = 0.0
+        paused_logged = False
+        with self.lock:
+            while True:
+                rate = self.rate()
+                now = self.clock.monotonic()
+                if rate is None:
+                    self.last = now
+                    self.tokens = 0.0
+                    return waited
+                if rate > 0:
+                    self.tokens = min(self.tokens + (now - self.last) * rate, rate * self.burst_seconds)
+                    self.last = now
+                    if self.tokens >= 0:
+                        # Chunks bigger than the bucket are let through and paid back as debt
+                        self.tokens -= nbytes
+                        return waited
+                    delay = -self.tokens / rate
+                else:
+                    if not paused_logged:
+                        logger.info(f"Transfers paused until {next_change(self.windows, self.clock.now()):%H:%M}")
+                        paused_logged = True
+                    self.last = now
+                    delay = (next_change(self.windows, self.clock.now()) - self.clock.now()).total_seconds()
+                delay = max(0.01, min(delay, MAX_SLEEP))
+                self.clock.sleep(delay)
+                waited += delay
+
+
+_limiters = {}
+_lock = threading.Lock()
+
+
+def get_limiter(kind: str) -> Limiter:
+    """Process-wide limiter for a transfer kind ("upload" or "copy")."""
+    with _lock:
+        if kind not in _limiters:
+            _limiters[kind] = Limiter(WINDOWS.get(kind, []))
+        return _limiters[kind]
+
+
+# ===== ESTIMATES =====
+def estimate_finish(windows: list, nbytes: int, link_rate: float,
+                    start: datetime.datetime = None) -> datetime.datetime:
+    """When a transfer of 'nbytes' at 'link_rate' bytes/s would end under the windows' limits."""
+    t = start or datetime.datetime.now()
+    remaining = float(nbytes)
+    for _ in range(10000):
+        limit = rate_at(windows, t)
+        rate = link_rate if limit is None else min(link_rate, limit)
+        boundary = next_change(windows, t)
+        span = (boundary - t).total_seconds()
+        if rate > 0 and remaining <= rate * span:
+            return t + datetime.timedelta(seconds=remaining / rate)
+        remaining -= rate * span
+        t = boundary
+    raise ValueError("Transfer does not finish within the estimate horizon")
+
+
+def check_window(kind: str, nbytes: int, link_rate: float | None, start: datetime.datetime = None) -> dict | None:
+    """
+    Log when a transfer will end and whether it runs into a capped window.
+    'link_rate' is the unthrottled throughput (e.g. from the run history); None skips the estimate.
+    """
+    if not link_rate:
+        return None
+    windows = WINDOWS.get(kind, [])
+    start = start or datetime.datetime.now()
+    finish = estimate_finish(windows, nbytes, link_rate, start)
+    unthrottled = start + datetime.timedelta(seconds=nbytes / link_rate)
+    estimate = {"start": start, "finish": finish, "unthrottled_finish": unthrottled,
+                "throttled": finish > unthrottled + datetime.timedelta(seconds=1)}
+    if estimate["throttled"]:
+        logger.warning(
+            f"{kind.capitalize()} of {nbytes / 1048576:.0f} MiB runs into a bandwidth window: expected to "
+            f"finish at {finish:%Y-%m-%d %H:%M} instead of {unthrottled:%H:%M} at full speed"
+        )
+    else:
+        logger.info(f"{kind.capitalize()} of {nbytes / 1048576:.0f} MiB expected to finish at {finish:%H:%M}")
+    return estimate
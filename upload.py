@@ -1,113 +1,108 @@
 import os
-import time
 import glob
+import json
+import threading
 from loggingUtils import log_config
-from tenacity import retry, wait_exponential, stop_after_attempt
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaFileUpload
-from google.oauth2 import service_account
+import digests
 
 # === CONFIG ===
 EXTENSION = "bak"
 SERVICE_ACCOUNT_FILE = "credentials.json"
 SCOPES = ["https://www.googleapis.com/auth/drive"]
 FOLDER_ID = "0AGehFL_62_CeUk9PVA"
+# Backups of every database share the folder; the backup naming pattern tells them apart
+NAME_PREFIX = ""
+# Drive v3 discovery document, copied from the one shipped with googleapiclient on first use
+DISCOVERY_CACHE = "drive_v3_discovery.json"
 
 logger = log_config()
 
-def get_drive_service():
-    creds = service_account.Credentials.from_service_account_file(
-        SERVICE_ACCOUNT_FILE, scopes=SCOPES
-    )
-    return build("drive", "v3", credentials=creds)
-
-@retry(wait=wait_exponential(multiplier=2, min=2, max=60), stop=stop_after_attempt(5))
-def upload_file(service, file_path):
-    file_name = f"MWFichaClinica-{time.strftime('%Y-%m-%d_%H-%M')}.{EXTENSION}"
-    media = MediaFileUpload(file_path, chunksize=5 * 1024 * 1024, resumable=True)
-
-    # Create upload request (Shared Drive compatible)
-    request = service.files().create(
-        media_body=media,
-        body={"name": file_name, "parents": [FOLDER_ID]},
-        supportsAllDrives=True  # 👈 Required for Shared Drives
-    )
+# The Google client libraries are imported inside the functions that need them,
+# so runs that stop before the Drive stage (and the other CLIs) do not pay for loading them.
+
+# Kept for the life of the process so the daemon does not rebuild them on every run
+_credentials = None
+_service = None
+_lock = threading.Lock()
+
+
+def get_credentials():
+    """Service account credentials, read once and refreshed before they expire."""
+    from google.oauth2 import service_account
+    from google_auth_httplib2 import Request
+    from googleapiclient.http import build_http
+
+    global _credentials
+    with _lock:
+        if _credentials is None:
+            _credentials = service_account.Credentials.from_service_account_file(
+                SERVICE_ACCOUNT_FILE, scopes=SCOPES
+            )
+        if not _credentials.valid:
+            _credentials.refresh(Request(build_http()))
+        return _credentials
+
+
+def load_discovery_document() -> str | None:
+    """Drive v3 discovery document from the local cache, so building the service needs no network."""
+    if os.path.exists(DISCOVERY_CACHE):
+        with open(DISCOVERY_CACHE, "r", encoding="utf-8") as f:
+            return f.read()
+    from googleapiclient.discovery_cache import get_static_doc
+    document = get_static_doc("drive", "v3")
+    if document is None:
+        return None
+    try:
+        json.loads(document)
+        tmp = DISCOVERY_CACHE + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(document)
+        os.replace(tmp, DISCOVERY_CACHE)
+    except (ValueError, OSError) as e:
+        logger.warning(f"Could not cache the Drive discovery document: {e}")
+    return document
 
-    response = None
-    last_progress = 0
 
-    while response is None:
-        try:
-            status, response = request.next_chunk()
-            if status:
-                progress = int(status.progress() * 100)
-                if progress >= last_progress + 1:
-                    logger.info(f"Progress: {progress}%")
-                    last_progress = progress
-        except HttpError as e:
-            logger.warning(f"HTTP error {e.resp.status}, retrying...")
-            raise e
+def get_drive_service():
+    from googleapiclient.discovery import build, build_from_document
 
+    global _service
+    credentials = get_credentials()
+    with _lock:
+        if _service is None:
+            document = load_discovery_document()
+            if document is not None:
+                _service = build_from_document(document, credentials=credentials)
+            else:
+                _service = build("drive", "v3", credentials=credentials, cache_discovery=False)
+        return _service
 
-    logger.info(f"Uploaded {file_name} successfully!")
 
-    # Clean old backups and then empty trash
-    cleanup_old_backups(service, keep_latest=2)
+def get_upload_http():
+    """Authorized http object for the resumable upload engine (one per upload stream)."""
+    from google_auth_httplib2 import AuthorizedHttp
+    from googleapiclient.http import build_http
 
-    return response["id"]
+    # build_http() disables httplib2's handling of 308, which Drive uses for "resume incomplete"
+    return AuthorizedHttp(get_credentials(), http=build_http())
 
 
-def cleanup_old_backups(service, keep_latest=2):
+def check_uploaded_digests(service, file_path, response):
     """
-    Deletes old backup files in the target folder, keeping only the newest 'keep_latest' backups.
-    After deletion, it empties the Drive trash.
+    Compare the checksums Drive computed for an uploaded file with the local reference digests.
+    A corrupted upload is deleted so the next attempt uploads it again.
     """
-    try:
-        query = f"'{FOLDER_ID}' in parents and fileExtension='{EXTENSION}'"
-        results = service.files().list(
-            q=query,
-            orderBy="createdTime asc",
-            includeItemsFromAllDrives=True,
-            supportsAllDrives=True,
-            corpora="allDrives"
-        ).execute()
-
-        files = results.get("files", [])
-        if len(files) <= keep_latest:
-            logger.info("No old backups to delete.")
-            return
-
-        # Delete oldest backups
-        for f in files[:-keep_latest]:
-            try:
-                service.files().delete(fileId=f["id"], supportsAllDrives=True).execute()
-                logger.info(f"Deleted old backup: {f['name']}")
-            except Exception as e:
-                logger.warning(f"Could not delete old backup {f['name']}: {e}")
-
-        empty_trash(service)
-
-    except Exception as e:
-        logger.error(f"Error cleaning up old backups: {e}")
-
-
-def empty_trash(service):
-    """
-    Permanently empties the Google Drive trash (for the authenticated account or Shared Drive).
-    """
-    try:
-        service.files().emptyTrash().execute()
-        logger.info("Google Drive trash has been emptied successfully.")
-    except HttpError as e:
-        logger.error(f"Failed to empty Google Drive trash: {e}")
-    except Exception as e:
-        logger.error(f"Unexpected error while emptying trash: {e}")
+    reference = digests.get(file_path)
+    for name, field in (("md5", "md5Checksum"), ("sha256", "sha256Checksum")):
+        remote = response.get(field)
+        if remote and remote != reference[name]:
+            service.files().delete(fileId=response["id"], supportsAllDrives=True).execute()
+            raise IOError(f"{field} mismatch for {response['name']} on Drive (expected {reference[name]}, got {remote})")
+    logger.info(f"Drive checksums of {response['name']} match the local file")
 
 
 if __name__ == "__main__":
     logger.info("=== Starting Google Drive upload (Shared Drive mode) ===")
-    service = get_drive_service()
 
     pattern = 'C:\\Users\\Servidor\\Desktop\\GynébeBackup\\MWFichaClinica*'
     files = glob.glob(pattern)
@@ -121,6 +116,5 @@ if __name__ == "__main__":
     if not os.path.exists(backup_file):
         logger.error(f"Backup file not found: {backup_file}")
     else:
-        upload_file(service, backup_file)
-
-    cleanup_old_backups(service, keep_latest=2)
\ No newline at end of file
+        import storage
+        storage.send(storage.DriveBackend(), backup_file, label="drive", phase="upload")
\ No newline at end of file